@@ -0,0 +1,3 @@
+from gogitit.api import CheckResult, PlanResult, Session, SyncResult  # noqa: F401
+from gogitit.errors import (  # noqa: F401
+    BatchError, ConflictError, GogititError, LockTimeout, ManifestError, RepoError, StatusError)
@@ -0,0 +1,633 @@
+"""
+Library API to plan, sync and check manifests from Python without the CLI. Nothing
+here prints or exits, progress is passed to a callback, results are returned and
+errors raised as the types in gogitit.errors:
+
+    session = gogitit.Session('/var/cache/gogitit', progress=log.info, jobs=4)
+    try:
+        for manifest in manifests:
+            result = session.sync(manifest)
+    finally:
+        session.close()
+
+A session keeps the repo caches it opened for the runs which follow, so a long
+running process skips reopening them and re-reading their objects. For a single
+run, plan(), sync(), sync_all() and check() in this module create and close a
+session.
+"""
+
+import collections
+from multiprocessing.pool import ThreadPool
+import hashlib
+import os
+import threading
+
+import git
+
+import gogitit.cache
+import gogitit.export
+import gogitit.jobs
+import gogitit.manifest
+import gogitit.plan
+import gogitit.status
+import gogitit.timings
+from gogitit.errors import BatchError, ManifestError, RepoError
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.gogitit/cache')
+
+# Returned by check when no sync is required, otherwise one of the CHECK_STATUS_*
+# constants of gogitit.manifest:
+CHECK_STATUS_OK = 0
+
+
+class SyncResult(collections.namedtuple('SyncResult', [
+        'output_dir', 'rebuilt', 'deltas', 'unchanged', 'files_written', 'files_current', 'pruned', 'conflicts',
+        'timings'])):
+    """
+    Keys of the copies rebuilt, of those updated from a git diff (also in rebuilt) and of
+    those left unchanged, the number of files written, left in place as already current
+    and pruned, (path, first key, second key) conflicts and the Timings of the sync.
+    """
+    __slots__ = ()
+
+
+class PlanResult(collections.namedtuple('PlanResult', ['output_dir', 'copies', 'changes', 'conflicts',
+                                                       'unchanged'])):
+    """
+    (key, action) for each copy, where action is rebuild, delta or unchanged, (change,
+    path, key) for each file a sync would add, update, remove or keep modified,
+    (path, first key, second key) conflicts, and the number of files left unchanged.
+    """
+    __slots__ = ()
+
+
+class CheckResult(collections.namedtuple('CheckResult', ['output_dir', 'status', 'reasons', 'verified'])):
+    """
+    The CHECK_STATUS_* status, with the reasons a sync is required, if any. verified
+    is the (change, path) list of output files changed since the sync when verifying,
+    otherwise None.
+    """
+    __slots__ = ()
+
+    @property
+    def sync_required(self):
+        return self.status != CHECK_STATUS_OK
+
+
+class Session(object):
+    """
+    Runs plans, syncs and checks against one cache dir, one at a time, with the same
+    defaults. Repo caches opened by a run are kept open for the following runs. Their
+    locks are released at the end of every run, so other processes can use them in
+    between, and the session should be closed once done.
+
+    progress is called with each line of progress, which is dropped if None.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, progress=None, jobs=1, jobs_per_host=4, depth=None,
+                 filter_spec=None, max_age=None, lock_timeout=300):
+        self.cache_dir = cache_dir
+        self.progress = progress
+        self.jobs = jobs
+        self.jobs_per_host = jobs_per_host
+        self.depth = depth
+        self.filter_spec = filter_spec
+        self.max_age = max_age
+        self.lock_timeout = lock_timeout
+
+        # Map of repo_url_to_dir() to every RepoCache opened by this session:
+        self.repo_caches = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "Session<cache_dir=%s>" % self.cache_dir
+
+    def echo(self, message=''):
+        if self.progress is not None:
+            self.progress(message)
+
+    def load(self, manifest_file, output_dir=None, target=None):
+        """
+        Load a manifest from a path or open file, returning it with its output dir set
+        and the SHA1 of its contents. output_dir overrides the manifest's. Of a manifest
+        declaring targets, loads the one named target, which may be omitted if it
+        declares only one.
+        """
+        manifests = self.load_targets(manifest_file, [target] if target else None, output_dir)
+        if len(manifests) > 1:
+            raise ManifestError("Manifest %s declares targets %s, choose one." % (
+                manifests[0][0].path, ', '.join(manifest.target for manifest, manifest_sha in manifests)))
+        return manifests[0]
+
+    def load_targets(self, manifest_file, targets=None, output_dir=None):
+        """
+        Load each target a manifest declares, or only those named in targets, returning
+        (manifest, SHA1) pairs as load() does. A manifest without targets is loaded as is.
+        """
+        if not hasattr(manifest_file, 'read'):
+            with open(manifest_file, 'r') as f:
+                return self.load_targets(f, targets, output_dir)
+        manifests = gogitit.manifest.load_targets(manifest_file, self.cache_dir, self.repo_caches, targets,
+                                                  depth=self.depth, filter=self.filter_spec)
+        if output_dir and len(manifests) > 1:
+            raise ManifestError("An output dir can only be given for a single target.")
+        manifest_file.seek(0)
+        manifest_sha = hashlib.sha1(manifest_file.read()).hexdigest()
+        for manifest in manifests:
+            manifest.set_max_age(self.max_age)
+            manifest.set_lock_timeout(self.lock_timeout)
+            setup_output_dir(manifest, output_dir)
+        return [(manifest, manifest_sha) for manifest in manifests]
+
+    def _start(self, create_cache_dir=True):
+        """ Ready the repo caches of earlier runs to be used again. """
+        for cache in self.repo_caches.values():
+            cache.reset()
+        if create_cache_dir:
+            self._create_cache_dir()
+
+    def _create_cache_dir(self):
+        # Make sure the working directory exists:
+        if not os.path.exists(self.cache_dir):
+            self.echo("Creating gogitit cache directory: %s" % self.cache_dir)
+            os.makedirs(self.cache_dir)
+
+    def sync(self, manifest_file, output_dir=None, force=False, delta=True, link_mode='copy', copy_jobs=4,
+             gc_interval=7 * 24 * 60 * 60, cache_max_size=None, target=None):
+        """ Fetch all remote sources and assemble them into the output dir, returning a SyncResult. """
+        with self._lock:
+            timings = gogitit.timings.Timings()
+            self._start()
+            manifest, manifest_sha = self.load(manifest_file, output_dir, target)
+            try:
+                self.echo("\nSyncing to: %s" % manifest.output_dir)
+                self.echo("\nCloning repositories:\n")
+                self._fetch([manifest], timings, gc_interval)
+                result = self._assemble(manifest, manifest_sha, timings, force, delta, link_mode, copy_jobs,
+                                        self.echo)
+                self._prune_caches([manifest], timings, cache_max_size)
+            finally:
+                manifest.release_locks()
+            timings.stop()
+            return result
+
+    def sync_all(self, manifest_files, force=False, delta=True, link_mode='copy', copy_jobs=4,
+                 gc_interval=7 * 24 * 60 * 60, cache_max_size=None, sync_jobs=1, targets=None):
+        """
+        Sync many manifests, each to its own output dir, and every target of those which
+        declare targets, or only those named in targets. Every repo any of them uses is
+        fetched once, with all versions they need, then output dirs are assembled with
+        sync_jobs at a time. Returns a SyncResult for each manifest or target in order, all
+        sharing the Timings of the batch. A failure does not stop the others, once all are
+        done a BatchError is raised if any failed, keyed by Manifest.key.
+        """
+        with self._lock:
+            timings = gogitit.timings.Timings()
+            self._start()
+            manifests = []
+            try:
+                for manifest_file in manifest_files:
+                    manifests.extend(self.load_targets(manifest_file, targets))
+                results, failures = self._sync_all(manifests, timings, force, delta, link_mode, copy_jobs,
+                                                   gc_interval, cache_max_size, sync_jobs)
+            finally:
+                for manifest, manifest_sha in manifests:
+                    manifest.release_locks()
+            timings.stop()
+
+        self.echo("\nManifest summary:\n")
+        for manifest, manifest_sha in manifests:
+            if manifest.key in failures:
+                self.echo("  FAILED  %s: %s" % (
+                    manifest.key, gogitit.jobs.error_message(failures[manifest.key]).splitlines()[0]))
+            else:
+                self.echo("  ok      %s -> %s" % (manifest.key, manifest.output_dir))
+        if failures:
+            raise BatchError("%s of %s manifests failed." % (len(failures), len(manifests)), failures, results)
+        return [results[manifest.key] for manifest, manifest_sha in manifests]
+
+    def _sync_all(self, manifests, timings, force, delta, link_mode, copy_jobs, gc_interval, cache_max_size,
+                  sync_jobs):
+        output_dirs = {}
+        for manifest, manifest_sha in manifests:
+            output_dir = os.path.realpath(manifest.output_dir)
+            if output_dir in output_dirs:
+                raise ManifestError("Manifests %s and %s both sync to: %s" % (
+                    output_dirs[output_dir], manifest.key, manifest.output_dir))
+            output_dirs[output_dir] = manifest.key
+
+        failures = {}
+        versions = set((repo.url, repo.version) for manifest, manifest_sha in manifests for repo in manifest.repos)
+        self.echo("\nCloning %s repositories at %s versions for %s manifests:\n" % (
+            len(set(url for url, version in versions)), len(versions), len(manifests)))
+        try:
+            self._fetch([manifest for manifest, manifest_sha in manifests], timings, gc_interval)
+        except RepoError as e:
+            # Manifests using repos which fetched can still be synced:
+            for repo, error in e.failures.items():
+                failures.setdefault(repo.manifest.key, error)
+
+        # Copies of the same source at the same commit write the same files, i.e. in several
+        # targets of one manifest file, which are read from git once through the blob store:
+        sources = collections.Counter(_source(copy) for manifest, manifest_sha in manifests
+                                      if manifest.key not in failures
+                                      for repo in manifest.repos for copy in repo.copy)
+        shared = frozenset(source for source, count in sources.items() if count > 1)
+        store = gogitit.export.BlobStore(os.path.join(self.cache_dir, gogitit.export.BLOB_STORE_DIR))
+
+        def _assemble_one(item):
+            manifest, manifest_sha = item
+            output = ["\nSyncing to: %s" % manifest.output_dir]
+            # Read the repo caches through git repos of this thread's own, as a repo's
+            # persistent git cat-file process can only serve one thread at a time:
+            git_repos = {}
+            for repo in manifest.repos:
+                git_dir = repo.cache.git_repo.git_dir
+                if git_dir not in git_repos:
+                    git_repos[git_dir] = git.Repo(git_dir)
+                repo.tree = gogitit.export.CommitTree(git_repos[git_dir], repo.sha)
+            try:
+                return manifest, self._assemble(manifest, manifest_sha, timings, force, delta, link_mode,
+                                                copy_jobs, output.append, store, shared), output
+            except Exception as e:
+                output.append("  Error: %s" % gogitit.jobs.error_message(e))
+                return manifest, e, output
+            finally:
+                for git_repo in git_repos.values():
+                    git_repo.git.clear_cache()
+
+        results = {}
+        pending = [item for item in manifests if item[0].key not in failures]
+        pool = ThreadPool(min(sync_jobs, len(pending)) or 1)
+        try:
+            for manifest, result, output in pool.imap_unordered(_assemble_one, pending):
+                for line in output:
+                    self.echo(line)
+                if isinstance(result, Exception):
+                    failures[manifest.key] = result
+                else:
+                    results[manifest.key] = result
+        finally:
+            pool.close()
+            pool.join()
+            if link_mode == 'copy':
+                # Nothing links to the store files written for copies to share, so they
+                # would only take space until evicted:
+                store.discard()
+
+        self._prune_caches([manifest for manifest, manifest_sha in manifests], timings, cache_max_size)
+        return results, failures
+
+    def _fetch(self, manifests, timings, gc_interval):
+        """ Clone/update all repos of the manifests, each cache once for every version they need. """
+        repos = []
+        for manifest in manifests:
+            if gc_interval:
+                manifest.set_gc_interval(gc_interval)
+            repos.extend(manifest.repos)
+        gogitit.jobs.run(repos, lambda repo, echo: fetch_repo(repo, echo, timings), self.jobs,
+                         self.jobs_per_host, self.echo)
+
+    def _assemble(self, manifest, manifest_sha, timings, force, delta, link_mode, copy_jobs, echo, store=None,
+                  shared=()):
+        """
+        Write the output dir of a manifest whose repos are fetched, returning a SyncResult.
+        shared holds the sources, see _source, of copies which other output dirs also
+        write, and store the BlobStore they are shared through.
+        """
+        manifest.exporter = gogitit.export.Exporter(
+            link_mode, store or gogitit.export.BlobStore(os.path.join(self.cache_dir, gogitit.export.BLOB_STORE_DIR)),
+            copy_jobs)
+        try:
+            return self._build(manifest, manifest_sha, timings, force, delta, echo, shared)
+        finally:
+            manifest.exporter.close()
+
+    def _build(self, manifest, manifest_sha, timings, force, delta, echo, shared):
+        """ Write the output dir through the exporter of the manifest, see _assemble. """
+        output_dir = manifest.output_dir
+        with timings.phase('plan') as phase:
+            plan = gogitit.plan.Plan(manifest)
+            phase['files'] = len(plan.files)
+        manifest.plan = plan
+        echo_conflicts(plan, echo)
+
+        # The files recorded at the last sync are ours to prune, even when forcing a rebuild:
+        with timings.phase('status_load') as phase:
+            previous_status = gogitit.status.load(output_dir) or gogitit.status.Status()
+            phase['files'] = len(previous_status.records())
+        if not force:
+            manifest.exporter.previous = previous_status
+        for change in gogitit.manifest.manifest_changes(manifest, previous_status) or []:
+            echo(change)
+        rebuild, deltas, skip = split_unchanged(manifest, previous_status, delta, force, echo)
+
+        echo("\nBuilding output directory:\n")
+
+        for copy in rebuild:
+            if copy not in deltas and copy.needs_pre(previous_status):
+                with timings.phase('pre', copy.key):
+                    copy.pre(echo)
+
+        # Stream the status of what we synced, replacing the previous one only on success:
+        status = gogitit.status.StatusWriter(output_dir, manifest_sha)
+        try:
+            for copy in rebuild:
+                manifest.exporter.shared = _source(copy) in shared
+                with timings.phase('delta' if copy in deltas else 'copy', copy.key) as phase:
+                    written, bytes_written = manifest.exporter.written, manifest.exporter.bytes_written
+                    if copy in deltas:
+                        copy.delta(status, previous_status, echo)
+                    else:
+                        copy.run(status, echo)
+                    phase['files'] = manifest.exporter.written - written
+                    phase['bytes'] = manifest.exporter.bytes_written - bytes_written
+
+            for copy in skip:
+                echo("Unchanged: %s" % copy.key)
+                with timings.phase('keep', copy.key):
+                    copy.keep(status, previous_status)
+
+            with timings.phase('prune') as phase:
+                pruned = gogitit.manifest.prune(previous_status, plan.stale(previous_status), echo)
+                phase['files'] = pruned
+        except Exception:
+            status.abort()
+            raise
+        with timings.phase('status_write'):
+            status.close()
+
+        echo("\nSkipped %s unchanged copies, updated %s from git diff, rebuilt %s." % (
+            len(skip), len(deltas), len(rebuild) - len(deltas)))
+        echo("Left %s files in place as already current, pruned %s no longer synced." % (
+            manifest.exporter.unchanged, pruned))
+        return SyncResult(
+            output_dir, [copy.key for copy in rebuild], [copy.key for copy in deltas], [copy.key for copy in skip],
+            manifest.exporter.written, manifest.exporter.unchanged, pruned, list(plan.conflicts), timings)
+
+    def _prune_caches(self, manifests, timings, cache_max_size):
+        if cache_max_size is None:
+            return
+        self.echo("\nLimiting cache size to %s:" % gogitit.cache.format_size(cache_max_size))
+        with timings.phase('cache_prune'):
+            removed, freed = gogitit.cache.prune(
+                gogitit.cache.find(self.cache_dir), cache_max_size,
+                keep=[cache.repo_dir for manifest in manifests for cache in manifest.repo_caches.values()],
+                store_dir=os.path.join(self.cache_dir, gogitit.export.BLOB_STORE_DIR), echo=self.echo)
+        self.echo("  Removed %s repo caches, freeing %s." % (removed, gogitit.cache.format_size(freed)))
+
+    def plan(self, manifest_file, output_dir=None, target=None):
+        """ Work out what a sync would change in the output dir without writing to it, returning a PlanResult. """
+        with self._lock:
+            self._start()
+            manifest, manifest_sha = self.load(manifest_file, output_dir, target)
+            try:
+                gogitit.jobs.run(manifest.repos, clone_repo, self.jobs, self.jobs_per_host, self.echo)
+                sync_plan = gogitit.plan.Plan(manifest)
+                previous_status = gogitit.status.load(manifest.output_dir) or gogitit.status.Status()
+                rebuild, deltas, skip = split_unchanged(manifest, previous_status, True, echo=self.echo)
+                changes, unchanged = sync_plan.changes(previous_status, skip)
+            finally:
+                manifest.release_locks()
+
+        copies = [(copy.key, 'unchanged' if copy in skip else 'delta' if copy in deltas else 'rebuild')
+                  for copy in sync_plan.copies]
+        return PlanResult(manifest.output_dir, copies, changes, list(sync_plan.conflicts), unchanged)
+
+    def check(self, manifest_file, output_dir=None, fetch=False, verify=False, target=None):
+        """
+        Check whether the output dir is in sync with the manifest, resolving the current
+        commit of each repo without fetching unless fetch is set, returning a CheckResult.
+        """
+        with self._lock:
+            self._start(False)
+            manifest, manifest_sha = self.load(manifest_file, output_dir, target)
+            try:
+                return self._check(manifest, manifest_sha, fetch, verify)
+            finally:
+                manifest.release_locks()
+
+    def _check(self, manifest, manifest_sha, fetch, verify):
+        output_dir = manifest.output_dir
+        self.echo("Checking if sync is required for output directory: %s" % output_dir)
+
+        def required(status, reasons):
+            for reason in reasons:
+                self.echo(reason)
+            return CheckResult(output_dir, status, reasons, None)
+
+        status = gogitit.status.load(output_dir)
+        if status is None:
+            return required(gogitit.manifest.CHECK_STATUS_NO_STATUS_FILE, [
+                "No status file exists, sync is required: %s" % os.path.join(output_dir, gogitit.status.STATUS_FILE)])
+        self.echo(status.path)
+
+        changes = gogitit.manifest.manifest_changes(manifest, status)
+        if changes is None:
+            # Status from an older release, compare the whole manifest file:
+            if manifest_sha != status.manifest_sha:
+                return required(gogitit.manifest.CHECK_STATUS_MANIFEST_CHANGED,
+                                ["Manifest has changed, sync is required."])
+        elif changes:
+            return required(gogitit.manifest.CHECK_STATUS_MANIFEST_CHANGED,
+                            changes + ["Manifest has changed, sync is required."])
+
+        if not fetch and status.copies:
+            # Resolve the current commit of each repo, usually with a single request to
+            # each remote, and compare against the commits recorded for each copy:
+            gogitit.jobs.run(manifest.repos, resolve_repo, self.jobs, self.jobs_per_host, self.echo)
+            reasons = [copy.commit_check(status) for repo in manifest.repos for copy in repo.copy]
+        else:
+            self._create_cache_dir()
+
+            # Clone/update all repos:
+            gogitit.jobs.run(manifest.repos, clone_repo, self.jobs, self.jobs_per_host, self.echo)
+
+            # All repos in cache should now have checked out the correct SHA:
+            reasons = [copy.sha_check(status) for repo in manifest.repos for copy in repo.copy]
+        reasons = [reason for reason in reasons if reason]
+        if reasons:
+            return required(gogitit.manifest.CHECK_STATUS_SHA_CHANGED, reasons)
+
+        if not verify:
+            return CheckResult(output_dir, CHECK_STATUS_OK, [], None)
+        verified = self.verify_output(status)
+        if verified:
+            return CheckResult(output_dir, gogitit.manifest.CHECK_STATUS_OUTPUT_CHANGED,
+                               ["Output directory has changed since the last sync, sync is required."], verified)
+        return CheckResult(output_dir, CHECK_STATUS_OK, [], verified)
+
+    def verify_output(self, status):
+        """ Check the files in the output dir are as the last sync wrote them, returning those changed. """
+        self.echo("\nVerifying output directory:")
+        for key in sorted(status.copies):
+            if not status.is_indexed(key):
+                self.echo("  Not verified, files not recorded by the last sync: %s" % key)
+        changes, checked, hashed = status.verify()
+        for change, path in changes:
+            self.echo("  %s: %s" % (change, path))
+        self.echo("  Checked %s files, hashed %s." % (checked, hashed))
+        if changes:
+            self.echo("Output directory has changed since the last sync, sync is required.")
+        return changes
+
+    def close(self):
+        """ Close the git repos of every repo cache opened, ending their git processes. """
+        with self._lock:
+            for cache in self.repo_caches.values():
+                if cache.git_repo is not None:
+                    cache.git_repo.git.clear_cache()
+                    cache.git_repo = None
+                cache.lock.release()
+                cache.fetch_lock.release()
+            self.repo_caches.clear()
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+def plan(manifest_file, output_dir=None, target=None, **kwargs):
+    """ Plan a sync in a session of its own, taking the arguments of Session. """
+    session = Session(**kwargs)
+    try:
+        return session.plan(manifest_file, output_dir, target)
+    finally:
+        session.close()
+
+
+def sync(manifest_file, output_dir=None, force=False, delta=True, link_mode='copy', copy_jobs=4,
+         gc_interval=7 * 24 * 60 * 60, cache_max_size=None, target=None, **kwargs):
+    """ Sync in a session of its own, taking the arguments of Session. """
+    session = Session(**kwargs)
+    try:
+        return session.sync(manifest_file, output_dir, force, delta, link_mode, copy_jobs, gc_interval,
+                            cache_max_size, target)
+    finally:
+        session.close()
+
+
+def sync_all(manifest_files, force=False, delta=True, link_mode='copy', copy_jobs=4, gc_interval=7 * 24 * 60 * 60,
+             cache_max_size=None, sync_jobs=1, targets=None, **kwargs):
+    """ Sync many manifests in a session of their own, taking the arguments of Session. """
+    session = Session(**kwargs)
+    try:
+        return session.sync_all(manifest_files, force, delta, link_mode, copy_jobs, gc_interval, cache_max_size,
+                                sync_jobs, targets)
+    finally:
+        session.close()
+
+
+def check(manifest_file, output_dir=None, fetch=False, verify=False, target=None, **kwargs):
+    """ Check in a session of its own, taking the arguments of Session. """
+    session = Session(**kwargs)
+    try:
+        return session.check(manifest_file, output_dir, fetch, verify, target)
+    finally:
+        session.close()
+
+
+def echo_conflicts(plan, echo):
+    for path, first, second in plan.conflicts:
+        echo("Conflict: %s is written by %s and %s, the last wins." % (path, first, second))
+
+
+def clone_repo(repo, echo):
+    """ Clone/update a single repo and validate its copy sources exist. """
+    echo("Cloning: %s" % repo.url)
+    repo.clone(echo)
+    for copy in repo.copy:
+        copy.validate()
+    echo("")
+
+
+def fetch_repo(repo, echo, timings=None):
+    """ Clone/update a single repo and fetch all files its copies will export. """
+    timings = timings or gogitit.timings.Timings()
+    echo("Cloning: %s" % repo.url)
+    with timings.phase('clone', "%s (%s)" % (repo.url, repo.version)):
+        repo.clone(echo)
+    for copy in repo.copy:
+        with timings.phase('validate', copy.key):
+            copy.validate()
+    with timings.phase('prefetch', "%s (%s)" % (repo.url, repo.version)):
+        repo.prefetch(echo)
+    echo("")
+
+
+def resolve_repo(repo, echo):
+    """ Resolve the commit for a single repo, fetching only if necessary. """
+    echo("Resolving: %s (%s)" % (repo.url, repo.version))
+    repo.resolve(echo)
+    echo("")
+
+
+def _source(copy):
+    """ Return what identifies the files a copy writes, whichever output dir it writes them to. """
+    return copy.repo.url, copy.repo.sha, copy.src
+
+
+def _overlaps(path1, path2):
+    """ Return True if either path is, or is within, the other. """
+    path1 = os.path.normpath(path1) + os.sep
+    path2 = os.path.normpath(path2) + os.sep
+    return path1.startswith(path2) or path2.startswith(path1)
+
+
+def split_unchanged(manifest, previous_status, delta=False, force=False, echo=None):
+    """
+    Work out what each copy needs to bring its output from the previous sync up to date.
+
+    Returns a list of copies to rebuild in manifest order, the subset of those which
+    can be updated in place from a git diff, and the copies whose output is current.
+    A copy is fully rebuilt regardless if its output lies within a directory another
+    copy will delete before rebuilding, or contains such a directory. With force every
+    copy is fully rebuilt.
+    """
+    echo = echo or (lambda message='': None)
+    rebuild = []
+    deltas = []
+    skip = []
+    for repo in manifest.repos:
+        for copy in repo.copy:
+            if not force and copy.is_current(previous_status):
+                skip.append(copy)
+            else:
+                rebuild.append(copy)
+                if delta and not force and copy.can_delta(previous_status, echo):
+                    deltas.append(copy)
+
+    kept = skip + deltas
+    cleanup_dirs = [d for copy in rebuild if copy not in deltas and copy.needs_pre(previous_status)
+                    for d in copy.cleanup_dirs()]
+    while cleanup_dirs:
+        clobbered = [copy for copy in kept if any(_overlaps(path, d) for d in cleanup_dirs
+                                                  for path in previous_status.copies[copy.key]['paths'])]
+        cleanup_dirs = [d for copy in clobbered if copy.needs_pre(previous_status) for d in copy.cleanup_dirs()]
+        for copy in clobbered:
+            kept.remove(copy)
+            if copy in deltas:
+                deltas.remove(copy)
+            else:
+                skip.remove(copy)
+                rebuild.append(copy)
+
+    # Preserve manifest order for rebuilt copies, later entries may overwrite earlier ones:
+    order = [copy for repo in manifest.repos for copy in repo.copy]
+    rebuild.sort(key=order.index)
+    return rebuild, deltas, skip
+
+
+def setup_output_dir(manifest, output_dir):
+    """ Normalize the manifest output dir with the optional override. """
+    if not manifest.output_dir and not output_dir:
+        raise ManifestError("No output dir defined in manifest or CLI argument.")
+
+    if output_dir:
+        manifest.output_dir = output_dir
+    else:
+        # Make the manifest output_dir relative to manifest location if not absolute:
+        if manifest.output_dir[0] != '/':
+            manifest.output_dir = os.path.abspath(os.path.join(
+                os.path.dirname(manifest.path), manifest.output_dir))
+
+    return manifest.output_dir
@@ -0,0 +1,214 @@
+"""Lists, garbage collects and evicts the repo caches in a cache dir."""
+
+import errno
+import os
+import re
+import shutil
+import time
+
+import click
+import git
+
+from gogitit.errors import LockTimeout
+from gogitit.export import BLOB_STORE_DIR
+from gogitit.lock import CacheLock
+from gogitit.manifest import RepoCache, repo_url_to_dir
+
+SIZE_RE = re.compile(r'^([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?)i?B?$', re.IGNORECASE)
+SIZE_UNITS = ['', 'K', 'M', 'G', 'T']
+
+BUNDLE_SUFFIX = '.bundle'
+
+
+def find(cache_dir):
+    """ Return a RepoCache for every repo in cache_dir, sorted by path. """
+    caches = []
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        if dirpath == cache_dir and BLOB_STORE_DIR in dirnames:
+            dirnames.remove(BLOB_STORE_DIR)
+        if _is_repo(dirpath):
+            # Repos are not nested, and their contents are not of interest:
+            dirnames[:] = []
+            caches.append(_open(dirpath))
+    return sorted(caches, key=lambda cache: cache.repo_dir)
+
+
+def _is_repo(path):
+    """ Return True if path is a bare repo, or a clone made by an earlier release. """
+    return (os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects'))) or \
+        os.path.isdir(os.path.join(path, '.git'))
+
+
+def _open(repo_dir):
+    url = git.Repo(repo_dir).config_reader().get_value('remote "origin"', 'url', None)
+    return RepoCache(os.path.dirname(repo_dir), url, repo_dir)
+
+
+def bundle_path(bundle_dir, cache):
+    """ Return the path of the bundle for a cache within bundle_dir, laid out as the cache dir is. """
+    return os.path.join(bundle_dir, repo_url_to_dir(cache.url) + BUNDLE_SUFFIX)
+
+
+def reference_order(caches):
+    """ Return caches ordered so every reference comes before the caches borrowing from it. """
+    ordered = []
+
+    def add(cache):
+        if cache not in ordered:
+            if cache.reference is not None:
+                add(cache.reference)
+            ordered.append(cache)
+    for cache in sorted(caches, key=lambda cache: cache.repo_dir):
+        add(cache)
+    return ordered
+
+
+def size(path):
+    """ Return the total size in bytes of every file beneath path. """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+
+def parse_size(value):
+    """ Parse a size in bytes with an optional K, M, G or T suffix, i.e. 500M or 10G. """
+    match = SIZE_RE.match(value.strip())
+    if not match:
+        raise click.BadParameter("Invalid size, expected a number of bytes with an optional "
+                                 "K, M, G or T suffix: %s" % value)
+    return int(float(match.group(1)) * 1024 ** SIZE_UNITS.index(match.group(2).upper()))
+
+
+def format_size(value):
+    """ Format a size in bytes for display, i.e. 1.5M. """
+    unit = 0
+    while value >= 1024 and unit < len(SIZE_UNITS) - 1:
+        value /= 1024.0
+        unit += 1
+    if unit == 0:
+        return "%sB" % value
+    return "%.1f%s" % (value, SIZE_UNITS[unit])
+
+
+def gc(caches, interval=0, lock_timeout=None, echo=click.echo):
+    """
+    Run git gc on each cache last collected at least interval seconds ago, waiting for
+    other processes to finish with it first. Returns the number of caches collected.
+    """
+    collected = 0
+    now = time.time()
+    for cache in caches:
+        last_gc = cache.last_gc()
+        if last_gc is not None and now - last_gc < interval:
+            continue
+        cache.lock.timeout = lock_timeout
+        cache.fetch_lock.timeout = lock_timeout
+        try:
+            # Readers first, once none are left no fetch can be running or start:
+            cache.lock.acquire(True, echo)
+            cache.fetch_lock.acquire(True, echo)
+            cache.gc(echo)
+        finally:
+            cache.fetch_lock.release()
+            cache.lock.release()
+        collected += 1
+    return collected
+
+
+def prune(caches, max_size=None, unused_for=None, keep=(), store_dir=None, echo=click.echo):
+    """
+    Remove caches not used for unused_for seconds, then the least recently used until
+    the rest total at most max_size bytes. Caches with a repo_dir in keep are never
+    removed, nor are any another process is using, as they can be cloned again on
+    next use. Nor are references other caches borrow objects from, until those are
+    removed. Returns the number of caches removed and the bytes freed.
+
+    Files in the blob store at store_dir count towards max_size too, unless an output
+    file is hard linked to them, and are removed the same way before any cache is, as
+    they are quicker to write again than a cache is to clone.
+    """
+    now = time.time()
+    store = sorted(store_files(store_dir), key=lambda item: item[2]) if store_dir else []
+    caches = sorted(caches, key=lambda cache: cache.last_used())
+    sizes = dict((cache.repo_dir, size(cache.repo_dir)) for cache in caches)
+    total = sum(sizes.values()) + sum(item[1] for item in store)
+    removed = 0
+    freed = 0
+
+    store_removed = 0
+    store_freed = 0
+    for path, file_size, last_used in store:
+        unused = unused_for is not None and now - last_used >= unused_for
+        if not unused and (max_size is None or total <= max_size):
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            # Removed by another process meanwhile:
+            if e.errno != errno.ENOENT:
+                raise
+        total -= file_size
+        store_freed += file_size
+        store_removed += 1
+    if store_removed:
+        echo("  Removed %s files from the blob store, freeing %s." % (store_removed, format_size(store_freed)))
+    freed += store_freed
+
+    for cache in caches:
+        unused = unused_for is not None and now - cache.last_used() >= unused_for
+        if not unused and (max_size is None or total <= max_size):
+            continue
+        if cache.repo_dir in keep:
+            continue
+        if any(cache.objects_dir() in other.alternates() for other in caches
+               if other is not cache and os.path.exists(other.repo_dir)):
+            echo("  Shares objects with other caches, not removed: %s" % cache.repo_dir)
+            continue
+        # The lock files are left in place, another process may be waiting on them:
+        lock = CacheLock(cache.lock.path, 0)
+        fetch_lock = CacheLock(cache.fetch_lock.path, 0)
+        try:
+            lock.acquire(True, echo)
+            fetch_lock.acquire(True, echo)
+        except LockTimeout:
+            lock.release()
+            echo("  In use, not removed: %s" % cache.repo_dir)
+            continue
+        try:
+            echo("  Removing %s cache last used %s: %s" % (
+                format_size(sizes[cache.repo_dir]), format_time(cache.last_used()), cache.repo_dir))
+            shutil.rmtree(cache.repo_dir)
+        finally:
+            fetch_lock.release()
+            lock.release()
+        total -= sizes[cache.repo_dir]
+        freed += sizes[cache.repo_dir]
+        removed += 1
+    return removed, freed
+
+
+def store_files(store_dir):
+    """
+    Return a (path, size, last used) tuple for each file in the blob store which no
+    output file is hard linked to, and so can be removed to free space. A store file
+    is used when read, where the filesystem records access times, or written.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(store_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if st.st_nlink == 1 and not name.startswith('.tmp-'):
+                files.append((path, st.st_size, max(st.st_atime, st.st_mtime)))
+    return files
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return "never"
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
@@ -1,147 +1,439 @@
 import click
+import gogitit.api
+import gogitit.cache
+import gogitit.errors
+import gogitit.export
 import gogitit.manifest
-import hashlib
+import gogitit.status
+import gogitit.timings
+import functools
+import glob
+import json
 import os
 import sys
-import yaml
 
 # Will be written to the top level of the output directory and tracks
 # everything we wrote on last successful sync.
-CACHE_FILE = ".gogitit-cache.yml"
+STATUS_FILE = gogitit.status.STATUS_FILE
+
+
+# Options of every command fetching repos into the cache dir:
+_FETCH_OPTIONS = [
+    click.option(
+        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where gogitit will store cached copies of repositories."),
+    click.option(
+        '--jobs', '-j', default=1, type=click.IntRange(1),
+        help="Number of repositories to clone and fetch concurrently."),
+    click.option(
+        '--jobs-per-host', default=4, type=click.IntRange(1),
+        help="Maximum concurrent clones and fetches against a single git server."),
+    click.option(
+        '--depth', default=None, type=click.IntRange(1),
+        help="Default history depth for repos whose manifest entry does not set one."),
+    click.option(
+        '--filter', 'filter_spec', default=None,
+        help="Default partial clone filter, i.e. blob:none, for repos whose manifest entry does not set one."),
+    click.option(
+        '--max-age', default=None, type=click.IntRange(0),
+        help="Seconds for which a branch fetched or listed from its remote is considered current, "
+             "rather than asking the remote again."),
+    click.option(
+        '--refresh', is_flag=True, default=False,
+        help="Always ask remotes for the latest commit of each branch, ignoring --max-age."),
+    click.option(
+        '--lock-timeout', default=300, type=click.IntRange(0),
+        help="Seconds to wait for other gogitit processes sharing the cache dir to finish with a repo."),
+]
+
+# Options of the commands writing output directories:
+_SYNC_OPTIONS = [
+    click.option(
+        '--force', is_flag=True, default=False,
+        help="Rebuild every copy, even those unchanged since the last sync."),
+    click.option(
+        '--delta/--no-delta', default=True,
+        help="Update copies whose commit changed by applying only the files changed in git."),
+    click.option(
+        '--link-mode', default='copy', type=click.Choice(gogitit.export.LINK_MODES),
+        help="How output files are created from the cache: copied, hard linked (read only) "
+             "or reflinked (copy-on-write) to a shared store of files in the cache dir, "
+             "or auto to reflink where possible and copy otherwise."),
+    click.option(
+        '--copy-jobs', default=4, type=click.IntRange(1),
+        help="Number of files written to each output directory concurrently."),
+    click.option(
+        '--gc-interval', default=7 * 24 * 60 * 60, type=click.IntRange(0),
+        help="Seconds after which git gc is run on a repo cache once fetched, 0 to leave it to "
+             "gogitit cache gc."),
+    click.option(
+        '--cache-max-size', default=None, type=gogitit.cache.parse_size,
+        help="Once synced, remove the least recently used repo caches not in any manifest until "
+             "those in the cache dir total at most this size, i.e. 10G."),
+]
+
+
+def _common_options(sync=False):
+    """
+    Add the options shared by every command fetching repos to a command, and with sync
+    those shared by the commands writing output directories.
+    """
+    options = _FETCH_OPTIONS + (_SYNC_OPTIONS if sync else [])
+
+    def decorator(func):
+        for option in reversed(options):
+            func = option(func)
+        return func
+    return decorator
 
 
 @click.command()
 @click.option(
         '--manifest-file', '-m', default='gogitit.yml', type=click.File('r'),
         help="Location of manifest that defines what to fetch and sync.")
-@click.option(
-        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
-        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
-        help="Directory where gogitit will store cached copies of repositories.")
 @click.option(
         '--output-dir', '-o', default=None,
         type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
         help="Directory where all output will be assembled into final structure.")
-def sync(manifest_file, cache_dir, output_dir):
+@_common_options(sync=True)
+@click.option(
+        '--target', '-t', multiple=True,
+        help="Target to sync, of a manifest declaring several. May be repeated, all are synced if not given.")
+@click.option(
+        '--sync-jobs', default=1, type=click.IntRange(1),
+        help="Number of targets assembled concurrently, once all repos are fetched.")
+@click.option(
+        '--timings', is_flag=True, default=False,
+        help="Print the time spent in each phase of the sync, with files and bytes written.")
+@click.option(
+        '--timings-json', default=None, type=click.File('w'),
+        help="Write the time of each phase of the sync, per repo and copy entry, to a file as JSON.")
+@click.option(
+        '--profile', default=None, type=click.Path(dir_okay=False, writable=True),
+        help="Profile the sync, writing statistics of all threads to a file for python -m pstats.")
+def sync(manifest_file, cache_dir, output_dir, jobs, jobs_per_host, depth, filter_spec, max_age, refresh,
+         lock_timeout, force, delta, link_mode, copy_jobs, gc_interval, cache_max_size, target, sync_jobs, timings,
+         timings_json, profile):
     """Fetch all remote sources and assemble into the destination directory."""
-    # Make sure the working directory exists:
-    if not os.path.exists(cache_dir):
-        click.echo("Creating gogitit cache directory: %s" % cache_dir)
-        os.makedirs(cache_dir)
+    if profile:
+        profiler = gogitit.timings.Profiler()
+        profiler.start()
+        click.get_current_context().call_on_close(functools.partial(profiler.stop, profile))
 
-    manifest = gogitit.manifest.load(manifest_file, cache_dir)
-    output_dir = setup_output_dir(manifest, output_dir)
-    click.echo("\nSyncing to: %s" % output_dir)
+    session = gogitit.api.Session(cache_dir, click.echo, jobs, jobs_per_host, depth, filter_spec,
+                                  None if refresh else max_age, lock_timeout)
+    click.get_current_context().call_on_close(session.close)
+    if len(target) == 1 or len(gogitit.manifest.target_names(manifest_file)) <= 1:
+        results = [session.sync(manifest_file, output_dir, force, delta, link_mode, copy_jobs, gc_interval,
+                                cache_max_size, target[0] if target else None)]
+    else:
+        if output_dir:
+            raise gogitit.errors.ManifestError("An output dir can only be given for a single target.")
+        # Every target selected is assembled from one fetch of the repos:
+        results = session.sync_all([manifest_file], force, delta, link_mode, copy_jobs, gc_interval, cache_max_size,
+                                   sync_jobs, list(target) or None)
 
-    click.echo("\nCloning repositories:\n")
+    if timings:
+        click.echo("\nTimings:\n")
+        for line in results[0].timings.table():
+            click.echo(line and "  %s" % line)
+    if timings_json:
+        json.dump(results[0].timings.to_json(), timings_json, indent=2, sort_keys=True)
+        timings_json.write('\n')
 
-    # Clone/update all repos:
-    for repo in manifest.repos:
-        click.echo("Cloning: %s" % repo.url)
-        repo.clone()
-        for copy in repo.copy:
-            copy.validate()
+    for result in results:
+        click.echo("\nOutput ready in: %s" % result.output_dir)
+    click.echo("")
 
-    status = {}
-    manifest_file.seek(0)
-    status['manifest_sha'] = hashlib.sha1(manifest_file.read()).hexdigest()
 
-    click.echo("\nBuilding output directory:\n")
+@click.command('sync-all')
+@click.argument('manifests', nargs=-1, required=True)
+@_common_options(sync=True)
+@click.option(
+        '--sync-jobs', default=1, type=click.IntRange(1),
+        help="Number of output directories assembled concurrently, once all repos are fetched.")
+@click.option(
+        '--timings', is_flag=True, default=False,
+        help="Print the time spent in each phase of the syncs, with files and bytes written.")
+def sync_all(manifests, cache_dir, jobs, jobs_per_host, sync_jobs, depth, filter_spec, max_age, refresh,
+             lock_timeout, force, delta, link_mode, copy_jobs, gc_interval, cache_max_size, timings):
+    """
+    Sync many manifests, each to its own output directory. MANIFESTS are paths or
+    glob patterns, each repo they use is fetched once for all of them.
+    """
+    paths = []
+    for pattern in manifests:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise click.BadParameter("No manifests match: %s" % pattern, param_hint='MANIFESTS')
+        paths.extend(path for path in matches if path not in paths)
 
-    for repo in manifest.repos:
-        for copy in repo.copy:
-            copy.pre()
+    session = gogitit.api.Session(cache_dir, click.echo, jobs, jobs_per_host, depth, filter_spec,
+                                  None if refresh else max_age, lock_timeout)
+    click.get_current_context().call_on_close(session.close)
+    results = session.sync_all(paths, force, delta, link_mode, copy_jobs, gc_interval, cache_max_size, sync_jobs)
 
-    for repo in manifest.repos:
-        for copy in repo.copy:
-            copy.run(status)
+    if timings:
+        click.echo("\nTimings:\n")
+        for line in results[0].timings.table():
+            click.echo(line and "  %s" % line)
 
-    # Write the cache of what we synced:
-    f = open(os.path.join(output_dir, CACHE_FILE), 'w')
-    f.write(yaml.dump(status))
-    f.close()
+    click.echo("\nSynced %s manifests.\n" % len(results))
 
-    click.echo("\nOutput ready in: %s\n" % output_dir)
 
+@click.command()
+@click.option(
+        '--manifest-file', '-m', default='gogitit.yml', type=click.File('r'),
+        help="Location of manifest that defines what to fetch and sync.")
+@click.option(
+        '--output-dir', '-o', default=None,
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where all output will be assembled into final structure.")
+@_common_options()
+@click.option(
+        '--target', '-t', default=None,
+        help="Target to plan, of a manifest declaring several.")
+@click.option(
+        '--json', 'as_json', is_flag=True, default=False,
+        help="Print the plan as JSON, progress is written to stderr.")
+def plan(manifest_file, cache_dir, output_dir, jobs, jobs_per_host, depth, filter_spec, max_age, refresh,
+         lock_timeout, target, as_json):
+    """Show what a sync would change in the destination directory, without writing to it."""
+    # Progress goes to stderr with --json, keeping stdout parseable:
+    session = gogitit.api.Session(cache_dir, functools.partial(click.echo, err=as_json), jobs, jobs_per_host,
+                                  depth, filter_spec, None if refresh else max_age, lock_timeout)
+    click.get_current_context().call_on_close(session.close)
+    result = session.plan(manifest_file, output_dir, target)
 
-def setup_output_dir(manifest, cli_output_dir):
-    """ Normalize the manifest output dir with the optional CLI override. """
-    if not manifest.output_dir and not cli_output_dir:
-        click.echo("No output dir defined in manifest or CLI argument.")
-        sys.exit(1)
+    counts = dict((change, 0) for change in ('Add', 'Update', 'Remove', 'Keep'))
+    for change, path, key in result.changes:
+        counts[change] += 1
 
-    if cli_output_dir:
-        manifest.output_dir = cli_output_dir
-    else:
-        # Make the manifest output_dir relative to manifest location if not absolute:
-        if manifest.output_dir[0] != '/':
-            manifest.output_dir = os.path.abspath(os.path.join(
-                os.path.dirname(manifest.path), manifest.output_dir))
+    if as_json:
+        click.echo(json.dumps({
+            'output_dir': result.output_dir,
+            'copies': [{'copy': key, 'action': action} for key, action in result.copies],
+            'changes': [{'change': change.lower(), 'path': path, 'copy': key}
+                        for change, path, key in result.changes],
+            'conflicts': [{'path': path, 'copies': [first, second]}
+                          for path, first, second in result.conflicts],
+            'summary': dict([(change.lower(), count) for change, count in counts.items()] +
+                            [('unchanged', result.unchanged)]),
+        }, indent=2, sort_keys=True))
+        return
 
-    return manifest.output_dir
+    click.echo("\nPlan for output directory: %s\n" % result.output_dir)
+    for key, action in result.copies:
+        click.echo("%s: %s" % (action.capitalize(), key))
+    for path, first, second in result.conflicts:
+        click.echo("Conflict: %s is written by %s and %s, the last wins." % (path, first, second))
+    if result.changes:
+        click.echo("")
+    for change, path, key in result.changes:
+        click.echo("  %s: %s" % ("Keep modified" if change == 'Keep' else change, path))
+    click.echo("\nWould add %s files, update %s and remove %s, leaving %s unchanged." % (
+        counts['Add'], counts['Update'], counts['Remove'], result.unchanged))
 
 
 @click.command()
 @click.option(
         '--manifest-file', '-m', default='gogitit.yml', type=click.File('r'),
         help="Location of manifest that defines what to fetch and sync.")
-@click.option(
-        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
-        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
-        help="Directory where gogitit will store cached copies of repositories.")
 @click.option(
         '--output-dir', '-o', default=None,
         type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
         help="Directory where all output will be assembled into final structure.")
-def check(manifest_file, cache_dir, output_dir):
+@_common_options()
+@click.option(
+        '--fetch', is_flag=True, default=False,
+        help="Fetch every repo and check the files each copy matches, rather than only "
+             "resolving versions with git ls-remote.")
+@click.option(
+        '--target', '-t', default=None,
+        help="Target to check, of a manifest declaring several.")
+@click.option(
+        '--verify', is_flag=True, default=False,
+        help="Also check no file written by the last sync was modified or deleted, and no other "
+             "files were added to the directories it wrote.")
+def check(manifest_file, cache_dir, output_dir, jobs, jobs_per_host, depth, filter_spec, max_age, refresh,
+          lock_timeout, target, fetch, verify):
     """
     Scan the destination directory and it's cache and check if contents
-    match current manifest.
+    match current manifest. Every target of a manifest declaring several is checked
+    unless one is given, exiting with the status of the first requiring a sync.
     """
-    manifest = gogitit.manifest.load(manifest_file, cache_dir)
-    output_dir = setup_output_dir(manifest, output_dir)
-    click.echo("Checking if sync is required for output directory: %s" % output_dir)
+    session = gogitit.api.Session(cache_dir, click.echo, jobs, jobs_per_host, depth, filter_spec,
+                                  None if refresh else max_age, lock_timeout)
+    click.get_current_context().call_on_close(session.close)
+    targets = [target] if target else gogitit.manifest.target_names(manifest_file)
+    if len(targets) <= 1:
+        targets = [target]
+    if output_dir and len(targets) > 1:
+        raise gogitit.errors.ManifestError("An output dir can only be given for a single target.")
+    status = gogitit.api.CHECK_STATUS_OK
+    for name in targets:
+        if len(targets) > 1:
+            click.echo("\nTarget: %s" % name)
+        manifest_file.seek(0)
+        result = session.check(manifest_file, output_dir, fetch, verify, name)
+        if result.sync_required and status == gogitit.api.CHECK_STATUS_OK:
+            status = result.status
+    if status != gogitit.api.CHECK_STATUS_OK:
+        sys.exit(status)
 
-    status_filepath = os.path.join(output_dir, CACHE_FILE)
-    click.echo(status_filepath)
-    if not os.path.exists(status_filepath):
-        click.echo("No status file exists, sync is required: %s" % status_filepath)
-        sys.exit(gogitit.manifest.CHECK_STATUS_NO_STATUS_FILE)
-    status = yaml.load(open(status_filepath))
 
-    manifest_file.seek(0)
-    current_manifest_sha = hashlib.sha1(manifest_file.read()).hexdigest()
-    if current_manifest_sha != status['manifest_sha']:
-        click.echo("Manifest has changed, sync is required.")
-        sys.exit(gogitit.manifest.CHECK_STATUS_MANIFEST_CHANGED)
+@click.group()
+def cache():
+    """Inspect and clean up the repo caches in the cache directory."""
+    pass
 
-    # Make sure the working directory exists:
-    if not os.path.exists(cache_dir):
-        click.echo("Creating gogitit cache directory: %s" % cache_dir)
-        os.makedirs(cache_dir)
 
-    # Clone/update all repos:
-    for repo in manifest.repos:
-        repo.clone()
-        for copy in repo.copy:
-            copy.validate()
+@cache.command('list')
+@click.option(
+        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where gogitit will store cached copies of repositories.")
+def cache_list(cache_dir):
+    """List the repo caches with their size and when they were last used."""
+    caches = gogitit.cache.find(cache_dir) if os.path.isdir(cache_dir) else []
+    click.echo("Repo caches in: %s\n" % cache_dir)
+    total = 0
+    for repo_cache in caches:
+        size = gogitit.cache.size(repo_cache.repo_dir)
+        total += size
+        click.echo("%s" % (repo_cache.url or repo_cache.repo_dir))
+        click.echo("  Path: %s" % repo_cache.repo_dir)
+        click.echo("  Size: %s, last used: %s, last gc: %s" % (
+            gogitit.cache.format_size(size), gogitit.cache.format_time(repo_cache.last_used()),
+            gogitit.cache.format_time(repo_cache.last_gc())))
+        for objects_dir in repo_cache.alternates():
+            click.echo("  Borrows objects from: %s" % os.path.dirname(objects_dir))
+    store_size = gogitit.cache.size(os.path.join(cache_dir, gogitit.export.BLOB_STORE_DIR))
+    click.echo("\n%s repo caches totalling %s, and %s of linked files." % (
+        len(caches), gogitit.cache.format_size(total), gogitit.cache.format_size(store_size)))
 
-    # All repos in cache should now have checked out the correct SHA:
-    for repo in manifest.repos:
-        for copy in repo.copy:
-            copy.sha_check(status)
 
+@cache.command('gc')
+@click.option(
+        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where gogitit will store cached copies of repositories.")
+@click.option(
+        '--interval', default=0, type=click.IntRange(0),
+        help="Skip repo caches garbage collected within this many seconds, for running from cron.")
+@click.option(
+        '--lock-timeout', default=300, type=click.IntRange(0),
+        help="Seconds to wait for other gogitit processes sharing the cache dir to finish with a repo.")
+def cache_gc(cache_dir, interval, lock_timeout):
+    """Run git gc on the repo caches, packing objects fetched since the last run."""
+    caches = gogitit.cache.find(cache_dir) if os.path.isdir(cache_dir) else []
+    collected = gogitit.cache.gc(caches, interval, lock_timeout)
+    click.echo("Garbage collected %s of %s repo caches." % (collected, len(caches)))
 
-CACHE_FILE = '.gogitit-cache.yml'
 
+@cache.command('prune')
+@click.option(
+        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where gogitit will store cached copies of repositories.")
+@click.option(
+        '--max-size', default=None, type=gogitit.cache.parse_size,
+        help="Remove the least recently used repo caches and linked files until the rest total at most "
+             "this size, i.e. 10G.")
+@click.option(
+        '--unused-days', default=None, type=click.IntRange(0),
+        help="Remove repo caches no sync, plan or check --fetch has used for this many days, and linked "
+             "files no sync has.")
+def cache_prune(cache_dir, max_size, unused_days):
+    """Remove repo caches, which are cloned again if used afterwards."""
+    if max_size is None and unused_days is None:
+        raise click.UsageError("One of --max-size or --unused-days is required.")
+    caches = gogitit.cache.find(cache_dir) if os.path.isdir(cache_dir) else []
+    removed, freed = gogitit.cache.prune(
+        caches, max_size, unused_days * 24 * 60 * 60 if unused_days is not None else None,
+        store_dir=os.path.join(cache_dir, gogitit.export.BLOB_STORE_DIR))
+    click.echo("Removed %s of %s repo caches, freeing %s." % (
+        removed, len(caches), gogitit.cache.format_size(freed)))
 
-@click.group()
+
+@cache.command('export-bundle')
+@click.option(
+        '--manifest-file', '-m', default='gogitit.yml', type=click.File('r'),
+        help="Location of manifest that defines what to fetch and sync.")
+@click.option(
+        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where gogitit will store cached copies of repositories.")
+@click.option(
+        '--lock-timeout', default=300, type=click.IntRange(0),
+        help="Seconds to wait for other gogitit processes sharing the cache dir to finish with a repo.")
+@click.argument('bundle_dir', type=click.Path(file_okay=False, dir_okay=True))
+def cache_export_bundle(manifest_file, cache_dir, lock_timeout, bundle_dir):
+    """Write a git bundle of each repo cache the manifest uses to BUNDLE_DIR."""
+    # The repo caches of every target, shared between them:
+    repo_caches = {}
+    for manifest in gogitit.manifest.load_targets(manifest_file, cache_dir, repo_caches):
+        manifest.set_lock_timeout(lock_timeout)
+        click.get_current_context().call_on_close(manifest.release_locks)
+    written = 0
+    for repo_cache in gogitit.cache.reference_order(repo_caches.values()):
+        click.echo("Bundling: %s" % repo_cache.url)
+        written += repo_cache.export_bundle(gogitit.cache.bundle_path(bundle_dir, repo_cache))
+    click.echo("\nWrote %s of %s bundles to: %s" % (written, len(repo_caches), bundle_dir))
+
+
+@cache.command('import-bundle')
+@click.option(
+        '--manifest-file', '-m', default='gogitit.yml', type=click.File('r'),
+        help="Location of manifest that defines what to fetch and sync.")
+@click.option(
+        '--cache-dir', default=os.path.expanduser('~/.gogitit/cache'),
+        type=click.Path(file_okay=False, dir_okay=True, writable=True, readable=True),
+        help="Directory where gogitit will store cached copies of repositories.")
+@click.option(
+        '--lock-timeout', default=300, type=click.IntRange(0),
+        help="Seconds to wait for other gogitit processes sharing the cache dir to finish with a repo.")
+@click.argument('bundle_dir', type=click.Path(exists=True, file_okay=False, dir_okay=True))
+def cache_import_bundle(manifest_file, cache_dir, lock_timeout, bundle_dir):
+    """Seed the repo caches the manifest uses from the git bundles in BUNDLE_DIR."""
+    # The repo caches of every target, shared between them:
+    repo_caches = {}
+    for manifest in gogitit.manifest.load_targets(manifest_file, cache_dir, repo_caches):
+        manifest.set_lock_timeout(lock_timeout)
+        click.get_current_context().call_on_close(manifest.release_locks)
+    imported = 0
+    for repo_cache in gogitit.cache.reference_order(repo_caches.values()):
+        path = gogitit.cache.bundle_path(bundle_dir, repo_cache)
+        click.echo("Importing: %s" % repo_cache.url)
+        if not os.path.exists(path):
+            click.echo("  No bundle, will be cloned on sync: %s" % path)
+            continue
+        imported += repo_cache.import_bundle(path)
+    click.echo("\nImported %s of %s repo caches, sync to fetch any changes since." % (
+        imported, len(repo_caches)))
+
+
+class _Group(click.Group):
+    """ Shows the errors gogitit raises as click shows its own, exiting with status 1. """
+
+    def invoke(self, ctx):
+        try:
+            return click.Group.invoke(self, ctx)
+        except gogitit.errors.GogititError as e:
+            raise click.ClickException(e.message)
+
+
+@click.group(cls=_Group)
 def main():
     pass
 
 
 main.add_command(sync)
+main.add_command(sync_all)
 main.add_command(check)
+main.add_command(plan)
+main.add_command(cache)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+"""
+Errors raised by gogitit, which callers of the library API can catch by type. The CLI
+shows the message of each and exits with status 1.
+"""
+
+
+class GogititError(Exception):
+    """ Base of every error gogitit raises itself. """
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+class ManifestError(GogititError):
+    """ The manifest is invalid, or a copy source does not exist in its repo. """
+    pass
+
+
+class RepoError(GogititError):
+    """
+    One or more repos could not be cloned, fetched or resolved. failures maps each
+    repo which failed to the exception it raised.
+    """
+
+    def __init__(self, message, failures=None):
+        GogititError.__init__(self, message)
+        self.failures = failures or {}
+
+
+class ConflictError(GogititError):
+    """ Entries of the manifest write the same path as both a file and a directory. """
+    pass
+
+
+class StatusError(GogititError):
+    """ The status file of the output dir can't be read. """
+    pass
+
+
+class LockTimeout(GogititError):
+    """ Another process held the lock on a repo cache for longer than the lock timeout. """
+    pass
+
+
+class BatchError(GogititError):
+    """
+    One or more manifests of a batch failed to sync. failures maps the key of each
+    manifest which failed, its path and target if any, to the exception it raised,
+    results the key of each which synced to its SyncResult.
+    """
+
+    def __init__(self, message, failures=None, results=None):
+        GogititError.__init__(self, message)
+        self.failures = failures or {}
+        self.results = results or {}
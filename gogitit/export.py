@@ -0,0 +1,473 @@
+"""Exports files straight from the git object store into the output directory."""
+
+import ctypes
+import errno
+import fnmatch
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import git
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Git tree entry modes:
+MODE_SYMLINK = 0o120000
+MODE_EXECUTABLE = 0o100755
+
+LINK_MODES = ['copy', 'hardlink', 'reflink', 'auto']
+
+# Directory within the cache dir for the blob store used by link modes:
+BLOB_STORE_DIR = '.blobs'
+
+# Linux ioctl to clone a file's data copy-on-write:
+FICLONE = 0x40049409
+
+# Errors indicating a link type is not possible between the blob store and output dir:
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.ENOSYS)
+
+
+class CommitTree(object):
+    """
+    The files of one commit, resolved from git tree objects rather than a checkout.
+    Paths are relative to the top level of the repository, which is itself '.'.
+    """
+
+    def __init__(self, git_repo, sha):
+        self.git_repo = git_repo
+        self.sha = sha
+        self.root = git_repo.commit(sha).tree
+
+    def __str__(self):
+        return "CommitTree<sha=%s>" % self.sha
+
+    def get(self, path):
+        """ Return the tree, blob or submodule at path, or None if it does not exist. """
+        path = os.path.normpath(path)
+        if path == '.':
+            return self.root
+        try:
+            return self.root[path]
+        except KeyError:
+            return None
+
+    def is_dir(self, path):
+        item = self.get(path)
+        return item is not None and item.type == 'tree'
+
+    def glob(self, pattern):
+        """
+        Return the paths matching a shell style pattern, following the rules of glob.glob
+        for a checkout of this commit: wildcards do not match across directories or
+        hidden names, and a trailing slash only matches directories.
+        """
+        parts = [p for p in os.path.normpath(pattern).split('/') if p and p != '.']
+        matches = ['.']
+        for part in parts:
+            found = []
+            for match in matches:
+                tree = self.get(match)
+                if tree is None or tree.type != 'tree':
+                    continue
+                if glob.has_magic(part):
+                    names = [item.name for item in tree
+                             if fnmatch.fnmatchcase(item.name, part) and
+                             (part.startswith('.') or not item.name.startswith('.'))]
+                else:
+                    names = [part] if self.get(os.path.join(match, part)) is not None else []
+                found.extend(os.path.normpath(os.path.join(match, name)) for name in sorted(names))
+            matches = found
+
+        if pattern.endswith('/'):
+            matches = [match for match in matches if self.is_dir(match)]
+        return matches
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+class BlobStore(object):
+    """
+    Blobs exported to plain files in the cache dir, one per content SHA and file mode, so
+    output directories can be assembled by linking to them rather than copying.
+
+    Files are read only, so an output file hard linked to the store can't be edited in
+    place and corrupt every other output sharing it. Sync always replaces output files
+    rather than writing to them. As root can write to them regardless, a store file is
+    checked against its blob before first being reused, and written again if changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Store files checked against their blob by this process:
+        self._verified = set()
+
+    def __str__(self):
+        return "BlobStore<path=%s>" % self.path
+
+    def get(self, blob):
+        """ Return the path of the store file for a blob, writing it if necessary. """
+        executable = blob.mode == MODE_EXECUTABLE
+        path = os.path.join(self.path, blob.hexsha[:2], blob.hexsha[2:] + ('.x' if executable else ''))
+        if os.path.isfile(path) and os.path.getsize(path) == blob.size:
+            if path in self._verified or blob_sha(path) == blob.hexsha:
+                self._verified.add(path)
+                return path
+
+        # Write to a temporary file and rename so concurrent syncs never see a partial file:
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(blob.data_stream, f)
+            os.chmod(tmp_path, 0o555 if executable else 0o444)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self._verified.add(path)
+        return path
+
+    def discard(self):
+        """
+        Remove the store files this store returned which no output file is hard linked
+        to, once output dirs written in copy mode are done sharing them.
+        """
+        for path in self._verified:
+            try:
+                if os.lstat(path).st_nlink == 1:
+                    os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self._verified.clear()
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+class Exporter(object):
+    """
+    Writes files from commit trees to the output dir, using one of LINK_MODES:
+
+      copy: stream each blob from the object store into the output file.
+      hardlink: hard link output files to the blob store, output files are read only.
+      reflink: clone output files from the blob store sharing data copy-on-write,
+          only on filesystems which support it (btrfs, xfs).
+      auto: reflink where possible, otherwise copy from the blob store. Never hard
+          links, as that makes output files share an inode with the store.
+
+    Modes other than copy fall back to copying from the blob store when the output dir
+    is on another filesystem, or does not support the link type.
+
+    If previous is set to the Status of the last sync, files it shows already hold the
+    blob being exported are left in place rather than written again.
+
+    Files are written by a pool of 'workers' threads, each reading blobs through its own
+    git.Repo as a repo's persistent git cat-file process can only serve one at a time.
+    Threads and their repos are kept for every export until close() is called.
+
+    When several output dirs are written from the same commits, set shared to copy
+    files from the blob store in copy mode too, so each blob is read from git once
+    for all of them. Only worth it for files more than one output dir writes.
+    """
+
+    def __init__(self, link_mode='copy', store=None, workers=1, shared=False):
+        self.link_mode = link_mode
+        self.store = store
+        self.workers = workers
+        self.shared = shared
+        self.previous = None
+        # Number of files left in place as they were already current:
+        self.unchanged = 0
+        # Number of files, and bytes of content, written:
+        self.written = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+        # Repos opened by the worker threads, to end their git processes on close:
+        self._repos = []
+        self.can_reflink = link_mode in ('reflink', 'auto')
+        self.can_hardlink = link_mode == 'hardlink'
+
+    def __str__(self):
+        return "Exporter<link_mode=%s>" % self.link_mode
+
+    def export(self, tree, path, dest, record=None):
+        """
+        Write the file or directory at path in the commit tree to dest, calling
+        record(dest, blob) for each file written if given.
+        """
+        return self.export_pairs(tree, [(path, dest)], record)
+
+    def export_pairs(self, tree, pairs, record=None, owned=None):
+        """
+        Write the file or directory at each (path, dest) pair in the commit tree, calling
+        record(dest, blob) for each file written if given, always from the calling thread.
+        If given, files are only written to the destinations owned(dest) is True for.
+        Every directory is created before any file is written. Returns the number of files.
+        """
+        files = {}
+        dirs = set()
+        for path, dest in pairs:
+            item = tree.get(path)
+            if item.type == 'blob':
+                files[dest] = item
+            elif item.type == 'tree':
+                dirs.add(dest)
+                for child in item.traverse():
+                    child_dest = os.path.join(dest, os.path.relpath(child.path, item.path or '.'))
+                    if child.type == 'blob':
+                        files[child_dest] = child
+                    else:
+                        dirs.add(child_dest)
+            else:
+                # Submodules are exported as an empty directory, as they appear in a checkout:
+                dirs.add(dest)
+
+        if owned is not None:
+            files = dict((dest, blob) for dest, blob in files.items() if owned(dest))
+        dirs.update(os.path.dirname(dest) for dest in files)
+        for path in sorted(dirs):
+            _make_dirs(path)
+
+        if self.workers > 1 and len(files) > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            try:
+                for dest, blob in self._pool.imap_unordered(self._write_in_thread, files.items(), 16):
+                    if record:
+                        record(dest, blob)
+            except Exception:
+                # Wait for the files still being written:
+                self.close()
+                raise
+        else:
+            for dest, blob in files.items():
+                self.write_blob(blob, dest)
+                if record:
+                    record(dest, blob)
+        return len(files)
+
+    def close(self):
+        """ End the worker threads, and the git processes of their repos. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for git_repo in self._repos:
+            git_repo.git.clear_cache()
+        self._repos = []
+        self._local = threading.local()
+
+    def _write_in_thread(self, item):
+        dest, blob = item
+        # Read the blob through this thread's own repo:
+        repos = self._local.__dict__.setdefault('repos', {})
+        git_dir = blob.repo.git_dir
+        if git_dir not in repos:
+            repos[git_dir] = git.Repo(git_dir)
+            with self._lock:
+                self._repos.append(repos[git_dir])
+        self.write_blob(git.Blob(repos[git_dir], blob.binsha, blob.mode, blob.path), dest)
+        return dest, blob
+
+    def write_blob(self, blob, dest):
+        """ Write a blob to dest, replacing any existing file. """
+        if self.previous is not None and self.previous.is_current(dest, blob):
+            with self._lock:
+                self.unchanged += 1
+            return
+        with self._lock:
+            self.written += 1
+            self.bytes_written += blob.size
+        if os.path.islink(dest) or os.path.isfile(dest):
+            os.remove(dest)
+        elif os.path.isdir(dest):
+            # A directory synced before, where the manifest or repo now has a file:
+            shutil.rmtree(dest)
+        _make_dirs(os.path.dirname(dest))
+
+        if blob.mode == MODE_SYMLINK:
+            target = blob.data_stream.read()
+            if not isinstance(target, str):
+                target = target.decode('utf-8')
+            os.symlink(target, dest)
+            return
+
+        # Let the umask apply to new files just as it would in a checkout:
+        mode = 0o777 if blob.mode == MODE_EXECUTABLE else 0o666
+        if self.link_mode == 'copy' and not self.shared:
+            _write_file(blob.data_stream, dest, mode)
+            return
+
+        try:
+            self._write_from_store(self.store.get(blob), dest, mode)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Removed from the store by cache prune in another process meanwhile:
+            self._write_from_store(self.store.get(blob), dest, mode)
+
+    def _write_from_store(self, store_path, dest, mode):
+        if self.can_reflink:
+            try:
+                _reflink(store_path, dest, mode)
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in LINK_ERRORS:
+                    raise
+                self.can_reflink = False
+        if self.can_hardlink:
+            try:
+                os.link(store_path, dest)
+                return
+            except OSError as e:
+                if e.errno not in LINK_ERRORS:
+                    raise
+                self.can_hardlink = False
+        _copy_file(store_path, dest, mode)
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+def _write_file(stream, dest, mode):
+    f = os.fdopen(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb')
+    try:
+        shutil.copyfileobj(stream, f)
+    finally:
+        f.close()
+
+
+def _copy_file(src, dest, mode):
+    """ Copy src to dest, within the kernel where the platform allows. """
+    with open(src, 'rb') as f:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            if _kernel_copy(f.fileno(), dest_fd, os.fstat(f.fileno()).st_size):
+                return
+        finally:
+            os.close(dest_fd)
+        _write_file(f, dest, mode)
+
+
+def _libc_sendfile():
+    """
+    Return sendfile for Linux from the C library, as the os module of Python 2 has none,
+    or None if it can't be found.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sendfile64
+    except (AttributeError, OSError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        """ Like os.sendfile, the GIL is released while the kernel copies. """
+        result = func(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count)
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+    return sendfile
+
+
+_sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+
+def _kernel_copy(src_fd, dest_fd, size):
+    """
+    Copy size bytes between file descriptors with copy_file_range, or sendfile, so data
+    never passes through Python. Returns False if neither is available or supported,
+    raises IOError if the source ends short of size.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            if hasattr(os, 'copy_file_range'):
+                count = os.copy_file_range(src_fd, dest_fd, size - offset)
+            elif _sendfile is not None:
+                count = _sendfile(dest_fd, src_fd, offset, size - offset)
+            else:
+                return False
+        except OSError as e:
+            if offset == 0 and e.errno in LINK_ERRORS:
+                return False
+            raise
+        if count == 0:
+            raise IOError(errno.EIO, "Copied %s of %s bytes" % (offset, size))
+        offset += count
+    return True
+
+
+def blob_sha(path):
+    """ Return the git blob SHA of the file or symlink at path, as git hash-object would. """
+    if os.path.islink(path):
+        data = os.readlink(path)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+    sha = hashlib.sha1(b'blob %d\0' % os.path.getsize(path))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _make_dirs(path):
+    """
+    Create a directory and its parents, removing a file in the way, i.e. one synced
+    before where the manifest or repo now has a directory.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTDIR):
+            raise
+        if os.path.isdir(path):
+            return
+        # The output dir exists, so the nearest path that does is within it:
+        existing = path
+        while not os.path.lexists(existing):
+            existing = os.path.dirname(existing)
+        if os.path.isdir(existing):
+            raise
+        os.remove(existing)
+        os.makedirs(path)
+
+
+def _reflink(src, dest, mode):
+    """ Clone src to dest sharing data copy-on-write, raises IOError if not supported. """
+    if fcntl is None:
+        raise IOError(errno.EOPNOTSUPP, "reflink not supported on this platform")
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, src_fd)
+        except Exception:
+            os.close(dest_fd)
+            os.remove(dest)
+            raise
+        os.close(dest_fd)
+    finally:
+        os.close(src_fd)
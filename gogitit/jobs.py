@@ -0,0 +1,115 @@
+"""Runs per-repository work (clone, fetch, checkout) concurrently."""
+
+from multiprocessing.pool import ThreadPool
+import threading
+
+import click
+
+from gogitit.errors import GogititError, RepoError
+from gogitit.manifest import repo_url_to_dir
+
+
+def repo_host(url):
+    """ Return the host portion of a repo URL, used to cap connections per server. """
+    return repo_url_to_dir(url).split('/')[0]
+
+
+class RepoJob(object):
+    """
+    All work for the manifest entries sharing one repo cache. These must run one
+    after another as they operate on the same git clone, but independent jobs may
+    run in parallel.
+
+    Output is buffered so it can be printed as one block once the job completes.
+    """
+
+    def __init__(self, cache, repos):
+        self.cache = cache
+        self.repos = repos
+        self.output = []
+        # Exception raised for each repo, or None if it succeeded:
+        self.errors = {}
+
+    def echo(self, msg):
+        self.output.append(msg)
+
+    def __str__(self):
+        return "RepoJob<cache=%s>" % self.cache
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+def error_message(e):
+    if isinstance(e, GogititError):
+        return e.message
+    return str(e).strip() or e.__class__.__name__
+
+
+def run(repos, func, jobs=1, per_host=None, echo=click.echo):
+    """
+    Call func(repo, echo) for every repo, with at most 'jobs' running at once and at
+    most 'per_host' against any one git server.
+
+    Output of each job is passed to echo as a single block when it finishes. A failure
+    does not stop the remaining jobs, once all have completed a report is echoed for
+    every repo and a RepoError raised if any of them failed.
+    """
+    grouped = []
+    by_cache = {}
+    for repo in repos:
+        # Caches sharing objects are fetched by one job, as a fork fetches its reference:
+        cache = repo.cache
+        while cache.reference is not None:
+            cache = cache.reference
+        if cache not in by_cache:
+            by_cache[cache] = RepoJob(cache, [])
+            grouped.append(by_cache[cache])
+        by_cache[cache].repos.append(repo)
+        by_cache[repo.cache] = by_cache[cache]
+
+    host_locks = {}
+    if per_host:
+        for job in grouped:
+            host = repo_host(job.repos[0].url)
+            if host not in host_locks:
+                host_locks[host] = threading.BoundedSemaphore(per_host)
+
+    def _run(job):
+        lock = host_locks.get(repo_host(job.repos[0].url))
+        if lock:
+            lock.acquire()
+        try:
+            for repo in job.repos:
+                try:
+                    func(repo, job.echo)
+                    job.errors[repo] = None
+                except Exception as e:
+                    job.errors[repo] = e
+                    job.echo("  Error: %s" % error_message(e))
+        finally:
+            if lock:
+                lock.release()
+        return job
+
+    pool = ThreadPool(min(jobs, len(grouped)) or 1)
+    try:
+        for job in pool.imap_unordered(_run, grouped):
+            for line in job.output:
+                echo(line)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [repo for repo in repos if by_cache[repo.cache].errors.get(repo)]
+    if failed:
+        echo("\nRepository summary:\n")
+        for repo in repos:
+            error = by_cache[repo.cache].errors.get(repo)
+            if error:
+                message = error_message(error).splitlines()[0]
+                echo("  FAILED  %s (%s): %s" % (repo.url, repo.version, message))
+            else:
+                echo("  ok      %s (%s)" % (repo.url, repo.version))
+        raise RepoError("%s of %s repositories failed." % (len(failed), len(repos)),
+                        dict((repo, by_cache[repo.cache].errors[repo]) for repo in failed))
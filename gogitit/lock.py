@@ -0,0 +1,108 @@
+"""File locks letting several gogitit processes share one cache directory."""
+
+import errno
+import os
+import time
+
+import click
+
+from gogitit.errors import LockTimeout
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds between attempts to take a lock held by another process:
+POLL_INTERVAL = 0.1
+
+
+class CacheLock(object):
+    """
+    An advisory lock on a file beside a repo cache, held shared by any number of
+    processes at once, or exclusive by one. Released by release(), or when the process
+    exits. Locking is skipped on platforms without fcntl. See RepoCache for the locks
+    each cache has.
+
+    Waits at most timeout seconds for another process to release the lock, or forever
+    if timeout is None.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+        self.exclusive = None
+
+    def __str__(self):
+        return "CacheLock<path=%s>" % self.path
+
+    def acquire(self, exclusive=False, echo=click.echo):
+        """ Take the lock shared or exclusive, an exclusive lock is downgraded if held. """
+        if fcntl is None:
+            return
+        if self.fd is not None and self.exclusive == exclusive:
+            return
+        if self.fd is not None and self.exclusive:
+            # Can't block, no other process holds the lock:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            self.exclusive = False
+            return
+
+        if self.fd is None:
+            parent = os.path.dirname(self.path)
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+
+        # Upgrading a shared lock may drop it while waiting, which is harmless as
+        # nothing is read from the cache in the meantime:
+        start = time.time()
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            waited = time.time() - start
+            if self.timeout is not None and waited >= self.timeout:
+                self.release()
+                raise LockTimeout("Timed out after %ss waiting for lock: %s" % (self.timeout, self.path))
+            if not waiting:
+                waiting = True
+                echo("  Waiting for %s lock: %s" % ("exclusive" if exclusive else "shared", self.path))
+            time.sleep(POLL_INTERVAL)
+        self.exclusive = exclusive
+
+    def try_acquire(self, exclusive=False, echo=click.echo):
+        """
+        Take the lock as acquire() does, but only if that needn't wait, returning whether
+        it was taken. Upgrading a shared lock may drop it when this fails, in which case
+        it is taken shared again.
+        """
+        shared = self.fd is not None and not self.exclusive
+        timeout, self.timeout = self.timeout, 0
+        try:
+            self.acquire(exclusive, echo)
+            return True
+        except LockTimeout:
+            return False
+        finally:
+            self.timeout = timeout
+            if shared and self.fd is None:
+                self.acquire(False, echo)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.exclusive = None
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
@@ -1,29 +1,126 @@
 """Parses the gogitit manifest."""
 
+import hashlib
+import json
 import os
 import glob
+import re
 import shutil
 import string
-import sys
+import tempfile
+import time
 
 import click
 import git
 import yaml
 
+from gogitit.errors import ManifestError
+from gogitit.export import CommitTree, Exporter
+from gogitit.lock import CacheLock
+
 
 # These exit status codes represent the various reasons why check may fail,
 # indicating that a sync is required.
 CHECK_STATUS_NO_STATUS_FILE = 1
 CHECK_STATUS_MANIFEST_CHANGED = 2  # manifest checksum changed
 CHECK_STATUS_SHA_CHANGED = 3  # if branch SHA1 has changed
+CHECK_STATUS_OUTPUT_CHANGED = 4  # files in the output dir modified, missing or unexpected
 # TODO: separate code for files not in status? status that didn't match any files?
 
+# Maximum number of missing objects requested from a partial clone's remote at once:
+PREFETCH_BATCH_SIZE = 1000
+
+FULL_SHA_RE = re.compile('^[0-9a-f]{40}$')
+
+# Written within each repo cache to track when its branches were last fetched, and
+# when the cache was last used and garbage collected:
+CACHE_META_FILE = 'gogitit-meta.yml'
+
+# Settings a target of a manifest can override or add to:
+TARGET_KEYS = ['output_dir', 'versions', 'repos', 'depth', 'filter']
+
+
+def load(f, cache_dir, repo_caches=None, target=None, **defaults):
+    """
+    Load the manifest from file f. Any defaults which are not None apply to settings
+    the manifest does not specify itself. Repo caches already open, from other
+    manifests or an earlier run of the same process, can be given as a map of
+    repo_url_to_dir() to RepoCache, and are shared rather than opened again. Those
+    from an earlier run must have been reset().
+
+    Of a manifest declaring targets, the one named target is loaded, which may be
+    omitted if it declares only one.
+    """
+    manifests = load_targets(f, cache_dir, repo_caches, [target] if target else None, **defaults)
+    if len(manifests) > 1:
+        raise ManifestError("Manifest %s declares targets %s, choose one." % (
+            f.name, ', '.join(manifest.target for manifest in manifests)))
+    return manifests[0]
+
 
-def load(f, cache_dir):
+def load_targets(f, cache_dir, repo_caches=None, targets=None, **defaults):
+    """
+    Load a manifest for each target manifest file f declares, or only those named in
+    targets, sharing their repo caches. A manifest without targets is loaded as is.
+    Otherwise see load().
+    """
     data = yaml.safe_load(f)
     # TODO: validation
-    m = Manifest(f.name, cache_dir, **data)
-    return m
+    for key, value in defaults.items():
+        if value is not None:
+            data.setdefault(key, value)
+    repo_caches = repo_caches if repo_caches is not None else {}
+
+    declared = data.pop('targets', None)
+    if declared is None:
+        if targets:
+            raise ManifestError("Manifest %s declares no targets." % f.name)
+        if any('targets' in r for r in data['repos']):
+            raise ManifestError("Manifest %s declares no targets for its repos to name." % f.name)
+        return [Manifest(f.name, cache_dir, repo_caches, **data)]
+
+    for name in targets or []:
+        if name not in declared:
+            raise ManifestError("Target %s not declared in manifest %s." % (name, f.name))
+    for r in data.get('repos', []):
+        for name in r.get('targets', []):
+            if name not in declared:
+                raise ManifestError("Target %s of repo %s not declared in manifest %s." % (name, r['url'], f.name))
+    return [Manifest(f.name, cache_dir, repo_caches, target=name, **_target_data(data, name, declared[name] or {}))
+            for name in sorted(targets or declared)]
+
+
+def target_names(f):
+    """ Return the names of the targets manifest file f declares, leaving it to be read again. """
+    data = yaml.safe_load(f)
+    f.seek(0)
+    return sorted(data.get('targets') or {})
+
+
+def _target_data(data, name, target):
+    """
+    Return the manifest data for a target: repos not limited to other targets, then
+    those of the target itself, with its versions and other settings overriding.
+    """
+    unknown = set(target) - set(TARGET_KEYS)
+    if unknown:
+        raise ManifestError("Unknown settings for target %s: %s" % (name, ', '.join(sorted(unknown))))
+    versions = target.get('versions', {})
+    repos = []
+    for r in data.get('repos', []) + target.get('repos', []):
+        if name not in r.get('targets', [name]):
+            continue
+        r = dict(r)
+        r.pop('targets', None)
+        if r['url'] in versions:
+            r['version'] = versions[r['url']]
+        repos.append(r)
+
+    target_data = dict(data, repos=repos)
+    for key in ('output_dir', 'depth', 'filter'):
+        if key in target:
+            target_data[key] = target[key]
+    return target_data
 
 
 def repo_url_to_dir(repo_url):
@@ -56,14 +153,577 @@ def repo_url_to_dir(repo_url):
 
 
 class Manifest(object):
-    def __init__(self, path, cache_dir, **kwargs):
+    def __init__(self, path, cache_dir, repo_caches=None, **kwargs):
         self.path = path
         self.cache_dir = cache_dir
-        self.output_dir = kwargs['output_dir']
+        self.output_dir = kwargs.get('output_dir')
+        # Name of the target of the manifest file loaded, if it declares targets:
+        self.target = kwargs.get('target')
+
+        # Defaults for repos which don't set these themselves:
+        self.depth = kwargs.get('depth')
+        self.filter = kwargs.get('filter')
+
+        # Writes files from the repo caches into the output dir:
+        self.exporter = Exporter()
+        # The gogitit.plan.Plan of the sync, deciding which entry writes each path:
+        self.plan = None
+
+        # One cache per unique repository, shared by all entries using it:
+        self.repo_caches = {}
+        # Caches opened by other manifests or earlier runs, shared if this manifest needs them:
+        self.open_caches = repo_caches if repo_caches is not None else {}
+
         self.repos = []
         for r in kwargs['repos']:
             self.repos.append(Repo(self, cache_dir, **r))
 
+    @property
+    def key(self):
+        """ Identifies the manifest file, and the target loaded from it if any. """
+        return "%s[%s]" % (self.path, self.target) if self.target else self.path
+
+    def set_max_age(self, max_age):
+        """ Set the number of seconds branches fetched or listed are trusted for. """
+        for cache in self.repo_caches.values():
+            cache.max_age = max_age
+
+    def set_gc_interval(self, gc_interval):
+        """ Set the number of seconds after which a cache is garbage collected once fetched. """
+        for cache in self.repo_caches.values():
+            cache.gc_interval = gc_interval
+
+    def set_lock_timeout(self, timeout):
+        """ Set the number of seconds to wait for other processes using the same caches. """
+        for cache in self.repo_caches.values():
+            cache.lock.timeout = timeout
+            cache.fetch_lock.timeout = timeout
+
+    def release_locks(self):
+        """ Release the locks held on every repo cache, once done reading from them. """
+        for cache in self.repo_caches.values():
+            cache.lock.release()
+            cache.fetch_lock.release()
+
+    def repo_cache(self, url):
+        """ Return the cache for the given repo URL, creating it if necessary. """
+        key = repo_url_to_dir(url)
+        if key not in self.repo_caches:
+            cache = self.open_caches.get(key)
+            if cache is None or cache.repo_dir != os.path.join(self.cache_dir, key):
+                cache = RepoCache(self.cache_dir, url)
+                self.open_caches[key] = cache
+            self.repo_caches[key] = cache
+        return self.repo_caches[key]
+
+
+class RepoCache(object):
+    """
+    A bare git repository in the cache directory. Fetched at most once per run no matter
+    how many manifest entries reference it, the files of each version they request are
+    then read straight from its object store, so several versions can be used side by
+    side without a checkout.
+    """
+
+    def __init__(self, cache_dir, url, repo_dir=None):
+        self.url = url
+        self.repo_dir = repo_dir or os.path.join(cache_dir, repo_url_to_dir(url))
+        self.git_repo = None
+
+        # Held shared until the run is done with the cache, so other processes don't run git
+        # gc on it or remove it while it is being read, which take it exclusive:
+        self.lock = CacheLock(self.repo_dir + '.lock')
+        # Held exclusive while fetching into the cache or updating its metadata. Fetching
+        # only adds objects and moves refs, which is safe while others read, so this only
+        # keeps fetches apart. Never held while waiting for another cache, i.e. a reference:
+        self.fetch_lock = CacheLock(self.repo_dir + '.fetch.lock')
+        self.reset()
+
+    def __str__(self):
+        return "RepoCache<url=%s>" % self.url
+
+    def reset(self):
+        """
+        Forget everything a run needed from the cache, so another run can use it. The
+        git repo stays open, so its object lookups are warm.
+        """
+        # Versions required, history depth and partial clone filter, see add_entry:
+        self.versions = []
+        self.depth = None
+        self.filter = None
+
+        # Set once fetched by this run:
+        self.fetched = False
+
+        # Map of version to the commit SHA it resolved to:
+        self.commits = {}
+
+        # Map of ref name to commit SHA advertised by the remote, see ls_remote:
+        self.remote_refs = None
+
+        # Seconds for which the commit of a branch fetched or listed from the remote is
+        # trusted without asking again, None to always ask:
+        self.max_age = None
+
+        # Seconds between runs of git gc on the cache after fetching, None to never run it:
+        self.gc_interval = None
+
+        # Cache of a related repo, i.e. the upstream of a fork, whose objects this cache
+        # borrows through git alternates rather than fetching them again:
+        self.reference = None
+
+    def add_entry(self, version, depth=None, filter_spec=None):
+        """
+        Add the version a manifest entry needs from this cache, and combine its clone
+        options with those of other entries. History is only truncated, and blobs only
+        omitted, if every entry allows it.
+        """
+        if not self.versions:
+            self.depth = depth
+            self.filter = filter_spec
+        else:
+            self.depth = depth and self.depth and max(depth, self.depth)
+            if filter_spec != self.filter:
+                self.filter = None
+        if version not in self.versions:
+            self.versions.append(version)
+
+    def set_reference(self, reference):
+        """ Set the cache of a related repo to borrow objects from, see fetch. """
+        if reference is self:
+            return
+        cache = reference
+        while cache is not None:
+            if cache is self:
+                raise ManifestError("Circular references between %s and %s" % (self.url, reference.url))
+            cache = cache.reference
+        if self.reference is not None and self.reference is not reference:
+            raise ManifestError("Conflicting references for %s: %s and %s" % (
+                self.url, self.reference.url, reference.url))
+        self.reference = reference
+
+    def fetch(self, echo=click.echo):
+        """
+        Create or update the cache, only the first call does any work. With a reference
+        that is fetched first, then this cache borrows its objects, so only the commits
+        which differ between the two are downloaded.
+        """
+        if self.fetched:
+            echo("  Already fetched: %s" % self.repo_dir)
+            return
+
+        if self.reference:
+            echo("  Fetching reference repo: %s" % self.reference.url)
+            try:
+                self.reference.fetch(echo)
+            except git.GitCommandError:
+                # The reference only saves downloading objects, i.e. when working offline from a
+                # cache seeded from bundles the fork can do without it:
+                echo("  Unable to fetch reference repo, continuing without updating it.")
+
+        self.lock.acquire(False, echo)
+        self.fetch_lock.acquire(True, echo)
+        try:
+            self._fetch(echo)
+        finally:
+            self.fetch_lock.release()
+
+    def _fetch(self, echo=click.echo):
+        """ Fetch into the cache, the caller holds the fetch lock. """
+        if not os.path.exists(self.repo_dir):
+            echo("  Creating repo cache: %s" % self.repo_dir)
+            git_repo = git.Repo.init(self.repo_dir, mkdir=True, bare=True)
+            git_repo.create_remote('origin', self.url)
+        else:
+            # Caches created by earlier releases are regular clones, which work just as well.
+            echo("  Re-using repo cache: %s" % self.repo_dir)
+            # Reopened if removed and cloned again by another process since last used:
+            git_repo = self.git_repo if self.git_repo and os.path.exists(self.git_repo.git_dir) else \
+                git.Repo(self.repo_dir)
+        if self.reference and os.path.exists(self.reference.repo_dir):
+            self._borrow_objects(echo)
+
+        kwargs = {}
+        if self.depth:
+            echo("  Limiting history to depth: %s" % self.depth)
+            kwargs['depth'] = self.depth
+        if self.filter:
+            # Registers the cache as a partial clone on first use, git then fetches
+            # omitted objects from origin when they are needed:
+            echo("  Partial clone filter: %s" % self.filter)
+            kwargs['filter'] = self.filter
+
+        # A cache only used as a reference is fetched in full, so it has every branch to share:
+        refspecs = self._refspecs(git_repo, echo) if self.versions else None
+        if refspecs:
+            echo("  Fetching refs: %s" % ' '.join(refspec.split(':')[0].lstrip('+') for refspec in refspecs))
+            try:
+                git_repo.git.fetch('origin', *refspecs, no_tags=True, **kwargs)
+            except git.GitCommandError:
+                commits = [refspec.split(':')[0] for refspec in refspecs if FULL_SHA_RE.match(refspec.split(':')[0])]
+                if not commits:
+                    raise
+                # Servers without uploadpack.allowReachableSHA1InWant refuse commits
+                # no ref points at, which may still be found by fetching every branch:
+                echo("  Unable to fetch commits by SHA, fetching remotes instead.")
+                refspecs = None
+        if refspecs is None:
+            echo("  Fetching remotes.")
+            if self.depth:
+                # Tags outside the truncated history of each branch would otherwise be missed:
+                kwargs['tags'] = True
+            git_repo.remotes.origin.fetch(**kwargs)
+            branches = self.versions
+            for version in self.versions:
+                if FULL_SHA_RE.match(version) and _has_ref(git_repo, '%s^{commit}' % version):
+                    # Keep the commit referenced so it isn't garbage collected:
+                    git_repo.git.update_ref('refs/gogitit/commits/%s' % version, version)
+        elif refspecs:
+            branches = [refspec.split(':')[0][len('+refs/heads/'):] for refspec in refspecs
+                        if refspec.startswith('+refs/heads/')]
+        else:
+            echo("  All versions present in cache, skipping fetch.")
+            branches = []
+        self.git_repo = git_repo
+        self.fetched = True
+
+        self.record_refs(dict((branch, git_repo.git.rev_parse('refs/remotes/origin/%s' % branch))
+                              for branch in branches
+                              if _has_ref(git_repo, 'refs/remotes/origin/%s' % branch)))
+        meta = self._load_meta()
+        meta['last_used'] = time.time()
+        # Caches from earlier releases are first collected one interval from now:
+        meta.setdefault('last_gc', meta['last_used'])
+        self._save_meta(meta)
+        if self.gc_interval is not None and time.time() - meta['last_gc'] >= self.gc_interval:
+            # Only if no other process is reading from the cache, waiting for them while
+            # holding the fetch lock would hold up their fetches too:
+            if self.lock.try_acquire(True, echo):
+                self.gc(echo)
+                self.lock.acquire(False, echo)
+            else:
+                echo("  Cache in use by another process, postponing git gc: %s" % self.repo_dir)
+
+    def _borrow_objects(self, echo=click.echo):
+        """ Add the object store of the reference cache to the alternates of this one. """
+        objects_dir = self.objects_dir()
+        reference_dir = self.reference.objects_dir()
+        if reference_dir not in self.alternates():
+            echo("  Sharing objects with: %s" % self.reference.repo_dir)
+            if not os.path.isdir(os.path.join(objects_dir, 'info')):
+                os.makedirs(os.path.join(objects_dir, 'info'))
+            # Relative to the object store, so the cache dir can be moved:
+            with open(os.path.join(objects_dir, 'info', 'alternates'), 'a') as f:
+                f.write(os.path.relpath(reference_dir, objects_dir) + '\n')
+        # Objects borrowed must stay in the reference even once unreachable from its branches:
+        git.Repo(self.reference.repo_dir).git.config('gc.pruneExpire', 'never')
+
+    def export_bundle(self, path, echo=click.echo):
+        """
+        Write every ref in the cache and the objects they need to a git bundle at path,
+        which import_bundle can seed a cache from offline. Objects borrowed from a
+        reference are left out, its bundle must be imported first. Returns False if
+        the cache can't be bundled, or has nothing beyond its reference.
+        """
+        if not os.path.exists(self.repo_dir):
+            echo("  Not cached, sync first: %s" % self.url)
+            return False
+        self.lock.acquire(False, echo)
+        git_repo = git.Repo(self.repo_dir)
+        if os.path.exists(os.path.join(git_repo.git_dir, 'shallow')) or \
+                git_repo.config_reader().get_value('remote "origin"', 'promisor', False):
+            # Missing history or blobs would have to be fetched from the remote:
+            echo("  Shallow or partial clone, not bundled: %s" % self.url)
+            return False
+
+        args = ['--all']
+        if self.reference and self.reference.objects_dir() in self.alternates():
+            tips = git.Repo(self.reference.repo_dir).git.for_each_ref('--format=%(objectname)').split()
+            args += ['--not'] + sorted(set(tips))
+        # Git runs within the cache:
+        path = os.path.abspath(path)
+        _make_parent_dirs(path)
+        try:
+            git_repo.git.bundle('create', path, *args)
+        except git.GitCommandError as e:
+            if 'empty bundle' not in str(e):
+                raise
+            echo("  Nothing beyond reference repo, not bundled: %s" % self.url)
+            return False
+        echo("  Wrote bundle: %s" % path)
+        return True
+
+    def import_bundle(self, path, echo=click.echo):
+        """
+        Create the cache from a bundle written by export_bundle, after which a fetch only
+        downloads what changed since. Returns False if the cache already exists.
+        """
+        self.lock.acquire(False, echo)
+        self.fetch_lock.acquire(True, echo)
+        try:
+            if os.path.exists(self.repo_dir):
+                echo("  Already cached, not imported: %s" % self.repo_dir)
+                return False
+            echo("  Importing bundle: %s" % path)
+            try:
+                git_repo = git.Repo.init(self.repo_dir, mkdir=True, bare=True)
+                git_repo.create_remote('origin', self.url)
+                if self.reference and os.path.exists(self.reference.repo_dir):
+                    self._borrow_objects(echo)
+                git_repo.git.fetch(os.path.abspath(path), '+refs/*:refs/*')
+            except Exception:
+                # Leave nothing half imported, the next sync clones from scratch:
+                shutil.rmtree(self.repo_dir, ignore_errors=True)
+                raise
+            now = time.time()
+            self._save_meta({'last_used': now, 'last_gc': now})
+            return True
+        finally:
+            self.fetch_lock.release()
+
+    def objects_dir(self):
+        """ Return the object store of the cache, within .git for clones by earlier releases. """
+        git_dir = os.path.join(self.repo_dir, '.git')
+        return os.path.normpath(os.path.join(git_dir if os.path.isdir(git_dir) else self.repo_dir, 'objects'))
+
+    def alternates(self):
+        """ Return the object stores of other caches this cache borrows objects from. """
+        objects_dir = self.objects_dir()
+        path = os.path.join(objects_dir, 'info', 'alternates')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [os.path.normpath(os.path.join(objects_dir, line.strip())) for line in f
+                    if line.strip() and not line.startswith('#')]
+
+    def gc(self, echo=click.echo):
+        """
+        Pack loose objects fetched since the last run and drop unreachable ones with git
+        gc, which keeps fetches and reads from the cache fast. The caller must hold both
+        the lock and the fetch lock exclusive.
+        """
+        echo("  Running git gc: %s" % self.repo_dir)
+        git.Repo(self.repo_dir).git.gc('--quiet')
+        meta = self._load_meta()
+        meta['last_gc'] = time.time()
+        self._save_meta(meta)
+
+    def last_used(self):
+        """ Return when the cache was last fetched into by a run, or created if never. """
+        meta = self._load_meta()
+        if 'last_used' in meta:
+            return meta['last_used']
+        return os.path.getmtime(self.repo_dir)
+
+    def last_gc(self):
+        """ Return when git gc was last run on the cache, or None if not known. """
+        return self._load_meta().get('last_gc')
+
+    def _refspecs(self, git_repo, echo=click.echo):
+        """
+        Return the refspecs needed to fetch just the versions required from this cache.
+        Tags and commits are immutable, so are not fetched again once in the cache, only
+        branches need updating. Returns None if a version can't be found as a branch,
+        tag or full commit SHA, in which case everything must be fetched.
+        """
+        refspecs = []
+        unknown = []
+        for version in self.versions:
+            if _has_ref(git_repo, 'refs/remotes/origin/%s' % version):
+                recent_sha = self.recent_ref(version)
+                if recent_sha and recent_sha == git_repo.git.rev_parse('refs/remotes/origin/%s' % version):
+                    echo("  Branch %s fetched within the last %ss, not fetching." % (version, self.max_age))
+                    continue
+                refspecs.append('+refs/heads/%s:refs/remotes/origin/%s' % (version, version))
+            elif _has_ref(git_repo, 'refs/tags/%s' % version):
+                continue
+            elif FULL_SHA_RE.match(version) and _has_ref(git_repo, '%s^{commit}' % version):
+                continue
+            else:
+                unknown.append(version)
+
+        if unknown:
+            refs = self.ls_remote(echo)
+            for version in unknown:
+                if 'refs/heads/%s' % version in refs:
+                    refspecs.append('+refs/heads/%s:refs/remotes/origin/%s' % (version, version))
+                elif 'refs/tags/%s' % version in refs:
+                    refspecs.append('+refs/tags/%s:refs/tags/%s' % (version, version))
+                elif FULL_SHA_RE.match(version):
+                    # Keep the commit referenced so it isn't garbage collected:
+                    refspecs.append('%s:refs/gogitit/commits/%s' % (version, version))
+                else:
+                    return None
+        return refspecs
+
+    def is_partial(self):
+        """ Return True if objects may be missing from the cache as it is a partial clone. """
+        return self.git_repo.config_reader().get_value('remote "origin"', 'promisor', False)
+
+    def prefetch(self, sha, paths, echo=click.echo):
+        """
+        Download any blobs beneath paths in a commit missing from a partial clone, in one
+        request rather than letting git fetch them one at a time as they are read.
+        """
+        if not self.is_partial():
+            return
+        output = self.git_repo.git.rev_list('--objects', '--missing=print', '--no-walk', sha, '--', *paths)
+        missing = [line[1:] for line in output.splitlines() if line.startswith('?')]
+        if not missing:
+            return
+        echo("  Fetching %s files omitted by partial clone." % len(missing))
+        self.fetch_lock.acquire(True, echo)
+        try:
+            for i in range(0, len(missing), PREFETCH_BATCH_SIZE):
+                self.git_repo.git(c='fetch.negotiationAlgorithm=noop').fetch(
+                    'origin', '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no',
+                    '--filter=%s' % (self.filter or 'blob:none'), *missing[i:i + PREFETCH_BATCH_SIZE])
+        finally:
+            self.fetch_lock.release()
+
+    def resolve(self, version, echo=click.echo):
+        """ Return the commit SHA for a branch, tag or commit. """
+        if version in self.commits:
+            return self.commits[version]
+
+        if version in self.git_repo.remotes.origin.refs:
+            echo("  Using branch: %s" % version)
+            sha = self.git_repo.commit("origin/%s" % version).hexsha
+        else:
+            echo("  Using ref: %s" % version)
+            sha = self.git_repo.commit(version).hexsha
+
+        self.commits[version] = sha
+        return sha
+
+    def ls_remote(self, echo=click.echo):
+        """
+        Return a map of every ref name on the remote to its commit SHA, listed with a
+        single request on first use and without touching the cache.
+        """
+        if self.remote_refs is None:
+            echo("  Listing remote refs.")
+            refs = {}
+            for line in git.Git().ls_remote(self.url).splitlines():
+                sha, ref = line.split('\t')
+                # Annotated tags are followed by the commit they point to:
+                if ref.endswith('^{}'):
+                    refs[ref[:-3]] = sha
+                elif ref not in refs:
+                    refs[ref] = sha
+            self.remote_refs = refs
+            # Recorded under the fetch lock, as others update the same metadata. A fetch
+            # holding it, this one's included, records the refs it fetches itself, so this
+            # isn't worth waiting for:
+            if self.fetch_lock.fd is None and os.path.isdir(self.repo_dir) and \
+                    self.fetch_lock.try_acquire(True, echo):
+                try:
+                    self.record_refs(dict((version, refs['refs/heads/%s' % version]) for version in self.versions
+                                          if 'refs/heads/%s' % version in refs))
+                finally:
+                    self.fetch_lock.release()
+        return self.remote_refs
+
+    def resolve_remote(self, version, echo=click.echo):
+        """
+        Return the commit SHA for a branch, tag or commit without fetching. Full SHAs
+        are returned as is, anything else is looked up in the refs on the remote, then
+        as an abbreviated commit in the cache. Returns None if version can't be found.
+        """
+        if FULL_SHA_RE.match(version):
+            return version
+        recent_sha = self.recent_ref(version)
+        if recent_sha:
+            echo("  Branch %s listed within the last %ss, not asking remote." % (version, self.max_age))
+            return recent_sha
+        refs = self.ls_remote(echo)
+        for ref in ('refs/heads/%s' % version, 'refs/tags/%s' % version, version):
+            if ref in refs:
+                return refs[ref]
+        if os.path.exists(self.repo_dir):
+            self.lock.acquire(False, echo)
+            try:
+                return git.Repo(self.repo_dir).commit(version).hexsha
+            except (git.BadName, git.BadObject, ValueError):
+                pass
+        return None
+
+    def _load_meta(self):
+        path = os.path.join(self.repo_dir, CACHE_META_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+
+    def _save_meta(self, meta):
+        # Write to a temporary file and rename so concurrent readers never see a partial file:
+        fd, tmp_path = tempfile.mkstemp(dir=self.repo_dir, prefix='.%s-' % CACHE_META_FILE)
+        with os.fdopen(fd, 'w') as f:
+            f.write(yaml.safe_dump(meta, default_flow_style=False))
+        os.rename(tmp_path, os.path.join(self.repo_dir, CACHE_META_FILE))
+
+    def record_refs(self, branches):
+        """
+        Record the commit just fetched or listed for each branch in a map of name to SHA.
+        The caller must hold the fetch lock.
+        """
+        if not branches or not os.path.isdir(self.repo_dir):
+            return
+        meta = self._load_meta()
+        refs = meta.setdefault('refs', {})
+        now = time.time()
+        for branch, sha in branches.items():
+            refs[str(branch)] = {'sha': str(sha), 'time': now}
+        self._save_meta(meta)
+
+    def recent_ref(self, branch):
+        """ Return the commit recorded for a branch if that was within max_age, else None. """
+        if not self.max_age:
+            return None
+        ref = self._load_meta().get('refs', {}).get(branch)
+        if ref and time.time() - ref['time'] <= self.max_age:
+            return ref['sha']
+        return None
+
+    def has_commit(self, sha):
+        """ Return True if the given commit exists in the cache. """
+        try:
+            self.git_repo.git.cat_file('-e', '%s^{commit}' % sha)
+        except git.GitCommandError:
+            return False
+        return True
+
+    def diff(self, old_sha, new_sha, paths):
+        """
+        Return the files changed beneath paths between two commits as a list of
+        (status, old_path, new_path) tuples. old_path is None for added files,
+        new_path is None for deleted files.
+        """
+        output = self.git_repo.git.diff_tree(
+            '-r', '-z', '--name-status', '-M', old_sha, new_sha, '--', *paths)
+        fields = output.split('\0')
+        changes = []
+        i = 0
+        while i < len(fields) and fields[i]:
+            status = fields[i]
+            if status[0] in ('R', 'C'):
+                old_path, new_path = fields[i + 1], fields[i + 2]
+                if status[0] == 'C':
+                    old_path = None
+                i += 3
+            else:
+                old_path = new_path = fields[i + 1]
+                if status[0] == 'A':
+                    old_path = None
+                elif status[0] == 'D':
+                    new_path = None
+                i += 2
+            changes.append((status, old_path, new_path))
+        return changes
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
 
 class Repo(object):
 
@@ -74,8 +734,15 @@ class Repo(object):
         self.url = kwargs['url']
         self.version = kwargs.get('version', 'master')
 
-        # Location where we maintain a git clone of this repo:
-        self.repo_dir = os.path.join(self.cache_dir, repo_url_to_dir(self.url))
+        # Git repo shared with other entries for this repo:
+        self.cache = manifest.repo_cache(self.url)
+        self.cache.add_entry(self.version, kwargs.get('depth', manifest.depth), kwargs.get('filter', manifest.filter))
+        if kwargs.get('reference'):
+            # A related repo, i.e. the upstream of a fork, to share objects with:
+            self.cache.set_reference(manifest.repo_cache(kwargs['reference']))
+
+        # Files of the commit our version resolves to, available once cloned:
+        self.tree = None
 
         self.copy = []
         for t in kwargs['copy']:
@@ -84,30 +751,40 @@ class Repo(object):
     def __str__(self):
         return "Repo<url=%s version=%s>" % (self.url, self.version)
 
-    def clone(self):
-        if not os.path.exists(self.repo_dir):
-            click.echo("  Creating repo cache: %s" % self.repo_dir)
-            os.makedirs(self.repo_dir)
-            git_repo = git.Repo.clone_from(self.url, self.repo_dir)
-        else:
-            click.echo("  Re-using repo cache: %s" % self.repo_dir)
+    def spec(self):
+        """ Return the settings of this entry which determine what it syncs. """
+        return {'url': self.url, 'version': str(self.version)}
 
-        git_repo = git.Repo(self.repo_dir)
-        click.echo("  Fetching remotes.")
-        git_repo.remotes.origin.fetch()
+    def spec_hash(self):
+        """ Hash of spec(), unaffected by formatting or unrelated edits to the manifest. """
+        return _hash(self.spec())
 
-        if self.version in git_repo.remotes.origin.refs:
-            click.echo("  Checking out branch: %s" % self.version)
-            g = git_repo.git
-            g.checkout("origin/%s" % self.version)
+    def clone(self, echo=click.echo):
+        """ Update the repo cache and resolve the requested version. """
+        self.cache.fetch(echo)
+        self.sha = self.cache.resolve(self.version, echo)
+        self.tree = CommitTree(self.cache.git_repo, self.sha)
+        echo("  Sync commit: %s" % self.sha)
 
+    def resolve(self, echo=click.echo):
+        """
+        Resolve the requested version to a commit SHA without fetching if possible,
+        otherwise clone.
+        """
+        sha = self.cache.resolve_remote(self.version, echo)
+        if sha is None:
+            echo("  Unable to resolve %s without fetching." % self.version)
+            self.clone(echo)
         else:
-            click.echo("  Checking out ref: %s" % self.version)
-            raw_repo = git.Git(self.repo_dir)
-            raw_repo.checkout(self.version)
+            self.sha = sha
+            echo("  Sync commit: %s" % self.sha)
 
-        self.sha = git_repo.head.commit.hexsha
-        click.echo("  Sync commit: %s" % self.sha)
+    def prefetch(self, echo=click.echo):
+        """ Make sure all files our copies will export are present in a partial clone. """
+        paths = set()
+        for copy in self.copy:
+            paths.update(copy.files_matched)
+        self.cache.prefetch(self.sha, sorted(paths), echo)
 
     # Alias __repr__ to __str__
     __repr__ = __str__
@@ -122,32 +799,119 @@ class Copy(object):
 
         # Will contain globbed files and directories we intend to copy over.
         self.files_matched = []
+        self._copy_pairs = None
+        # (src, dest, is_dir) for each match, set by the sync plan:
+        self.targets = None
 
     def __str__(self):
         return "Copy<src=%s dst=%s>" % (self.src, self.dst)
 
+    @property
+    def key(self):
+        """ Identifies this copy entry in the status file. """
+        return "%s:%s -> %s" % (self.repo.url, self.src, self.dst)
+
+    def spec_hash(self):
+        """ Hash of the settings of this entry, and its repo, which determine what it syncs. """
+        return _hash({'repo': self.repo.spec(), 'src': self.src, 'dst': self.dst or ''})
+
+    def _copy_to_dir(self):
+        # Watch out for dst = '' indicating top level of output dir:
+        if self.dst:
+            return os.path.join(self.repo.manifest.output_dir, self.dst)
+        return self.repo.manifest.output_dir
+
+    def is_current(self, status):
+        """
+        Return True if the output of this copy recorded in the status from the last
+        sync was built from the same commit and is still present in the output dir.
+        Where its files were recorded, none may have been modified or deleted since,
+        which their recorded stat data shows without reading most of them.
+        """
+        previous = status.copies.get(self.key)
+        if not previous or previous['sha'] != self.repo.sha:
+            return False
+        dests = [dest for src, dest in self.copy_pairs()]
+        if sorted(dests) != sorted(previous['paths']):
+            return False
+        if not all(os.path.exists(dest) for dest in dests):
+            return False
+        if not status.is_indexed(self.key):
+            return True
+        records = status.records()
+        return all(status.is_unchanged(records.get(record.path, record)) for record in status.files(self.key))
+
+    def cleanup_dirs(self):
+        """ Return the destination directories pre() will delete. """
+        copy_pairs = self.copy_pairs()
+        return [dest for src, dest in copy_pairs if self.repo.tree.is_dir(src)]
+
     def validate(self):
-        source = os.path.join(self.repo.repo_dir, self.src)
         # mode is unused
         # mode = None
-        self.files_matched = glob.glob(source)
-        if len(self.files_matched) == 0 and not os.path.exists(source):
-            raise click.ClickException("src does not exist in repo: %s" % source)
+        self.files_matched = self.repo.tree.glob(self.src)
+        self._copy_pairs = None
+        self.targets = None
+        if len(self.files_matched) == 0:
+            raise ManifestError("src does not exist in repo %s: %s" % (self.repo.url, self.src))
 
     def sha_check(self, status):
-        copy_to_dir = self.repo.manifest.output_dir
-        if self.dst:
-            copy_to_dir = os.path.join(self.repo.manifest.output_dir, self.dst)
-
-        copy_pairs = self._build_copy_pairs(copy_to_dir)
+        """
+        Return why a sync is required if the destination paths this copy matches were
+        not synced from the current commit of its repo, or None if they were.
+        """
+        copy_pairs = self.copy_pairs()
         for src, dest in copy_pairs:
-            if dest not in status['paths']:
-                click.echo("%s missing in status, sync is required." % dest)
-                # TODO: should not sys.exit in here
-                sys.exit(CHECK_STATUS_SHA_CHANGED)
-            if self.repo.sha != status['paths'][dest]:
-                click.echo("Commit changed for repo %s, sync is required." % self.repo.url)
-                sys.exit(CHECK_STATUS_SHA_CHANGED)
+            if dest not in status.paths:
+                return "%s missing in status, sync is required." % dest
+            if self.repo.sha != status.paths[dest]:
+                return "Commit changed for repo %s, sync is required." % self.repo.url
+        return None
+
+    def commit_check(self, status):
+        """
+        Like sha_check, but compares the commit recorded for this copy at the last sync
+        rather than those of its paths, so the repo need not be fetched to know which paths
+        it matches. A path is recorded with the commit of the last copy writing it, which
+        may be another repo writing to the same directory.
+        """
+        previous = status.copies.get(self.key)
+        if not previous:
+            return "%s missing in status, sync is required." % self.key
+        if previous['sha'] != self.repo.sha:
+            return "Commit changed for repo %s, sync is required." % self.repo.url
+        return None
+
+    def copy_pairs(self):
+        """ Return the (src, dest) pairs for this copy, built once for the matched files. """
+        if self._copy_pairs is None:
+            self._copy_pairs = self._build_copy_pairs(self._copy_to_dir())
+        return self._copy_pairs
+
+    def plan_targets(self, planned_dirs=()):
+        """
+        Resolve the path each match is written to, returning (src, dest, is_dir) tuples.
+        A file copied to a destination without a trailing slash is written within it if
+        it is a directory, either already or one planned_dirs shows another copy creates.
+        """
+        self.targets = []
+        for src, dest in self.copy_pairs():
+            is_dir = self.repo.tree.is_dir(src)
+            if not is_dir:
+                dest = _file_dest(src, dest, planned_dirs)
+            self.targets.append((src, dest, is_dir))
+        return self.targets
+
+    def files(self):
+        """ Yield (dest, blob) for every file this copy writes. """
+        for src, dest, is_dir in self.targets or self.plan_targets():
+            item = self.repo.tree.get(src)
+            if item.type == 'blob':
+                yield dest, item
+            elif item.type == 'tree':
+                for child in item.traverse():
+                    if child.type == 'blob':
+                        yield os.path.join(dest, os.path.relpath(child.path, item.path or '.')), child
 
     def _build_copy_pairs(self, copy_to_dir):
         """ Return list of tuples matching source path to full destination path. """
@@ -157,68 +921,253 @@ class Copy(object):
             # destination with directory name to copy as. If however you use a glob which matches
             # to a directory, we need to copy to an exact dir of dst + your globbed dir name.
             full_dest_dir = copy_to_dir
-            if match != os.path.join(self.repo.repo_dir, self.src) and os.path.isdir(match):
+            if glob.has_magic(self.src) and self.repo.tree.is_dir(match):
                 full_dest_dir = os.path.join(copy_to_dir, os.path.basename(match))
             copy_pairs.append((match, full_dest_dir))
         return copy_pairs
 
-    def pre(self):
-        """ Run pre-copy. """
-        # Watch out for dst = '' indicating top level of output dir:
-        copy_to_dir = self.repo.manifest.output_dir
-        if self.dst:
-            copy_to_dir = os.path.join(self.repo.manifest.output_dir, self.dst)
+    def needs_pre(self, previous_status):
+        """
+        Return True if the files this copy wrote at the last sync were not recorded, so
+        pre() must delete its destination directories to remove any no longer produced.
+        Otherwise sync prunes exactly the files no copy produces any more.
+        """
+        if previous_status.legacy:
+            return True
+        return self.key in previous_status.copies and not previous_status.is_indexed(self.key)
 
+    def pre(self, echo=click.echo):
+        """ Run pre-copy. """
         # Delete all destination directories (when source is also a directory) prior to starting
         # the copy. This can't be done during because it can potentially clobber other files
-        # already copied into the output dir by other pairs.
-        copy_pairs = self._build_copy_pairs(copy_to_dir)
-        for pair in copy_pairs:
-            if os.path.isdir(pair[0]):
-                # TODO: this can blow away things you've already copied into the dir, i.e. when copying a bunch of roles to 'roles':
-                # If copying a dir, cleanup the target dir to remove old files:
-                full_dest_dir = pair[1]
-                click.echo("Pre: %s" % full_dest_dir)
-                if os.path.exists(full_dest_dir):
-                    click.echo("Deleting previous contents of: %s" % full_dest_dir)
-                    shutil.rmtree(full_dest_dir)
-
-    def run(self, status):
-        """ Copy all files to output dir. """
-        # Watch out for dst = '' indicating top level of output dir:
-        copy_to_dir = self.repo.manifest.output_dir
-        if self.dst:
-            copy_to_dir = os.path.join(self.repo.manifest.output_dir, self.dst)
+        # already copied into the output dir by other pairs. Only used when needs_pre() is True,
+        # as this can blow away things other entries copied into the dir, i.e. when copying a
+        # bunch of roles to 'roles'.
+        for full_dest_dir in self.cleanup_dirs():
+            # If copying a dir, cleanup the target dir to remove old files:
+            echo("Pre: %s" % full_dest_dir)
+            if os.path.exists(full_dest_dir):
+                echo("Deleting previous contents of: %s" % full_dest_dir)
+                shutil.rmtree(full_dest_dir)
 
+    def run(self, status, echo=click.echo):
+        """ Copy all files to output dir, recording each in the status writer. """
         # List of tuples, source file or path, dest path:
-        copy_pairs = self._build_copy_pairs(copy_to_dir)
-        for pair in copy_pairs:
-            if os.path.isdir(pair[0]):
-                # TODO: this can blow away things you've already copied into the dir, i.e. when copying a bunch of roles to 'roles':
-                # If copying a dir, cleanup the target dir to remove old files:
-                full_dest_dir = pair[1]
-                click.echo("Copy:")
-                click.echo("  Src: %s" % pair[0])
-                click.echo("  Dest: %s" % full_dest_dir)
-
-                shutil.copytree(pair[0], full_dest_dir, symlinks=True, ignore=shutil.ignore_patterns('.git'))
-                click.echo("  Done.")
-            else:
-                # Make sure directory exists for the file copy:
-                if pair[1][-1] == '/' and not os.path.exists(pair[1]):
-                    os.makedirs(pair[1])
-                elif not os.path.exists(os.path.dirname(pair[1])):
-                    os.makedirs(os.path.dirname(pair[1]))
-
-                click.echo("Copy:")
-                click.echo("  Src: %s" % pair[0])
-                click.echo("  Dest: %s" % pair[1])
-                shutil.copy2(pair[0], pair[1])
-                click.echo("  Done.")
-
-            if 'paths' not in status:
-                status['paths'] = {}
-            status['paths'][pair[1]] = self.repo.sha
+        self.record(status, [pair[1] for pair in self.copy_pairs()])
+        count = self.repo.manifest.exporter.export_pairs(
+            self.repo.tree, [(src, dest) for src, dest, is_dir in self.targets or self.plan_targets()],
+            self._recorder(status), self.owns)
+        echo("Copy: %s (%s files)" % (self.key, count))
+
+    def owns(self, dest):
+        """
+        Return True unless the plan of the sync has a later entry writing dest, which
+        wins whether or not it is rebuilt.
+        """
+        plan = self.repo.manifest.plan
+        return plan is None or dest not in plan.files or plan.files[dest][0] is self
+
+    def can_delta(self, previous_status, echo=click.echo):
+        """
+        Return True if the output of the previous sync can be updated in place from a
+        git diff between the previously synced commit and the current one.
+        """
+        previous = previous_status.copies.get(self.key)
+        if not previous or previous['sha'] == self.repo.sha:
+            return False
+
+        # The same sources must still be matched, and their output must be intact:
+        if sorted(pair[1] for pair in self.copy_pairs()) != sorted(previous['paths']):
+            return False
+        for src, dest, is_dir in self.targets or self.plan_targets():
+            intact = os.path.isdir(dest) if is_dir else os.path.lexists(dest)
+            if not intact:
+                return False
+
+        if not self.repo.cache.has_commit(previous['sha']):
+            echo("Previous commit %s no longer in cache: %s" % (previous['sha'], self.key))
+            return False
+        return True
+
+    def delta(self, status, previous_status, echo=click.echo):
+        """
+        Update the output of the previous sync in place, writing, deleting or renaming
+        only the files git reports as changed since the previously synced commit.
+        Only valid if can_delta() returned True.
+        """
+        previous = previous_status.copies[self.key]
+        roots = [(src, dest) for src, dest, is_dir in self.targets or self.plan_targets()]
+
+        def dest_path(path):
+            for root, dest in roots:
+                if path == root:
+                    return dest
+                if root == '.' or path.startswith(root + '/'):
+                    return os.path.join(dest, os.path.relpath(path, root))
+            return None
+
+        echo("Delta: %s (%s..%s)" % (self.key, previous['sha'][:8], self.repo.sha[:8]))
+        changes = self.repo.cache.diff(previous['sha'], self.repo.sha, [root for root, dest in roots])
+
+        # Remove deleted and renamed files first, renames with identical content are
+        # moved rather than copied again, unless the file was modified since the last sync
+        # or its mode changed:
+        writes = []
+        changed = set()
+        for change, old_path, new_path in changes:
+            old_dest = old_path and dest_path(old_path)
+            new_dest = new_path and dest_path(new_path)
+            if old_dest:
+                changed.add(old_dest)
+            if old_dest and not self.owns(old_dest):
+                # Written by another entry, which keeps it or writes it itself:
+                old_dest = None
+            if new_dest and not self.owns(new_dest):
+                new_dest = None
+            if old_dest and old_dest != new_dest and os.path.lexists(old_dest):
+                if change == 'R100' and new_dest and previous_status.is_current(
+                        old_dest, self.repo.tree.get(new_path)):
+                    echo("  Rename: %s -> %s" % (old_dest, new_dest))
+                    _make_parent_dirs(new_dest)
+                    os.rename(old_dest, new_dest)
+                    writes.append((new_path, new_dest, False))
+                    new_dest = None
+                else:
+                    echo("  Delete: %s" % old_dest)
+                    _remove(old_dest)
+                _remove_empty_dirs(os.path.dirname(old_dest), [dest for root, dest in roots])
+            if new_dest:
+                changed.add(new_dest)
+                writes.append((new_path, new_dest, True))
+
+        # Files the diff did not touch keep their previous record:
+        self.record(status, [pair[1] for pair in self.copy_pairs()], previous_status.is_indexed(self.key))
+        for record in previous_status.files(self.key):
+            if record.path not in changed:
+                status.add_file(*record)
+
+        for path, dest, export in writes:
+            if export:
+                echo("  Write: %s" % dest)
+            elif self.repo.tree.get(path).type == 'blob':
+                status.add_file(dest, self.repo.tree.get(path).hexsha)
+        self.repo.manifest.exporter.export_pairs(
+            self.repo.tree, [(path, dest) for path, dest, export in writes if export], self._recorder(status))
+
+    def keep(self, status, previous_status):
+        """ Record the output of the previous sync, unchanged, in the status writer. """
+        previous = previous_status.copies[self.key]
+        self.record(status, previous['paths'], previous_status.is_indexed(self.key))
+        for record in previous_status.files(self.key):
+            status.add_file(*record)
+
+    def record(self, status, paths, indexed=True):
+        """
+        Record the destination paths this copy produced in the status writer, to be
+        followed by the files written. indexed is False if some files may be missed.
+        """
+        status.add_copy(self.key, {
+            'sha': self.repo.sha,
+            'paths': paths,
+            'dirs': self.cleanup_dirs(),
+            'spec': self.spec_hash(),
+            'repo_spec': self.repo.spec_hash(),
+        }, indexed)
+
+    def _recorder(self, status):
+        """ Return a callback for the exporter which records each file written. """
+        return lambda dest, blob: status.add_file(dest, blob.hexsha)
 
     # Alias __repr__ to __str__
     __repr__ = __str__
+
+
+def _hash(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def manifest_changes(manifest, status):
+    """
+    Compare the entries of the manifest against those recorded in the status of the last
+    sync, returning a description of each which was added, changed or removed. Returns
+    None if the status predates recording entries, and can't be compared.
+    """
+    previous = status.copies
+    if not previous or any('spec' not in copy for copy in previous.values()):
+        return None
+
+    changes = []
+    keys = set()
+    for repo in manifest.repos:
+        for copy in repo.copy:
+            keys.add(copy.key)
+            if copy.key not in previous:
+                changes.append("Added: %s" % copy.key)
+            elif previous[copy.key]['repo_spec'] != repo.spec_hash():
+                changes.append("Repo changed: %s" % copy.key)
+            elif previous[copy.key]['spec'] != copy.spec_hash():
+                changes.append("Changed: %s" % copy.key)
+    for key in sorted(set(previous) - keys):
+        changes.append("Removed: %s" % key)
+    return changes
+
+
+def prune(previous_status, stale, echo=click.echo):
+    """
+    Remove the stale files recorded in the status of the previous sync, those no longer
+    synced, along with any directories left empty. Files modified since the previous
+    sync are left in place. Returns the number of files removed.
+    """
+    removed = 0
+    records = previous_status.records()
+    for path in sorted(stale):
+        if not os.path.lexists(path) or (os.path.isdir(path) and not os.path.islink(path)):
+            # Already gone, or replaced by a directory, i.e. when a file becomes one or
+            # the other way around:
+            continue
+        if not previous_status.is_unchanged(records[path]):
+            echo("Keeping modified file no longer synced: %s" % path)
+            continue
+        echo("Prune: %s" % path)
+        os.remove(path)
+        removed += 1
+        _remove_empty_dirs(os.path.dirname(path), [previous_status.output_dir])
+    return removed
+
+
+def _has_ref(git_repo, ref):
+    """ Return True if ref resolves to an object in the repository. """
+    try:
+        git_repo.git.rev_parse('--verify', '--quiet', ref)
+    except git.GitCommandError:
+        return False
+    return True
+
+
+def _file_dest(src, dest, dirs=()):
+    """ Return the path a single file copy will be written to, dirs being planned directories. """
+    if dest[-1] == '/' or os.path.isdir(dest) or os.path.normpath(dest) in dirs:
+        return os.path.join(dest, os.path.basename(src))
+    return dest
+
+
+def _make_parent_dirs(path):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _remove_empty_dirs(path, roots):
+    """ Remove path and its parents while they are empty, stopping at any of roots. """
+    roots = [os.path.normpath(root) for root in roots]
+    path = os.path.normpath(path)
+    while path not in roots and os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+        path = os.path.dirname(path)
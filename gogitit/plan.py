@@ -0,0 +1,91 @@
+"""Works out every file a sync will write before anything is written."""
+
+import os
+
+from gogitit.errors import ConflictError
+
+
+class Plan(object):
+    """
+    Every file a sync of the manifest writes, indexed by destination path, resolved once
+    from the commit trees of each copy. Built after all repos are cloned, the plan
+    drives conflict detection between entries, pruning of files no longer synced and
+    the dry run of the plan command.
+
+    Where entries write the same path the last in the manifest wins, as in a sync.
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.copies = [copy for repo in manifest.repos for copy in repo.copy]
+        # Destination path to the (copy, blob) that writes it:
+        self.files = {}
+        # (path, earlier copy key, later copy key) where entries write different content:
+        self.conflicts = []
+
+        # Directories copied by any entry, so a file copied to one is written within it:
+        planned_dirs = set(os.path.normpath(dest) for copy in self.copies
+                           for src, dest in copy.copy_pairs() if copy.repo.tree.is_dir(src))
+        for copy in self.copies:
+            copy.plan_targets(planned_dirs)
+
+        for copy in self.copies:
+            for path, blob in copy.files():
+                previous = self.files.get(path)
+                if previous and previous[0] is not copy and previous[1].binsha != blob.binsha:
+                    self.conflicts.append((path, previous[0].key, copy.key))
+                self.files[path] = (copy, blob)
+        self._check_file_dirs()
+
+    def __str__(self):
+        return "Plan<files=%s>" % len(self.files)
+
+    def _check_file_dirs(self):
+        """ Raise a ConflictError if any path is written as a file and as a directory. """
+        checked = set()
+        for path in self.files:
+            parent = os.path.dirname(path)
+            while parent not in checked and parent != os.path.dirname(parent):
+                checked.add(parent)
+                if parent in self.files:
+                    child = [p for p in self.files if p.startswith(parent + os.sep)][0]
+                    raise ConflictError("%s is a file from %s, but a directory from %s" % (
+                        parent, self.files[parent][0].key, self.files[child][0].key))
+                parent = os.path.dirname(parent)
+
+    def changes(self, previous_status, skip=()):
+        """
+        Compare the plan against the files recorded at the previous sync. Returns a sorted
+        list of (change, path, copy key) tuples and the number of files left unchanged.
+        Change is one of Add, Update, Remove or Keep, for a file no longer synced which
+        was modified since and will be left in place. Copies in skip are not written by
+        a sync, so their files are unchanged.
+        """
+        changes = []
+        unchanged = 0
+        for path in sorted(self.files):
+            copy, blob = self.files[path]
+            if copy in skip or previous_status.is_current(path, blob):
+                unchanged += 1
+            elif os.path.lexists(path):
+                changes.append(('Update', path, copy.key))
+            else:
+                changes.append(('Add', path, copy.key))
+
+        records = previous_status.records()
+        for path in sorted(self.stale(previous_status)):
+            if previous_status.is_unchanged(records[path]):
+                changes.append(('Remove', path, None))
+            else:
+                changes.append(('Keep', path, None))
+        return changes, unchanged
+
+    def stale(self, previous_status):
+        """ Return the files recorded at the previous sync which no entry writes any more. """
+        # A directory written in place of a file is no longer ours to remove:
+        return [path for path in previous_status.records()
+                if path not in self.files and os.path.lexists(path) and
+                not (os.path.isdir(path) and not os.path.islink(path))]
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
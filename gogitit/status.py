@@ -0,0 +1,302 @@
+"""
+Reads and writes the status file recording what the last sync wrote to the output dir.
+
+The status file is JSON lines. The first line is a header identifying the format
+version and the manifest synced. Each copy entry is then one object line, followed
+by one array line per file it wrote:
+
+    {"gogitit_status": 2, "manifest_sha": "..."}
+    {"copy": "<key>", "sha": "...", "paths": [...], "dirs": [...], "spec": "...", "repo_spec": "...",
+     "indexed": true}
+    ["<path>", "<blob sha>", <size>, <mtime>, <inode>]
+
+Paths within the output dir are stored relative to it, and are absolute once loaded. Copies are
+loaded up front while their file lines are only indexed, and read when requested.
+"""
+
+import collections
+import json
+import os
+import stat
+
+import yaml
+
+from gogitit.errors import StatusError
+from gogitit.export import MODE_EXECUTABLE, MODE_SYMLINK, blob_sha
+
+STATUS_FILE = '.gogitit-status.jsonl'
+
+# Status file written by older releases, a YAML dump of destination paths to SHAs:
+LEGACY_STATUS_FILE = '.gogitit-cache.yml'
+
+# Status being written by a sync, renamed to STATUS_FILE once complete:
+TMP_STATUS_FILE = '.gogitit-status.%s.tmp'
+
+FORMAT_VERSION = 2
+
+FileRecord = collections.namedtuple('FileRecord', ['path', 'blob', 'size', 'mtime', 'ino'])
+
+
+class _LegacyLoader(yaml.SafeLoader):
+    """ Safe loader also reading the tags yaml.dump gives unicode strings on Python 2. """
+
+
+_LegacyLoader.add_constructor(u'tag:yaml.org,2002:python/unicode', _LegacyLoader.construct_yaml_str)
+_LegacyLoader.add_constructor(u'tag:yaml.org,2002:python/str', _LegacyLoader.construct_yaml_str)
+
+
+def load(output_dir):
+    """ Load the status of the last sync to output_dir, or None if there is none. """
+    path = os.path.join(output_dir, STATUS_FILE)
+    if os.path.exists(path):
+        return Status.load(path, output_dir)
+    path = os.path.join(output_dir, LEGACY_STATUS_FILE)
+    if os.path.exists(path):
+        return Status.load_legacy(path)
+    return None
+
+
+class Status(object):
+    """
+    Status of the last sync: the manifest SHA, a record of each copy entry keyed by
+    Copy.key, and the commit each top level destination path was synced from.
+    """
+
+    def __init__(self, path=None, manifest_sha=None):
+        self.path = path
+        self.manifest_sha = manifest_sha
+        self.copies = {}
+        self.paths = {}
+        self.output_dir = None
+        # Written by an older release, so no files were recorded:
+        self.legacy = False
+        # Offset of the first file line of each copy written with its files:
+        self._offsets = {}
+        self._records = None
+        self._written = None
+
+    def __str__(self):
+        return "Status<path=%s>" % self.path
+
+    @classmethod
+    def load(cls, path, output_dir):
+        status = cls(path)
+        status.output_dir = output_dir
+        with open(path, 'rb') as f:
+            header = _decode(f.readline())
+            if header.get('gogitit_status') != FORMAT_VERSION:
+                raise StatusError("Unsupported status file format version %s: %s" % (
+                    header.get('gogitit_status'), path))
+            status.manifest_sha = header['manifest_sha']
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                if line.startswith(b'['):
+                    # File lines are read on demand:
+                    continue
+                copy = _decode(line)
+                key = copy.pop('copy')
+                copy['paths'] = [_absolute(p, output_dir) for p in copy['paths']]
+                copy['dirs'] = [_absolute(p, output_dir) for p in copy.get('dirs', [])]
+                if copy.get('indexed'):
+                    status._offsets[key] = f.tell()
+                status.copies[key] = copy
+                for p in copy['paths']:
+                    status.paths[p] = copy['sha']
+        return status
+
+    @classmethod
+    def load_legacy(cls, path):
+        with open(path) as f:
+            data = yaml.load(f, Loader=_LegacyLoader) or {}
+        status = cls(path, data.get('manifest_sha'))
+        status.copies = data.get('copies', {})
+        status.paths = data.get('paths', {})
+        status.legacy = True
+        return status
+
+    def is_indexed(self, key):
+        """ Return True if every file the copy wrote was recorded. """
+        return key in self._offsets
+
+    def files(self, key):
+        """ Yield a FileRecord for each file recorded for the copy with key. """
+        if key not in self._offsets:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offsets[key])
+            for line in f:
+                if not line.startswith(b'['):
+                    break
+                record = FileRecord(*_decode(line))
+                yield record._replace(path=_absolute(record.path, self.output_dir))
+
+    def records(self):
+        """ Return the latest FileRecord for every file recorded, by path. """
+        if self._records is None:
+            self._records = {}
+            self._written = os.stat(self.path).st_mtime if self._offsets else None
+            # Later copies may overwrite files of earlier ones, so read in the order written:
+            for key in sorted(self._offsets, key=self._offsets.get):
+                for record in self.files(key):
+                    self._records[record.path] = record
+        return self._records
+
+    def is_current(self, path, blob):
+        """ Return True if path holds the blob exactly as the last sync wrote it. """
+        record = self.records().get(path)
+        if record is None or record.blob != blob.hexsha:
+            return False
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if stat.S_ISLNK(st.st_mode) != (blob.mode == MODE_SYMLINK):
+            return False
+        if not stat.S_ISLNK(st.st_mode) and bool(st.st_mode & stat.S_IXUSR) != (blob.mode == MODE_EXECUTABLE):
+            return False
+        return self._unchanged(record, st)[0]
+
+    def is_unchanged(self, record):
+        """ Return True if the file of a record still holds the recorded blob. """
+        try:
+            st = os.lstat(record.path)
+        except OSError:
+            return False
+        return self._unchanged(record, st)[0]
+
+    def _unchanged(self, record, st):
+        """
+        Return whether the file of a record, with stat result st, still holds the recorded
+        blob, and whether it was hashed to find out. Like git's index the stat data is
+        trusted unless the file was written too close to the status for its mtime to be.
+        """
+        if (st.st_size, st.st_mtime, st.st_ino) == (record.size, record.mtime, record.ino) and \
+                record.mtime < self._written:
+            return True, False
+        if st.st_size != record.size or not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+            return False, False
+        return blob_sha(record.path) == record.blob, True
+
+    def verify(self):
+        """
+        Compare the output dir against the files recorded at the last sync, the way git
+        compares a work tree to its index. Only files whose stat data changed are hashed.
+        Returns a sorted list of (change, path) tuples, change being one of Modified,
+        Missing or Unexpected, the number of files checked and the number hashed.
+        """
+        records = self.records()
+        changes = []
+        hashed = 0
+        for path in sorted(records):
+            try:
+                st = os.lstat(path)
+            except OSError:
+                changes.append(('Missing', path))
+                continue
+            unchanged, was_hashed = self._unchanged(records[path], st)
+            hashed += was_hashed
+            if not unchanged:
+                changes.append(('Modified', path))
+
+        # Anything else within a directory a copy rebuilds would be deleted by a sync:
+        dirs = set(d for key in self._offsets for d in self.copies[key]['dirs'])
+        ignore = set(os.path.join(self.output_dir, name) for name in (STATUS_FILE, LEGACY_STATUS_FILE))
+        unexpected = set()
+        for root in dirs:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                    path = os.path.join(dirpath, name)
+                    if path not in records and path not in ignore and not _is_tmp(path, self.output_dir):
+                        unexpected.add(path)
+        changes.extend(('Unexpected', path) for path in sorted(unexpected))
+        return changes, len(records), hashed
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+class StatusWriter(object):
+    """
+    Streams a new status file to a temporary file in the output dir, which replaces the
+    previous status on close(). Each copy must be added before the files it wrote.
+    """
+
+    def __init__(self, output_dir, manifest_sha):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, STATUS_FILE)
+        # A copy to the top level of the output dir deletes it before rebuilding:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        # Created like any other file so the umask applies:
+        self.tmp_path = os.path.join(output_dir, TMP_STATUS_FILE % os.getpid())
+        self.f = os.fdopen(os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), 'wb')
+        self._write({'gogitit_status': FORMAT_VERSION, 'manifest_sha': manifest_sha})
+
+    def __str__(self):
+        return "StatusWriter<path=%s>" % self.path
+
+    def _write(self, data):
+        self.f.write(json.dumps(data, separators=(',', ':')).encode('utf-8') + b'\n')
+
+    def add_copy(self, key, copy, indexed=True):
+        """ Add the record of a copy entry, with its top level destination paths. """
+        copy = dict(copy)
+        copy['copy'] = key
+        copy['paths'] = [_relative(p, self.output_dir) for p in copy['paths']]
+        copy['dirs'] = [_relative(p, self.output_dir) for p in copy.get('dirs', [])]
+        copy['indexed'] = indexed
+        self._write(copy)
+
+    def add_file(self, path, blob, size=None, mtime=None, ino=None):
+        """ Add a file written by the last copy added, its stat data defaults to that on disk. """
+        if size is None:
+            st = os.lstat(path)
+            size, mtime, ino = st.st_size, st.st_mtime, st.st_ino
+        self._write([_relative(path, self.output_dir), blob, size, mtime, ino])
+
+    def close(self):
+        """ Replace the previous status, of either format, with the one written. """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.rename(self.tmp_path, self.path)
+        legacy_path = os.path.join(self.output_dir, LEGACY_STATUS_FILE)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+    def abort(self):
+        """ Discard the status written, leaving the previous status in place. """
+        self.f.close()
+        os.remove(self.tmp_path)
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+def _is_tmp(path, output_dir):
+    """ Return True if path is the temporary file of a status being written. """
+    prefix, suffix = TMP_STATUS_FILE.split('%s')
+    name = os.path.basename(path)
+    return os.path.dirname(path) == output_dir.rstrip(os.sep) and name.startswith(prefix) and name.endswith(suffix)
+
+
+def _decode(line):
+    return json.loads(line.decode('utf-8'))
+
+
+def _relative(path, output_dir):
+    """ Strip the output dir from path, so it loads as the same string from any output dir. """
+    if path == output_dir:
+        return ''
+    prefix = os.path.join(output_dir, '')
+    if path.startswith(prefix):
+        return path[len(prefix):]
+    return path
+
+
+def _absolute(path, output_dir):
+    if path == '':
+        return output_dir
+    return os.path.join(output_dir, path)
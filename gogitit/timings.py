@@ -0,0 +1,131 @@
+"""Records where the time of a run goes, and profiles it."""
+
+import contextlib
+import cProfile
+import pstats
+import threading
+import time
+
+from gogitit.cache import format_size
+
+
+class Timings(object):
+    """
+    Wall time of each phase of a run, such as fetching a repo or writing the files of a
+    copy entry, with the number of files and bytes it wrote where it writes any. Phases
+    may be timed from several threads at once.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        # Dicts of phase, key identifying the repo or copy entry, seconds, files and bytes:
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "Timings<phases=%s>" % len(self.phases)
+
+    @contextlib.contextmanager
+    def phase(self, name, key=None):
+        """
+        Time the block within, which can set 'files' and 'bytes' on the dict it is given.
+        The phase is only recorded if the block completes.
+        """
+        record = {'phase': name, 'key': key, 'files': None, 'bytes': None}
+        start = time.time()
+        yield record
+        record['seconds'] = time.time() - start
+        with self._lock:
+            self.phases.append(record)
+
+    def stop(self):
+        self.end = time.time()
+
+    def total(self):
+        return (self.end or time.time()) - self.start
+
+    def summary(self):
+        """ Return the total seconds, files and bytes of each phase, in the order first run. """
+        totals = []
+        by_name = {}
+        for record in self.phases:
+            if record['phase'] not in by_name:
+                by_name[record['phase']] = {'phase': record['phase'], 'count': 0, 'seconds': 0, 'files': None,
+                                            'bytes': None}
+                totals.append(by_name[record['phase']])
+            total = by_name[record['phase']]
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            for field in ('files', 'bytes'):
+                if record[field] is not None:
+                    total[field] = (total[field] or 0) + record[field]
+        return totals
+
+    def to_json(self):
+        return {'total_seconds': self.total(), 'summary': self.summary(), 'phases': self.phases}
+
+    def table(self, slowest=10):
+        """
+        Return lines of a table of the time spent in each phase, followed by the slowest
+        repos and copy entries. Phases run in parallel, so may add up to more than the total.
+        """
+        lines = ["%-14s %6s %9s %8s %9s" % ("Phase", "Count", "Seconds", "Files", "Bytes")]
+        for total in self.summary():
+            line = "%-14s %6s %9.3f %8s %9s" % (
+                total['phase'], total['count'], total['seconds'], _blank(total['files']),
+                '' if total['bytes'] is None else format_size(total['bytes']))
+            lines.append(line.rstrip())
+        lines.append("%-14s %6s %9.3f" % ("total", "", self.total()))
+
+        keyed = sorted([record for record in self.phases if record['key']], key=lambda r: -r['seconds'])
+        if keyed:
+            lines.append("")
+            lines.append("Slowest:")
+            for record in keyed[:slowest]:
+                lines.append("%-14s %9.3f  %s" % (record['phase'], record['seconds'], record['key']))
+        return lines
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+def _blank(value):
+    return '' if value is None else value
+
+
+class Profiler(object):
+    """
+    Profiles every thread started while running, not only the main thread as cProfile
+    alone would, then writes the combined statistics for pstats, snakeviz and the like.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "Profiler<threads=%s>" % len(self.profiles)
+
+    def _start_thread(self, frame, event, arg):
+        # Called in each new thread, replaced with the thread's own profile once enabled:
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        profile.enable()
+
+    def stop(self, path):
+        """ Stop profiling, and write the statistics of all threads to path. """
+        threading.setprofile(None)
+        self.profiles[0].disable()
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(path)
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
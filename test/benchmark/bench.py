@@ -0,0 +1,232 @@
+"""
+Benchmarks gogitit against generated local repos, so runs need no network access and
+are comparable from one run to the next.
+
+Generates repos at the scale requested, then times a sync into an empty cache and
+output dir, a sync with nothing to do, a sync after one file changed in one repo,
+and a check. Results are written as JSON, and compared against a previous run
+with --baseline:
+
+    python test/benchmark/bench.py --repos 10 --files 1000 --output results.json
+    python test/benchmark/bench.py --repos 10 --files 1000 --baseline results.json
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+# Written to results, bumped when they change incompatibly:
+RESULTS_VERSION = 1
+
+SCENARIOS = ['cold_sync', 'noop_sync', 'one_file_sync', 'check']
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def generate_repo(path, files, history, dirs=10):
+    """
+    Create a bare repo at path with history commits on master, the first adding all
+    files and each later one changing a few. Files are spread over roles within
+    dirs roles, with every tenth a playbook. Written with git fast-import, as
+    committing through a work tree is far too slow at scale.
+    """
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+    stream = []
+    for i in range(history):
+        changed = range(files) if i == 0 else [(i * 7 + n) % files for n in range(min(5, files))]
+        stream.append(_commit(i + 1, ['M 100644 inline %s\ndata <<EOF\n%s\nEOF' % (
+            _file_path(n, dirs), _content(n, i)) for n in changed]))
+    _fast_import(path, stream)
+
+
+def change_file(path, revision):
+    """ Commit a change to one file on master of a generated repo. """
+    _fast_import(path, [_commit(revision, ['M 100644 inline %s\ndata <<EOF\n%s\nEOF' % (
+        _file_path(0, 1), _content(0, revision))], 'refs/heads/master^0')])
+
+
+def _file_path(n, dirs):
+    if n % 10 == 9:
+        return 'playbooks/playbook%s.yml' % n
+    return 'roles/role%s/tasks/task%s.yml' % (n % dirs, n)
+
+
+def _content(n, revision):
+    return '---\n- name: task %s revision %s\n  debug:\n    msg: "%s"\n' % (n, revision, 'x' * (n % 200))
+
+
+def _commit(revision, changes, parent=None):
+    """ Return a commit for git fast-import, following the last on the branch unless given a parent. """
+    return '\n'.join([
+        'commit refs/heads/master',
+        'committer Benchmark <bench@example.com> %s +0000' % (1500000000 + revision),
+        'data <<EOF\nRevision %s\nEOF' % revision,
+    ] + (['from %s' % parent] if parent else []) + changes) + '\n'
+
+
+def _fast_import(path, stream):
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    process.communicate('\n'.join(stream).encode('utf-8'))
+    if process.returncode:
+        raise click.ClickException("git fast-import failed in %s" % path)
+
+
+def write_manifest(path, urls, globs):
+    """ Write a manifest syncing every repo into its own directory of the output dir. """
+    lines = ['---', 'output_dir: ./output', 'repos:']
+    for i, url in enumerate(urls):
+        lines += ['- url: %s' % url, '  version: master', '  copy:']
+        if globs:
+            lines += ['  - src: roles/role*', '    dst: repo%s/roles' % i,
+                      '  - src: playbooks/*.yml', '    dst: repo%s/playbooks/' % i]
+        else:
+            lines += ['  - src: roles', '    dst: repo%s/roles' % i,
+                      '  - src: playbooks', '    dst: repo%s/playbooks' % i]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+class Benchmark(object):
+    """ Runs gogitit in a work dir of generated repos, timing each command. """
+
+    def __init__(self, work_dir, manifest_path, gogitit_args, log):
+        self.work_dir = work_dir
+        self.manifest_path = manifest_path
+        self.cache_dir = os.path.join(work_dir, 'cache')
+        self.output_dir = os.path.join(work_dir, 'output')
+        self.gogitit_args = gogitit_args
+        self.log = log
+
+    def __str__(self):
+        return "Benchmark<work_dir=%s>" % self.work_dir
+
+    def run(self, command, *args):
+        """ Run a gogitit command in a new process, returning the seconds it took. """
+        cmd = [sys.executable, '-m', 'gogitit.cli', command, '-m', self.manifest_path,
+               '--cache-dir', self.cache_dir, '-o', self.output_dir] + list(args)
+        if command == 'sync':
+            cmd += self.gogitit_args
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT_DIR] + [os.environ.get('PYTHONPATH', '')]))
+        self.log.write('$ %s\n' % ' '.join(cmd))
+        self.log.flush()
+        start = time.time()
+        returncode = subprocess.call(cmd, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+        if returncode:
+            raise click.ClickException("gogitit %s failed with status %s, see %s" % (
+                command, returncode, self.log.name))
+        return elapsed
+
+    def reset(self):
+        for path in (self.cache_dir, self.output_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    # Alias __repr__ to __str__
+    __repr__ = __str__
+
+
+def summarize(runs):
+    ordered = sorted(runs)
+    return {'runs': runs, 'min': ordered[0], 'median': ordered[len(ordered) // 2]}
+
+
+def git_revision():
+    """ Return the commit of gogitit benchmarked, or None outside a git checkout. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--repos', default=5, type=click.IntRange(1), help="Number of repos to generate.")
+@click.option('--files', default=200, type=click.IntRange(1), help="Number of files in each repo.")
+@click.option('--history', default=10, type=click.IntRange(1), help="Number of commits in each repo.")
+@click.option('--globs/--no-globs', default=True,
+              help="Copy with glob patterns matching every role, or whole directories.")
+@click.option('--repeat', default=3, type=click.IntRange(1), help="Number of times each scenario is timed.")
+@click.option('--work-dir', default=None, type=click.Path(file_okay=False),
+              help="Directory to generate repos and sync in, kept afterwards. Defaults to a temporary dir.")
+@click.option('--output', default=None, type=click.Path(dir_okay=False),
+              help="File to write results to as JSON, printed if not given.")
+@click.option('--baseline', default=None, type=click.File('r'),
+              help="Results of an earlier run to compare against.")
+@click.argument('gogitit_args', nargs=-1)
+def main(repos, files, history, globs, repeat, work_dir, output, baseline, gogitit_args):
+    """Time gogitit commands against generated local repos. GOGITIT_ARGS are passed to sync."""
+    keep = work_dir is not None
+    if keep:
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        work_dir = os.path.abspath(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='gogitit-bench-')
+
+    try:
+        click.echo("Generating %s repos of %s files, %s commits each in: %s" % (repos, files, history, work_dir),
+                   err=True)
+        urls = []
+        for i in range(repos):
+            path = os.path.join(work_dir, 'repos', 'repo%s.git' % i)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            generate_repo(path, files, history)
+            urls.append('file://' + path)
+        manifest_path = os.path.join(work_dir, 'gogitit.yml')
+        write_manifest(manifest_path, urls, globs)
+
+        with open(os.path.join(work_dir, 'bench.log'), 'w') as log:
+            bench = Benchmark(work_dir, manifest_path, list(gogitit_args), log)
+            timings = dict((scenario, []) for scenario in SCENARIOS)
+            for i in range(repeat):
+                bench.reset()
+                timings['cold_sync'].append(bench.run('sync'))
+                timings['noop_sync'].append(bench.run('sync'))
+                change_file(urls[0][len('file://'):], history + i + 1)
+                timings['one_file_sync'].append(bench.run('sync'))
+                timings['check'].append(bench.run('check'))
+                click.echo("Run %s: %s" % (i + 1, ', '.join(
+                    "%s %.2fs" % (scenario, timings[scenario][-1]) for scenario in SCENARIOS)), err=True)
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir)
+
+    results = {
+        'gogitit_benchmark': RESULTS_VERSION,
+        'time': time.time(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'git': subprocess.check_output(['git', '--version']).decode('utf-8').strip(),
+        'params': {'repos': repos, 'files': files, 'history': history, 'globs': globs, 'repeat': repeat,
+                   'gogitit_args': list(gogitit_args)},
+        'results': dict((scenario, summarize(timings[scenario])) for scenario in SCENARIOS),
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        click.echo(json.dumps(results, indent=2, sort_keys=True))
+
+    if baseline:
+        previous = json.load(baseline)
+        if previous['params'] != results['params']:
+            click.echo("Warning: baseline was run with different parameters: %s" % previous['params'], err=True)
+        click.echo("\nMedian seconds against baseline %s:" % (previous.get('revision') or baseline.name), err=True)
+        for scenario in SCENARIOS:
+            before = previous['results'][scenario]['median']
+            after = results['results'][scenario]['median']
+            click.echo("  %-14s %8.2f %8.2f  %+.0f%%" % (
+                scenario, before, after, (after - before) / before * 100 if before else 0), err=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+""" Tests for the library API. """
+
+import os.path
+
+import gogitit
+import gogitit.api
+import gogitit.manifest
+
+import fixture
+
+
+class ApiTests(fixture.IntegrationFixture):
+
+    def setUp(self):
+        fixture.IntegrationFixture.setUp(self)
+        self.progress = []
+        self.session = gogitit.Session(self.cache_dir, progress=self.progress.append)
+        self.sync_dir = os.path.join(self.output_dir, 'synced')
+        self.url = self.create_repo('roles', {'roles/one/tasks/main.yml': 'one\n'})
+
+    def tearDown(self):
+        self.session.close()
+        fixture.IntegrationFixture.tearDown(self)
+
+    def _manifest(self, src='roles/one'):
+        return self.write_manifest("""---
+output_dir: ./synced
+repos:
+- url: %s
+  version: master
+  copy:
+  - src: %s
+    dst: roles/one
+""" % (self.url, src))
+
+    def test_sync_check_plan(self):
+        manifest_path = self._manifest()
+        result = self.session.sync(manifest_path)
+        self.assertEqual(self.sync_dir, result.output_dir)
+        self.assertEqual(['%s:roles/one -> roles/one' % self.url], result.rebuilt)
+        self.assertEqual(1, result.files_written)
+        self.assertTrue(os.path.exists(os.path.join(self.sync_dir, 'roles/one/tasks/main.yml')))
+        self.assertTrue("Copy: %s:roles/one -> roles/one (1 files)" % self.url in self.progress)
+        repo_cache = list(self.session.repo_caches.values())[0]
+        git_repo = repo_cache.git_repo
+
+        check = self.session.check(manifest_path)
+        self.assertFalse(check.sync_required)
+
+        # A second sync reuses the open repo cache, and has nothing to do:
+        result = self.session.sync(manifest_path)
+        self.assertEqual([], result.rebuilt)
+        self.assertEqual(1, len(result.unchanged))
+        self.assertTrue(list(self.session.repo_caches.values())[0].git_repo is git_repo)
+        self.assertEqual(None, repo_cache.lock.fd)
+
+        self.create_repo('roles', {'roles/one/tasks/main.yml': 'changed\n'})
+        check = self.session.check(manifest_path)
+        self.assertTrue(check.sync_required)
+        self.assertEqual(gogitit.manifest.CHECK_STATUS_SHA_CHANGED, check.status)
+        self.assertEqual(["Commit changed for repo %s, sync is required." % self.url], check.reasons)
+
+        plan = self.session.plan(manifest_path)
+        self.assertEqual([('%s:roles/one -> roles/one' % self.url, 'delta')], plan.copies)
+        self.assertEqual([('Update', os.path.join(self.sync_dir, 'roles/one/tasks/main.yml'),
+                           '%s:roles/one -> roles/one' % self.url)], plan.changes)
+
+    def test_errors(self):
+        with self.assertRaises(gogitit.RepoError) as context:
+            self.session.sync(self._manifest('roles/missing'))
+        self.assertTrue(isinstance(list(context.exception.failures.values())[0], gogitit.ManifestError))
+        self.assertFalse(os.path.exists(self.sync_dir))
+
+        self.write_manifest("---\noutput_dir:\nrepos: []\n")
+        self.assertRaises(gogitit.ManifestError, gogitit.api.check, os.path.join(self.output_dir, 'manifest.yml'),
+                          cache_dir=self.cache_dir)
@@ -0,0 +1,25 @@
+""" Smoke test for the benchmark harness, at the smallest scale. """
+
+import json
+import os
+
+from click.testing import CliRunner
+
+import fixture
+from test.benchmark import bench
+
+
+class BenchmarkTests(fixture.IntegrationFixture):
+
+    def test_results(self):
+        results_path = os.path.join(self.output_dir, 'results.json')
+        result = CliRunner().invoke(bench.main, [
+            '--repos', '2', '--files', '12', '--history', '2', '--repeat', '1',
+            '--work-dir', self.cache_dir, '--output', results_path])
+        self.debug_result(result)
+        self.assertEqual(0, result.exit_code)
+        with open(results_path) as f:
+            results = json.load(f)
+        self.assertEqual(sorted(bench.SCENARIOS), sorted(results['results']))
+        self.assertEqual(1, len(results['results']['cold_sync']['runs']))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'output/repo1/playbooks/playbook9.yml')))
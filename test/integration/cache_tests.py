@@ -0,0 +1,75 @@
+""" Tests for the gogitit cache CLI commands. """
+
+import os.path
+import shutil
+
+import fixture
+
+
+class CacheTests(fixture.IntegrationFixture):
+
+    def test_list_gc_prune(self):
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        # The repo cache in use is never removed to fit the size limit:
+        result = self._run_sync(manifest, '--cache-max-size', '1')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Removed 0 repo caches" in result.output)
+        repo_dir = os.path.join(self.cache_dir, 'github.com/dgoodwin/gogitit-test')
+
+        result = self._run_cache('list')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("https://github.com/dgoodwin/gogitit-test.git\n  Path: %s" % repo_dir in result.output)
+        self.assertTrue("1 repo caches totalling" in result.output)
+
+        result = self._run_cache('gc', '--interval', '3600')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Garbage collected 0 of 1 repo caches." in result.output)
+        result = self._run_cache('gc')
+        self.assertTrue("Garbage collected 1 of 1 repo caches." in result.output)
+
+        result = self._run_cache('prune')
+        self.assertEqual(2, result.exit_code)
+        result = self._run_cache('prune', '--unused-days', '0')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Removed 1 of 1 repo caches" in result.output)
+        self.assertFalse(os.path.exists(repo_dir))
+
+        # Cloned again on next use:
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue(os.path.exists(repo_dir))
+
+    def test_bundle_seeds_cache_offline(self):
+        url = self.create_repo('upstream', {'roles/role1/tasks/main.yml': 'v1\n'}, tag='v1')
+        manifest = """---
+output_dir: ./
+repos:
+- url: %s
+  version: v1
+  copy:
+  - src: roles/
+    dst: roles
+""" % url
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        manifest_path = self.write_manifest(manifest)
+        bundle_dir = os.path.join(self.output_dir, 'bundles')
+        result = self._run_cache('export-bundle', '-m', manifest_path, bundle_dir)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Wrote 1 of 1 bundles" in result.output)
+
+        # A fresh host seeded from the bundle syncs without the remote:
+        shutil.rmtree(self.cache_dir)
+        result = self._run_cache('import-bundle', '-m', manifest_path, bundle_dir)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Imported 1 of 1 repo caches" in result.output)
+        shutil.rmtree(url[len('file://'):])
+        shutil.rmtree(os.path.join(self.output_dir, 'roles'))
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("All versions present in cache, skipping fetch." in result.output)
+        with open(os.path.join(self.output_dir, 'roles/role1/tasks/main.yml')) as f:
+            self.assertEqual('v1\n', f.read())
+
+        result = self._run_cache('import-bundle', '-m', manifest_path, bundle_dir)
+        self.assertTrue("Already cached, not imported" in result.output)
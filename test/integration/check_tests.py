@@ -2,31 +2,33 @@
 
 import os
 import os.path
+import shutil
 
 import yaml
 
 import fixture
 import gogitit.manifest
+import gogitit.status
 from gogitit import cli
+from gogitit.lock import CacheLock
 
 
 class CheckTests(fixture.IntegrationFixture):
 
     def _load_status(self):
-        status = yaml.load(open(os.path.join(self.output_dir, cli.CACHE_FILE)))
-        return status
+        return gogitit.status.load(self.output_dir)
 
     def test_no_changes(self):
         manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
         result = self._run_sync(manifest)
         self.assertEqual(0, result.exit_code)
-        self.assertTrue(os.path.exists(os.path.join(self.output_dir, cli.CACHE_FILE)))
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, cli.STATUS_FILE)))
         status = self._load_status()
-        self.assertTrue('manifest_sha' in status)
+        self.assertTrue(status.manifest_sha)
 
         # This SHA matches the tag for v0.2:
         self.assertEqual('3bc5b2de2dcd73402f968ddbb7d15687fb9d1bb5',
-                status['paths'][os.path.join(self.output_dir, 'playbook1.yml')])
+                status.paths[os.path.join(self.output_dir, 'playbook1.yml')])
         result = self._run_check(manifest)
         self.assertEqual(0, result.exit_code)
 
@@ -34,7 +36,7 @@ class CheckTests(fixture.IntegrationFixture):
         manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
         result = self._run_sync(manifest)
         self.assertEqual(0, result.exit_code)
-        os.remove(os.path.join(self.output_dir, cli.CACHE_FILE))
+        os.remove(os.path.join(self.output_dir, cli.STATUS_FILE))
 
         result = self._run_check(manifest)
         self.assertEqual(gogitit.manifest.CHECK_STATUS_NO_STATUS_FILE, result.exit_code)
@@ -59,14 +61,204 @@ class CheckTests(fixture.IntegrationFixture):
         self.assertEqual(0, result.exit_code)
 
         # Edit the last status to appear as if it's an older commit:
+        status_path = os.path.join(self.output_dir, cli.STATUS_FILE)
+        synced_sha = list(self._load_status().copies.values())[0]['sha']
+        with open(status_path) as f:
+            content = f.read()
+        with open(status_path, 'w') as f:
+            f.write(content.replace(synced_sha, '3bc5b2de2dcd73402f968ddbb7d15687fb9d1bb5'))
+
+        result = self._run_check(manifest)
+        self.assertEqual(gogitit.manifest.CHECK_STATUS_SHA_CHANGED, result.exit_code)
+
+    def test_legacy_status_file(self):
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # Replace the status with the YAML written by older releases, tagging the
+        # unicode SHAs GitPython gives on Python 2:
         status = self._load_status()
-        for k in status['paths']:
-            status['paths'][k] = u'3bc5b2de2dcd73402f968ddbb7d15687fb9d1bb5'
-        f = open(os.path.join(self.output_dir, cli.CACHE_FILE), 'w')
-        f.write(yaml.dump(status))
-        f.close()
+        os.remove(os.path.join(self.output_dir, cli.STATUS_FILE))
+        legacy_path = os.path.join(self.output_dir, gogitit.status.LEGACY_STATUS_FILE)
+        legacy = "manifest_sha: %s\npaths:\n" % status.manifest_sha + "".join(
+            "  %s: !!python/unicode '%s'\n" % (k, v) for k, v in status.paths.items())
+        with open(legacy_path, 'w') as f:
+            f.write("unsafe: !!python/name:os.getcwd ''\n" + legacy)
+        # Tags constructing anything else are refused:
+        result = self._run_check(manifest)
+        self.assertEqual(1, result.exit_code)
+        self.assertTrue(isinstance(result.exception, yaml.constructor.ConstructorError))
+
+        with open(legacy_path, 'w') as f:
+            f.write(legacy)
+        result = self._run_check(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # The next sync replaces it:
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, cli.STATUS_FILE)))
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, gogitit.status.LEGACY_STATUS_FILE)))
 
+    def test_shared_dest_dir(self):
+        first = self.create_repo('first', {'conf/x.yml': 'first\n'})
+        second = self.create_repo('second', {'conf/x.yml': 'second\n'})
+        manifest = "---\noutput_dir: %s\nrepos:\n" % self.output_dir + "".join(
+            "- url: %s\n  version: master\n  copy:\n  - src: conf/*\n    dst: merged/\n" % url
+            for url in (first, second))
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # The file is recorded with the commit of the second repo, which wrote it last:
+        result = self._run_check(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        self.create_repo('first', {'conf/x.yml': 'first 2\n'})
         result = self._run_check(manifest)
         self.assertEqual(gogitit.manifest.CHECK_STATUS_SHA_CHANGED, result.exit_code)
 
+    def test_no_fetch(self):
+        manifest = self.build_manifest_str('master', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # Versions are resolved with ls-remote, the cache is not needed:
+        shutil.rmtree(self.cache_dir)
+        result = self._run_check(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertFalse(os.path.exists(self.cache_dir))
+        os.makedirs(self.cache_dir)
+
+    def test_fetch(self):
+        manifest = self.build_manifest_str('master', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        result = self._run_check(manifest, '--fetch')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Fetching refs: refs/heads/master" in result.output)
+
+    def test_max_age(self):
+        manifest = self.build_manifest_str('master', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        result = self._run_check(manifest, '--max-age', '3600')
+        self.assertEqual(0, result.exit_code)
+        self.assertFalse("Listing remote refs." in result.output)
 
+    def test_refs_recorded(self):
+        url = self.create_repo('roles', {'roles/one/tasks/main.yml': 'one\n'})
+        manifest = "---\noutput_dir: %s\nrepos:\n- url: %s\n  version: master\n  copy:\n" \
+            "  - src: roles/one\n    dst: roles/one\n" % (self.output_dir, url)
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        repo_dir = os.path.join(self.cache_dir, gogitit.manifest.repo_url_to_dir(url))
+        meta_path = os.path.join(repo_dir, gogitit.manifest.CACHE_META_FILE)
+        with open(meta_path) as f:
+            meta = f.read()
+
+        # Not waiting for another process fetching into the cache, which records refs itself:
+        lock = CacheLock(repo_dir + '.fetch.lock')
+        lock.acquire(True)
+        try:
+            result = self._run_check(manifest, '--lock-timeout', '0')
+        finally:
+            lock.release()
+        self.assertEqual(0, result.exit_code)
+        with open(meta_path) as f:
+            self.assertEqual(meta, f.read())
+
+        result = self._run_check(manifest)
+        self.assertEqual(0, result.exit_code)
+        with open(meta_path) as f:
+            self.assertNotEqual(meta, f.read())
+
+    def test_manifest_comment_ignored(self):
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        result = self._run_check("# A comment.\n" + manifest)
+        self.assertEqual(0, result.exit_code)
+
+    def test_manifest_entry_changes(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('playbooks/playbook1.yml', 'playbook1.yml'),
+            ('roles', 'roles'),
+        ])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        manifest = self.build_manifest_str('v0.2', [
+            ('playbooks/playbook1.yml', 'playbook1.yml'),
+            ('roles/dummyrole1', 'roles/dummyrole1'),
+        ])
+        result = self._run_check(manifest)
+        self.assertEqual(gogitit.manifest.CHECK_STATUS_MANIFEST_CHANGED, result.exit_code)
+        self.assertTrue("Added: https://github.com/dgoodwin/gogitit-test.git:roles/dummyrole1 -> roles/dummyrole1"
+                        in result.output)
+        self.assertTrue("Removed: https://github.com/dgoodwin/gogitit-test.git:roles -> roles" in result.output)
+        self.assertFalse("playbook1.yml" in result.output)
+
+    def test_verify_unchanged(self):
+        manifest = self.build_manifest_str('v0.2', [('roles', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        result = self._run_check(manifest, '--verify')
+        self.assertEqual(0, result.exit_code)
+
+        # Stat data changed, but the content did not:
+        path = os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+        os.utime(path, (0, 0))
+        result = self._run_check(manifest, '--verify')
+        self.assertEqual(0, result.exit_code)
+        self.assertFalse("Modified:" in result.output)
+
+    def test_verify_output_changed(self):
+        manifest = self.build_manifest_str('v0.2', [('roles', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        modified = os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+        with open(modified, 'a') as f:
+            f.write('# Edited\n')
+        missing = os.path.join(self.output_dir, 'roles/dummyrole2/tasks/main.yml')
+        os.remove(missing)
+        unexpected = os.path.join(self.output_dir, 'roles/dummyrole2/tasks/extra.yml')
+        with open(unexpected, 'w') as f:
+            f.write('---\n')
+
+        # Files outside the directories gogitit writes are not its concern:
+        with open(os.path.join(self.output_dir, 'other.yml'), 'w') as f:
+            f.write('---\n')
+
+        result = self._run_check(manifest, '--verify')
+        self.assertEqual(gogitit.manifest.CHECK_STATUS_OUTPUT_CHANGED, result.exit_code)
+        self.assertTrue("Modified: %s" % modified in result.output)
+        self.assertTrue("Missing: %s" % missing in result.output)
+        self.assertTrue("Unexpected: %s" % unexpected in result.output)
+        self.assertFalse("other.yml" in result.output)
+
+    def test_verify_repaired_by_sync(self):
+        url = self.create_repo('roles', {'roles/one/tasks/main.yml': 'one\n', 'roles/two/tasks/main.yml': 'two\n'})
+        manifest = "---\noutput_dir: %s\nrepos:\n- url: %s\n  version: master\n  copy:\n" \
+            "  - src: roles\n    dst: roles\n" % (self.output_dir, url)
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        modified = os.path.join(self.output_dir, 'roles/one/tasks/main.yml')
+        with open(modified, 'a') as f:
+            f.write('# Edited\n')
+        os.remove(os.path.join(self.output_dir, 'roles/two/tasks/main.yml'))
+        result = self._run_check(manifest, '--verify')
+        self.assertEqual(gogitit.manifest.CHECK_STATUS_OUTPUT_CHANGED, result.exit_code)
+
+        # A plain sync rewrites the copy with files changed since the last:
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("rebuilt 1." in result.output)
+        with open(modified) as f:
+            self.assertEqual('one\n', f.read())
+        result = self._run_check(manifest, '--verify')
+        self.assertEqual(0, result.exit_code)
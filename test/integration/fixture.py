@@ -5,6 +5,8 @@ import shutil
 import tempfile
 import unittest
 
+import git
+
 from gogitit import cli
 from click.testing import CliRunner
 
@@ -26,6 +28,28 @@ class IntegrationFixture(unittest.TestCase):
         shutil.rmtree(self.output_dir)
         shutil.rmtree(self.cache_dir)
 
+    def create_repo(self, name, files, tag=None):
+        """ Create a local repo committing files, a map of path to content, optionally
+        tagging the commit. Returns its file:// URL. Cleaned up with the output dir. """
+        repo_dir = os.path.join(self.output_dir, 'repos', name)
+        if os.path.exists(repo_dir):
+            git_repo = git.Repo(repo_dir)
+        else:
+            git_repo = git.Repo.init(repo_dir, mkdir=True)
+            git_repo.git.config('user.name', 'Test')
+            git_repo.git.config('user.email', 'test@example.com')
+        for path, content in files.items():
+            full_path = os.path.join(repo_dir, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'w') as f:
+                f.write(content)
+        git_repo.git.add('--all')
+        git_repo.git.commit('-m', 'Commit %s' % ', '.join(sorted(files)))
+        if tag:
+            git_repo.git.tag(tag)
+        return 'file://' + repo_dir
+
     def write_manifest(self, manifest_str):
         """ Writes a test manifest to output_dir/manifest.yml. Will be cleaned up automatically
         with the directory itself. """
@@ -35,22 +59,50 @@ class IntegrationFixture(unittest.TestCase):
         manifest_file.close()
         return manifest_path
 
-    def _run_check(self, manifest, output_dir=None):
+    def _run_check(self, manifest, *extra_args):
         manifest_path = self.write_manifest(manifest)
         runner = CliRunner()
         args = ['check', '-m', manifest_path,
-            "--cache-dir", self.cache_dir]
-        if output_dir:
-            args = args.extend(["-o", output_dir])
+            "--cache-dir", self.cache_dir] + list(extra_args)
         result = runner.invoke(cli.main, args)
         self.debug_result(result)
         return result
 
-    def _run_sync(self, manifest):
+    def _run_sync(self, manifest, *extra_args):
         manifest_path = self.write_manifest(manifest)
         runner = CliRunner()
         result = runner.invoke(cli.main, ['sync', '-m', manifest_path, "-o", self.output_dir,
-            "--cache-dir", self.cache_dir])
+            "--cache-dir", self.cache_dir] + list(extra_args))
+        self.debug_result(result)
+        return result
+
+    def _run_plan(self, manifest, *extra_args):
+        manifest_path = self.write_manifest(manifest)
+        # Keep stderr apart, so --json output can be parsed:
+        runner = CliRunner(mix_stderr=False)
+        result = runner.invoke(cli.main, ['plan', '-m', manifest_path, "-o", self.output_dir,
+            "--cache-dir", self.cache_dir] + list(extra_args))
+        self.debug_result(result)
+        return result
+
+    def _run_sync_targets(self, manifest, *extra_args):
+        """ Sync without overriding the output dir, which each target of the manifest sets. """
+        manifest_path = self.write_manifest(manifest)
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ['sync', '-m', manifest_path, "--cache-dir", self.cache_dir] +
+                               list(extra_args))
+        self.debug_result(result)
+        return result
+
+    def _run_sync_all(self, *args):
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ['sync-all', "--cache-dir", self.cache_dir] + list(args))
+        self.debug_result(result)
+        return result
+
+    def _run_cache(self, *args):
+        runner = CliRunner()
+        result = runner.invoke(cli.main, ['cache', args[0], "--cache-dir", self.cache_dir] + list(args[1:]))
         self.debug_result(result)
         return result
 
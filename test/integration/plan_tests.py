@@ -0,0 +1,57 @@
+""" Tests for the gogitit plan CLI command. """
+
+import json
+import os
+import os.path
+
+import fixture
+
+
+class PlanTests(fixture.IntegrationFixture):
+
+    def test_nothing_written(self):
+        manifest = self.build_manifest_str('v0.2', [('roles/', 'roles')])
+        result = self._run_plan(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Rebuild: " in result.output)
+        self.assertTrue("Add: %s" % os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+                        in result.output)
+        self.assertEqual(['manifest.yml'], os.listdir(self.output_dir))
+
+    def test_json(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('roles/', 'roles'),
+            ('playbooks/playbook1.yml', 'playbook1.yml'),
+        ])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_plan(manifest, '--json')
+        self.assertEqual(0, result.exit_code)
+        plan = json.loads(result.stdout)
+        self.assertEqual(['unchanged'], [copy['action'] for copy in plan['copies']])
+        self.assertEqual(set(['remove']), set(change['change'] for change in plan['changes']))
+        self.assertEqual(1, plan['summary']['unchanged'])
+        self.assertEqual(len(plan['changes']), plan['summary']['remove'])
+
+        # Nothing was pruned:
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')))
+
+    def test_conflict(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('playbooks/playbook1.yml', 'main.yml'),
+            ('roles/dummyrole1/tasks/main.yml', 'main.yml'),
+        ])
+        result = self._run_plan(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Conflict: %s" % os.path.join(self.output_dir, 'main.yml') in result.output)
+
+    def test_file_and_directory_conflict(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('playbooks/playbook1.yml', 'roles/dummyrole1'),
+            ('roles/', 'roles'),
+        ])
+        result = self._run_plan(manifest)
+        self.assertEqual(1, result.exit_code)
+        self.assertTrue("is a file from" in result.stderr)
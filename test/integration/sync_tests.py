@@ -1,8 +1,18 @@
 """Integration tests for the sync CLI command."""
 
+import json
 import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import git
 
 import fixture
+import gogitit.export
+from gogitit.lock import CacheLock
+from gogitit.manifest import CHECK_STATUS_SHA_CHANGED, repo_url_to_dir
 
 
 class SyncTests(fixture.IntegrationFixture):
@@ -163,3 +173,532 @@ class SyncTests(fixture.IntegrationFixture):
         self._assert_exists('roles/main.yml')
 
         # Re-run to trigger cleanup of previous dirs:
+
+    def test_two_versions_of_one_repo(self):
+        manifest = """---
+output_dir: ./
+repos:
+- url: https://github.com/dgoodwin/gogitit-test.git
+  version: v0.2
+  copy:
+      - src: roles
+        dst: old/roles
+- url: https://github.com/dgoodwin/gogitit-test.git
+  version: master
+  copy:
+      - src: roles
+        dst: new/roles"""
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self._assert_exists('old/roles/dummyrole1/tasks/main.yml')
+        self._assert_exists('new/roles/dummyrole1/tasks/main.yml')
+
+        # Doesn't exist in v0.2 tag.
+        self._assert_exists('old/roles/dummyrole3/tasks/main.yml', False)
+        self._assert_exists('new/roles/dummyrole3/tasks/main.yml')
+        self.assertEqual(1, result.output.count("Fetching refs:"))
+
+    def test_unchanged_copies_skipped(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('roles/', 'roles'),
+            ('playbooks/playbook1.yml', 'playbook1.yml'),
+        ])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Skipped 0 unchanged copies, updated 0 from git diff, rebuilt 2." in result.output)
+
+        # Touching a synced file without changing it leaves the copy unchanged:
+        marked = os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+        os.utime(marked, (0, 0))
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Skipped 2 unchanged copies, updated 0 from git diff, rebuilt 0." in result.output)
+
+        # Modifying one rebuilds its copy:
+        with open(marked, 'a') as f:
+            f.write("# marker\n")
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Skipped 1 unchanged copies, updated 0 from git diff, rebuilt 1." in result.output)
+        self.assertFalse("# marker" in open(marked).read())
+
+        result = self._run_sync(manifest, '--force')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Skipped 0 unchanged copies, updated 0 from git diff, rebuilt 2." in result.output)
+
+    def test_changed_copy_merges_with_overlapping(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('roles/', 'merged/'),
+            ('playbooks/*', 'merged/'),
+        ])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # Changing the roles entry rebuilds it without deleting merged/, so the unchanged
+        # playbooks entry is left in place:
+        manifest = self.build_manifest_str('v0.2', [
+            ('roles', 'merged/'),
+            ('playbooks/*', 'merged/'),
+        ])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Skipped 1 unchanged copies, updated 0 from git diff, rebuilt 1." in result.output)
+        self._assert_exists('merged/playbook1.yml')
+        self._assert_exists('merged/dummyrole1/tasks/main.yml')
+
+    def test_delta_between_versions(self):
+        manifest = self.build_manifest_str('v0.2', [('roles/', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self._assert_exists('roles/dummyrole3/tasks/main.yml', False)
+
+        # Files not changed between the commits must not be rewritten:
+        marked = os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+        with open(marked, 'a') as f:
+            f.write("# marker\n")
+
+        manifest = self.build_manifest_str('master', [('roles/', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("updated 1 from git diff" in result.output)
+        self._assert_exists('roles/dummyrole3/tasks/main.yml')
+        self.assertTrue("# marker" in open(marked).read())
+
+    def test_delta_renames(self):
+        url = self.create_repo('roles', {'roles/a.yml': 'a\n', 'roles/b.sh': 'b\n', 'roles/d.yml': 'd\n'})
+        repo = git.Repo(url[len('file://'):])
+        manifest = "---\noutput_dir: %s\nrepos:\n- url: %s\n  version: master\n  copy:\n" \
+            "  - src: roles\n    dst: roles\n" % (self.output_dir, url)
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        with open(os.path.join(self.output_dir, 'roles/a.yml'), 'w') as f:
+            f.write("local edit\n")
+
+        # Renamed with identical content, but modified locally, or made executable:
+        repo.git.mv('roles/a.yml', 'roles/renamed.yml')
+        repo.git.mv('roles/b.sh', 'roles/c.sh')
+        os.chmod(os.path.join(repo.working_dir, 'roles/c.sh'), 0o755)
+        repo.git.mv('roles/d.yml', 'roles/e.yml')
+        repo.git.commit('-a', '-m', 'Rename.')
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("updated 1 from git diff" in result.output)
+        self.assertEqual(1, result.output.count("  Rename: "))
+        with open(os.path.join(self.output_dir, 'roles/renamed.yml')) as f:
+            self.assertEqual('a\n', f.read())
+        self.assertTrue(os.stat(os.path.join(self.output_dir, 'roles/c.sh')).st_mode & 0o100)
+        self._assert_exists('roles/e.yml')
+        self._assert_exists('roles/d.yml', False)
+
+        result = self._run_check(manifest, '--verify')
+        self.assertEqual(0, result.exit_code)
+
+    def test_shallow_partial_clone(self):
+        manifest = """---
+output_dir: ./
+repos:
+- url: https://github.com/dgoodwin/gogitit-test.git
+  version: master
+  depth: 1
+  filter: blob:none
+  copy:
+      - src: roles/dummyrole1
+        dst: roles/dummyrole1"""
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self._assert_exists('roles/dummyrole1/tasks/main.yml')
+        self._assert_exists('roles/dummyrole2/tasks/main.yml', False)
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'github.com/dgoodwin/gogitit-test/shallow')))
+
+    def test_tag_not_fetched_again(self):
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Fetching refs: refs/tags/v0.2" in result.output)
+
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("All versions present in cache, skipping fetch." in result.output)
+
+    def test_error_reported(self):
+        url = self.create_repo('roles', {'roles/one/tasks/main.yml': 'one\n'})
+        manifest = "---\nrepos:\n- url: %s\n  version: master\n  copy:\n  - src: roles/missing\n" \
+            "    dst: roles/missing\n" % url
+        result = self._run_sync(manifest)
+        self.assertEqual(1, result.exit_code)
+        self.assertTrue("\nError: 1 of 1 repositories failed.\n" in result.output)
+
+    def test_unadvertised_sha(self):
+        url = self.create_repo('unadvertised', {'conf/app.yml': 'old\n'})
+        git_repo = git.Repo(url[len('file://'):])
+        sha = git_repo.head.commit.hexsha
+        self.create_repo('unadvertised', {'conf/app.yml': 'new\n'})
+        manifest = """---
+repos:
+- url: %s
+  version: %s
+  copy:
+      - src: conf/app.yml
+        dst: app.yml""" % (url, sha)
+
+        # Protocol version 2 allows any commit, version 0 only those a ref points at
+        # unless the server sets uploadpack.allowReachableSHA1InWant:
+        os.environ['GIT_CONFIG_PARAMETERS'] = "'protocol.version=0'"
+        try:
+            result = self._run_sync(manifest)
+        finally:
+            del os.environ['GIT_CONFIG_PARAMETERS']
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Unable to fetch commits by SHA, fetching remotes instead." in result.output)
+        self.assertEqual('old\n', open(os.path.join(self.output_dir, 'app.yml')).read())
+
+        cache = git.Repo(os.path.join(self.cache_dir, repo_url_to_dir(url)))
+        self.assertEqual(sha, cache.git.rev_parse('refs/gogitit/commits/%s' % sha))
+
+    def test_max_age(self):
+        manifest = self.build_manifest_str('master', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest, '--max-age', '3600')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Fetching refs:" in result.output)
+
+        result = self._run_sync(manifest, '--max-age', '3600')
+        self.assertEqual(0, result.exit_code)
+        self.assertFalse("Fetching refs:" in result.output)
+
+        result = self._run_sync(manifest, '--max-age', '3600', '--refresh')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Fetching refs:" in result.output)
+
+    def test_removed_entry_pruned(self):
+        manifest = self.build_manifest_str('v0.2', [
+            ('roles/', 'roles'),
+            ('playbooks/playbook1.yml', 'playbook1.yml'),
+        ])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # Files we did not write are never pruned:
+        with open(os.path.join(self.output_dir, 'roles/notes.txt'), 'w') as f:
+            f.write("notes\n")
+
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self._assert_exists('playbook1.yml')
+        self._assert_exists('roles/dummyrole1', False)
+        self._assert_exists('roles/notes.txt')
+
+    def test_modified_file_not_pruned(self):
+        manifest = self.build_manifest_str('v0.2', [('roles/', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        marked = os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+        with open(marked, 'a') as f:
+            f.write("# marker\n")
+
+        manifest = self.build_manifest_str('v0.2', [('roles/dummyrole2', 'roles/dummyrole2')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Keeping modified file no longer synced: %s" % marked in result.output)
+        self._assert_exists('roles/dummyrole1/tasks/main.yml')
+        self._assert_exists('roles/dummyrole2/tasks/main.yml')
+
+    def test_rebuild_leaves_current_files(self):
+        manifest = self.build_manifest_str('v0.2', [('roles/', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        path = os.path.join(self.output_dir, 'roles/dummyrole1/tasks/main.yml')
+        inode = os.stat(path).st_ino
+
+        # A changed entry producing the same files rebuilds without rewriting them:
+        manifest = self.build_manifest_str('v0.2', [('roles', 'roles')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("rebuilt 1." in result.output)
+        self.assertTrue("pruned 0 no longer synced." in result.output)
+        self.assertFalse("Left 0 files" in result.output)
+        self.assertEqual(inode, os.stat(path).st_ino)
+
+    def test_cache_locked(self):
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # Another process reading from the repo cache doesn't hold up fetching into it:
+        lock = CacheLock(os.path.join(self.cache_dir, 'github.com/dgoodwin/gogitit-test.lock'))
+        lock.acquire(False)
+        try:
+            result = self._run_sync(manifest, '--lock-timeout', '0')
+        finally:
+            lock.release()
+        self.assertEqual(0, result.exit_code)
+
+        # Another process fetching into it does:
+        lock = CacheLock(os.path.join(self.cache_dir, 'github.com/dgoodwin/gogitit-test.fetch.lock'))
+        lock.acquire(True)
+        try:
+            result = self._run_sync(manifest, '--lock-timeout', '0')
+        finally:
+            lock.release()
+        self.assertEqual(1, result.exit_code)
+        self.assertTrue("Timed out after 0s waiting for lock" in result.output)
+
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+    def test_concurrent_lock_order(self):
+        urls = [self.create_repo(name, {'%s.yml' % name: '%s\n' % name}) for name in ('a', 'b')]
+        paths = []
+        for name, order in (('forward', urls), ('backward', urls[::-1])):
+            paths.append(os.path.join(self.output_dir, '%s.yml' % name))
+            with open(paths[-1], 'w') as f:
+                f.write("---\noutput_dir: ./%s\nrepos:\n" % name)
+                for url in order:
+                    f.write("- url: %s\n  version: master\n  copy:\n  - src: %s\n    dst: ./\n" % (
+                        url, os.path.basename(url) + '.yml'))
+
+        def sync(path, lock_timeout='60'):
+            return subprocess.Popen(
+                [sys.executable, '-m', 'gogitit.cli', 'sync', '-m', path, '--cache-dir', self.cache_dir,
+                 '--lock-timeout', lock_timeout],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(fixture.cli.__file__))),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        # A process reading from the first cache the other fetches doesn't hold it up:
+        self.assertEqual(0, sync(paths[0]).wait())
+        lock = CacheLock(os.path.join(self.cache_dir, repo_url_to_dir(urls[1]) + '.lock'), 0)
+        lock.acquire(False)
+        try:
+            self.create_repo('a', {'a.yml': 'changed\n'})
+            self.create_repo('b', {'b.yml': 'changed\n'})
+            process = sync(paths[1], '5')
+            self.assertEqual(0, process.wait(), process.stdout.read())
+        finally:
+            lock.release()
+
+        # Nor do two processes fetching the same caches in opposite orders wait on each other:
+        self.create_repo('a', {'a.yml': 'again\n'})
+        self.create_repo('b', {'b.yml': 'again\n'})
+        processes = [sync(path) for path in paths]
+        for process in processes:
+            self.assertEqual(0, process.wait(), process.stdout.read())
+        for name in ('forward', 'backward'):
+            with open(os.path.join(self.output_dir, name, 'a.yml')) as f:
+                self.assertEqual('again\n', f.read())
+
+    def test_timings(self):
+        manifest = self.build_manifest_str('v0.2', [('roles/', 'roles')])
+        timings_path = os.path.join(self.cache_dir, 'timings.json')
+        result = self._run_sync(manifest, '--timings', '--timings-json', timings_path)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Timings:" in result.output)
+        with open(timings_path) as f:
+            timings = json.load(f)
+        copies = [phase for phase in timings['phases'] if phase['phase'] == 'copy']
+        self.assertEqual(["https://github.com/dgoodwin/gogitit-test.git:roles/ -> roles"],
+                         [phase['key'] for phase in copies])
+        self.assertTrue(copies[0]['files'] > 0 and copies[0]['bytes'] > 0)
+
+    def test_fork_borrows_reference_objects(self):
+        manifest = self.build_manifest_str('v0.2', [('playbooks/playbook1.yml', 'playbook1.yml')])
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+        reference_dir = os.path.join(self.cache_dir, 'github.com/dgoodwin/gogitit-test')
+
+        # A fork with the same history as its upstream:
+        fork_parent = tempfile.mkdtemp(prefix='gogitit-test-fork-')
+        try:
+            fork_url = os.path.join(fork_parent, 'gogitit-test-fork.git')
+            git.Repo.clone_from(reference_dir, fork_url, bare=True)
+            manifest = """---
+output_dir: ./
+repos:
+- url: %s
+  reference: https://github.com/dgoodwin/gogitit-test.git
+  version: v0.2
+  copy:
+  - src: roles/
+    dst: roles
+""" % fork_url
+            result = self._run_sync(manifest)
+        finally:
+            shutil.rmtree(fork_parent)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Sharing objects with: %s" % reference_dir in result.output)
+        self._assert_exists('roles/dummyrole1/tasks/main.yml')
+
+        # Nothing needed downloading, every object is borrowed:
+        fork_dir = os.path.join(self.cache_dir, fork_url.lstrip('/')[:-len('.git')])
+        counts = git.Repo(fork_dir).git.count_objects('-v')
+        self.assertTrue("count: 0\n" in counts and "in-pack: 0\n" in counts, counts)
+
+    def test_sync_all(self):
+        url = self.create_repo('roles', {'roles/one/tasks/main.yml': 'one\n'}, tag='v1')
+        self.create_repo('roles', {'roles/one/tasks/main.yml': 'two\n'})
+        paths = []
+        for name, version in (('a', 'master'), ('b', 'v1'), ('c', 'master')):
+            paths.append(os.path.join(self.output_dir, '%s.yml' % name))
+            with open(paths[-1], 'w') as f:
+                f.write("""---
+output_dir: ./%s
+repos:
+- url: %s
+  version: %s
+  copy:
+  - src: roles/one
+    dst: roles/one
+""" % (name, url, version))
+
+        result = self._run_sync_all(os.path.join(self.output_dir, '*.yml'), '--sync-jobs', '3')
+        self.assertEqual(0, result.exit_code)
+        # The repo is fetched once, for both versions:
+        self.assertTrue("Cloning 1 repositories at 2 versions for 3 manifests:" in result.output)
+        self.assertEqual(2, result.output.count("Already fetched"))
+        for name, content in (('a', 'two\n'), ('b', 'one\n'), ('c', 'two\n')):
+            with open(os.path.join(self.output_dir, name, 'roles/one/tasks/main.yml')) as f:
+                self.assertEqual(content, f.read())
+        self.assertTrue("  ok      %s -> %s" % (paths[1], os.path.join(self.output_dir, 'b')) in result.output)
+
+        # A manifest which fails doesn't stop the others:
+        with open(paths[0], 'w') as f:
+            f.write("---\noutput_dir: ./a\nrepos:\n- url: %s\n  copy:\n  - src: missing\n    dst: missing\n" % url)
+        result = self._run_sync_all(*paths)
+        self.assertEqual(1, result.exit_code)
+        self.assertTrue("  FAILED  %s: src does not exist" % paths[0] in result.output)
+        self.assertTrue("1 of 3 manifests failed." in result.output)
+        self.assertEqual(2, result.output.count("Unchanged: "))
+
+    def test_later_entry_wins(self):
+        first = self.create_repo('first', {'conf/x.yml': 'first\n'})
+        second = self.create_repo('second', {'conf/x.yml': 'second\n'})
+        manifest = "---\nrepos:\n" + "".join(
+            "- url: %s\n  version: master\n  copy:\n  - src: conf/*\n    dst: merged/\n" % url
+            for url in (first, second))
+        path = os.path.join(self.output_dir, 'merged/x.yml')
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        # Only the first entry is rebuilt, the skipped second still owns the file:
+        for i, args in enumerate([('--no-delta',), ()]):
+            self.create_repo('first', {'conf/x.yml': 'first %s\n' % i, 'conf/y.yml': 'y\n'})
+            result = self._run_sync(manifest, *args)
+            self.assertEqual(0, result.exit_code)
+            self.assertTrue("Unchanged: %s:conf/* -> merged/" % second in result.output)
+            with open(path) as f:
+                self.assertEqual('second\n', f.read())
+            self._assert_exists('merged/y.yml')
+
+    def test_file_becomes_dir(self):
+        url = self.create_repo('roles', {'roles/r2/tasks/main.yml': 'main\n'})
+        repo_dir = url[len('file://'):]
+        manifest = """---
+repos:
+- url: %s
+  version: master
+  copy:
+  - src: roles/r2
+    dst: roles/r2
+""" % url
+        main = os.path.join(self.output_dir, 'roles/r2/tasks/main.yml')
+        result = self._run_sync(manifest)
+        self.assertEqual(0, result.exit_code)
+
+        git.Repo(repo_dir).git.rm('roles/r2/tasks/main.yml')
+        self.create_repo('roles', {'roles/r2/tasks/main.yml/tasks.yml': 'tasks\n'})
+        result = self._run_sync(manifest, '--no-delta')
+        self.assertEqual(0, result.exit_code)
+        with open(os.path.join(main, 'tasks.yml')) as f:
+            self.assertEqual('tasks\n', f.read())
+
+        # And back again:
+        git.Repo(repo_dir).git.rm('-r', 'roles/r2/tasks/main.yml')
+        self.create_repo('roles', {'roles/r2/tasks/main.yml': 'main\n'})
+        result = self._run_sync(manifest, '--force')
+        self.assertEqual(0, result.exit_code)
+        self.assertFalse("Keeping modified file" in result.output)
+        with open(main) as f:
+            self.assertEqual('main\n', f.read())
+
+    def test_removed_file_becomes_dir(self):
+        url = self.create_repo('roles', {'thing.yml': 'thing\n', 'conf/main.yml': 'main\n'})
+        entries = """---
+repos:
+- url: %s
+  version: master
+  copy:
+""" % url
+        result = self._run_sync(entries + "  - src: thing.yml\n    dst: thing\n  - src: conf\n    dst: other\n")
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, 'thing')))
+
+        # The file of a removed entry is in the way of the directory of another:
+        result = self._run_sync(entries + "  - src: conf\n    dst: thing\n")
+        self.assertEqual(0, result.exit_code)
+        with open(os.path.join(self.output_dir, 'thing/main.yml')) as f:
+            self.assertEqual('main\n', f.read())
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'other')))
+
+    def test_targets(self):
+        url = self.create_repo('roles', {'roles/one/tasks/main.yml': 'one\n', 'roles/two/tasks/main.yml': 'two\n'},
+                               tag='v1')
+        self.create_repo('roles', {'roles/one/tasks/main.yml': 'changed\n'})
+        manifest = """---
+repos:
+- url: %s
+  version: v1
+  copy:
+  - src: roles/
+    dst: roles
+targets:
+  prod:
+    output_dir: ./prod
+  qa:
+    output_dir: ./qa
+  staging:
+    output_dir: ./staging
+    versions:
+      %s: master
+""" % (url, url)
+        store = os.path.join(self.cache_dir, '.blobs')
+        written = []
+        blob_store_get = gogitit.export.BlobStore.get
+
+        def get(blob_store, blob):
+            written.append(blob.hexsha)
+            return blob_store_get(blob_store, blob)
+        gogitit.export.BlobStore.get = get
+        try:
+            result = self._run_sync_targets(manifest)
+        finally:
+            gogitit.export.BlobStore.get = blob_store_get
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Cloning 1 repositories at 2 versions for 3 manifests:" in result.output)
+        for target, content in (('prod', 'one\n'), ('qa', 'one\n'), ('staging', 'changed\n')):
+            with open(os.path.join(self.output_dir, target, 'roles/one/tasks/main.yml')) as f:
+                self.assertEqual(content, f.read())
+            self._assert_exists('%s/roles/two/tasks/main.yml' % target)
+        # Only the files of prod and qa, at the same commit, were shared through the store,
+        # which copy mode leaves empty once done:
+        self.assertEqual(4, len(written))
+        self.assertEqual(2, len(set(written)))
+        self.assertEqual(0, sum(len(files) for root, dirs, files in os.walk(store)))
+
+        result = self._run_sync_targets(manifest, '--target', 'staging')
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Output ready in: %s" % os.path.join(self.output_dir, 'staging') in result.output)
+        self.assertFalse("prod" in result.output)
+
+        # Several targets can't share one output dir:
+        result = self._run_sync(manifest)
+        self.assertEqual(1, result.exit_code)
+        self.assertTrue("An output dir can only be given for a single target." in result.output)
+
+        # Check looks at every target:
+        result = self._run_check(manifest)
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue("Target: qa" in result.output)
+        self.create_repo('roles', {'roles/one/tasks/main.yml': 'changed again\n'})
+        result = self._run_check(manifest)
+        self.assertEqual(CHECK_STATUS_SHA_CHANGED, result.exit_code)
+        result = self._run_check(manifest, '--target', 'prod')
+        self.assertEqual(0, result.exit_code)
@@ -0,0 +1,113 @@
+""" Unit tests for cache module. """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import click
+import git
+
+import gogitit.cache as cache
+from gogitit.lock import CacheLock
+from gogitit.manifest import RepoCache
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='gogitit-test-cache-')
+        self.echoed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _repo(self, path, last_used):
+        repo_dir = os.path.join(self.cache_dir, path)
+        git_repo = git.Repo.init(repo_dir, mkdir=True, bare=True)
+        git_repo.create_remote('origin', 'https://%s.git' % path)
+        repo_cache = RepoCache(self.cache_dir, 'https://%s.git' % path)
+        repo_cache._save_meta({'last_used': last_used})
+        return repo_cache
+
+    def test_find(self):
+        self._repo('github.com/a/one', 1)
+        self._repo('github.com/b/two', 2)
+        os.makedirs(os.path.join(self.cache_dir, '.blobs', 'ab'))
+        caches = cache.find(self.cache_dir)
+        self.assertEquals(['https://github.com/a/one.git', 'https://github.com/b/two.git'],
+                          [c.url for c in caches])
+        self.assertEquals(1, caches[0].last_used())
+
+    def test_prune_least_recently_used(self):
+        now = time.time()
+        oldest = self._repo('github.com/a/oldest', now - 300)
+        older = self._repo('github.com/a/older', now - 200)
+        newest = self._repo('github.com/a/newest', now - 100)
+        # Sizes differ slightly, so evicting only one cache fits the kept cache and the newest:
+        max_size = cache.size(oldest.repo_dir) + cache.size(newest.repo_dir)
+        removed, freed = cache.prune(cache.find(self.cache_dir), max_size, keep=[oldest.repo_dir],
+                                     echo=self.echoed.append)
+        self.assertEquals(1, removed)
+        self.assertTrue(freed > 0)
+        self.assertFalse(os.path.exists(older.repo_dir))
+        self.assertTrue(os.path.exists(oldest.repo_dir))
+        self.assertTrue(os.path.exists(newest.repo_dir))
+
+    def test_prune_unused(self):
+        now = time.time()
+        old = self._repo('github.com/a/old', now - 3 * 86400)
+        new = self._repo('github.com/a/new', now)
+        self.assertEquals(1, cache.prune(cache.find(self.cache_dir), unused_for=86400, echo=self.echoed.append)[0])
+        self.assertFalse(os.path.exists(old.repo_dir))
+        self.assertTrue(os.path.exists(new.repo_dir))
+
+    def test_prune_skips_locked(self):
+        old = self._repo('github.com/a/old', 1)
+        lock = CacheLock(old.lock.path)
+        lock.acquire(False)
+        try:
+            self.assertEquals(0, cache.prune(cache.find(self.cache_dir), unused_for=0, echo=self.echoed.append)[0])
+        finally:
+            lock.release()
+        self.assertTrue(os.path.exists(old.repo_dir))
+        self.assertEquals(["  In use, not removed: %s" % old.repo_dir], self.echoed)
+
+    def test_prune_store(self):
+        store_dir = os.path.join(self.cache_dir, '.blobs')
+        os.makedirs(os.path.join(store_dir, 'ab'))
+        old = time.time() - 3 * 86400
+        paths = {}
+        for name in ('old', 'linked', 'new'):
+            paths[name] = os.path.join(store_dir, 'ab', name)
+            with open(paths[name], 'w') as f:
+                f.write(name)
+            if name != 'new':
+                os.utime(paths[name], (old, old))
+        os.link(paths['linked'], os.path.join(self.cache_dir, 'output'))
+
+        self.assertEquals((0, 3), cache.prune([], unused_for=86400, store_dir=store_dir, echo=self.echoed.append))
+        self.assertEquals(["  Removed 1 files from the blob store, freeing 3B."], self.echoed)
+        self.assertFalse(os.path.exists(paths['old']))
+
+        # Files an output is hard linked to take no space of their own:
+        self.assertEquals((0, 3), cache.prune([], 0, store_dir=store_dir, echo=self.echoed.append))
+        self.assertFalse(os.path.exists(paths['new']))
+        self.assertTrue(os.path.exists(paths['linked']))
+
+    def test_gc_interval(self):
+        repo_cache = self._repo('github.com/a/one', 1)
+        self.assertEquals(1, cache.gc(cache.find(self.cache_dir), echo=self.echoed.append))
+        self.assertTrue(repo_cache.last_gc() > 1)
+        self.assertEquals(0, cache.gc(cache.find(self.cache_dir), 3600, echo=self.echoed.append))
+
+    def test_parse_size(self):
+        self.assertEquals(500, cache.parse_size('500'))
+        self.assertEquals(10 * 1024 ** 3, cache.parse_size('10G'))
+        self.assertEquals(1536 * 1024, cache.parse_size('1.5MiB'))
+        self.assertRaises(click.BadParameter, cache.parse_size, '10X')
+
+    def test_format_size(self):
+        self.assertEquals('512B', cache.format_size(512))
+        self.assertEquals('1.5M', cache.format_size(1536 * 1024))
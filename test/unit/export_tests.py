@@ -0,0 +1,193 @@
+""" Unit tests for export module. """
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import git
+
+import gogitit.export
+from gogitit.export import BlobStore, CommitTree, Exporter
+
+
+class CommitTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gogitit-test-export-')
+        repo_dir = os.path.join(self.tmp_dir, 'repo')
+        git_repo = git.Repo.init(repo_dir, mkdir=True)
+        for path in ['roles/role1/tasks/main.yml', 'roles/role2/tasks/main.yml',
+                     'roles/.hidden/main.yml', 'playbooks/playbook1.yml', 'README.md']:
+            full_path = os.path.join(repo_dir, path)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'w') as f:
+                f.write(path)
+        os.chmod(os.path.join(repo_dir, 'playbooks/playbook1.yml'), 0o755)
+        os.symlink('role1', os.path.join(repo_dir, 'roles/link'))
+        git_repo.git.add('-A')
+        git_repo.git.commit('-m', 'Initial commit.', author='Test <test@example.com>',
+                            env={'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com'})
+        self.tree = CommitTree(git_repo, git_repo.head.commit.hexsha)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_glob_literal(self):
+        self.assertEquals(['roles/role1'], self.tree.glob('roles/role1'))
+
+    def test_glob_missing(self):
+        self.assertEquals([], self.tree.glob('roles/role3'))
+
+    def test_glob_wildcard_skips_hidden(self):
+        self.assertEquals(['roles/link', 'roles/role1', 'roles/role2'], self.tree.glob('roles/*'))
+
+    def test_glob_trailing_slash_only_dirs(self):
+        self.assertEquals(['roles/role1', 'roles/role2'], self.tree.glob('roles/*/'))
+        self.assertEquals([], self.tree.glob('README.md/'))
+
+    def test_glob_top_level(self):
+        self.assertEquals(['.'], self.tree.glob('./'))
+
+    def test_is_dir(self):
+        self.assertTrue(self.tree.is_dir('roles'))
+        self.assertTrue(self.tree.is_dir('.'))
+        self.assertFalse(self.tree.is_dir('README.md'))
+        self.assertFalse(self.tree.is_dir('missing'))
+
+    def test_export_dir(self):
+        dest = os.path.join(self.tmp_dir, 'output', 'roles')
+        Exporter().export(self.tree, 'roles', dest)
+        with open(os.path.join(dest, 'role1/tasks/main.yml')) as f:
+            self.assertEquals('roles/role1/tasks/main.yml', f.read())
+        self.assertEquals('role1', os.readlink(os.path.join(dest, 'link')))
+
+    def test_export_executable(self):
+        dest = os.path.join(self.tmp_dir, 'output', 'playbook1.yml')
+        Exporter().export(self.tree, 'playbooks/playbook1.yml', dest)
+        self.assertTrue(os.stat(dest).st_mode & 0o100)
+
+    def test_export_hardlink(self):
+        store = BlobStore(os.path.join(self.tmp_dir, 'blobs'))
+        dest = os.path.join(self.tmp_dir, 'output', 'playbook1.yml')
+        Exporter('hardlink', store).export(self.tree, 'playbooks/playbook1.yml', dest)
+        store_path = store.get(self.tree.get('playbooks/playbook1.yml'))
+        self.assertTrue(os.path.samefile(store_path, dest))
+
+        # Store files are read only so linked output can't be edited in place:
+        self.assertFalse(os.stat(dest).st_mode & 0o222)
+
+    def test_export_auto_never_hardlinks(self):
+        store = BlobStore(os.path.join(self.tmp_dir, 'blobs'))
+        dest = os.path.join(self.tmp_dir, 'output', 'playbook1.yml')
+        Exporter('auto', store).export(self.tree, 'playbooks/playbook1.yml', dest)
+        self.assertFalse(os.path.samefile(store.get(self.tree.get('playbooks/playbook1.yml')), dest))
+
+    def test_store_rewrites_changed_file(self):
+        blob = self.tree.get('playbooks/playbook1.yml')
+        store_path = BlobStore(os.path.join(self.tmp_dir, 'blobs')).get(blob)
+        # Edited in place to content of the same size, as root could through a hard link:
+        os.chmod(store_path, 0o644)
+        with open(store_path, 'w') as f:
+            f.write('x' * blob.size)
+        self.assertEquals(store_path, BlobStore(os.path.join(self.tmp_dir, 'blobs')).get(blob))
+        with open(store_path) as f:
+            self.assertEquals('playbooks/playbook1.yml', f.read())
+
+    def test_export_replaces_link(self):
+        store = BlobStore(os.path.join(self.tmp_dir, 'blobs'))
+        dest = os.path.join(self.tmp_dir, 'output', 'playbook1.yml')
+        Exporter('hardlink', store).export(self.tree, 'playbooks/playbook1.yml', dest)
+        Exporter('copy').export(self.tree, 'README.md', dest)
+        store_path = store.get(self.tree.get('playbooks/playbook1.yml'))
+        self.assertFalse(os.path.samefile(store_path, dest))
+        with open(store_path) as f:
+            self.assertEquals('playbooks/playbook1.yml', f.read())
+
+    def test_export_workers(self):
+        dest = os.path.join(self.tmp_dir, 'output')
+        records = []
+        exporter = Exporter(workers=4)
+        count = exporter.export_pairs(
+            self.tree, [('roles', os.path.join(dest, 'roles')), ('README.md', os.path.join(dest, 'README.md'))],
+            lambda path, blob: records.append(path))
+        self.assertEquals(5, count)
+        self.assertEquals(sorted(records), sorted(
+            os.path.join(dest, path) for path in ['roles/role1/tasks/main.yml', 'roles/role2/tasks/main.yml',
+                                                  'roles/.hidden/main.yml', 'roles/link', 'README.md']))
+        with open(os.path.join(dest, 'roles/role2/tasks/main.yml')) as f:
+            self.assertEquals('roles/role2/tasks/main.yml', f.read())
+        self.assertEquals('role1', os.readlink(os.path.join(dest, 'roles/link')))
+
+        # The same threads, with a repo each, write the files of the next export:
+        pool = exporter._pool
+        exporter.export(self.tree, 'roles', os.path.join(dest, 'again'))
+        self.assertTrue(exporter._pool is pool)
+        self.assertTrue(len(exporter._repos) <= 4)
+        exporter.close()
+        self.assertEquals([], exporter._repos)
+
+
+class CopyFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gogitit-test-copy-')
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dest = os.path.join(self.tmp_dir, 'dest')
+        with open(self.src, 'w') as f:
+            f.write('0123456789')
+        self.calls = []
+        self.copy_file_range = getattr(os, 'copy_file_range', None)
+
+    def tearDown(self):
+        if self.copy_file_range is None:
+            if hasattr(os, 'copy_file_range'):
+                del os.copy_file_range
+        else:
+            os.copy_file_range = self.copy_file_range
+        shutil.rmtree(self.tmp_dir)
+
+    def _copy(self, copy_file_range):
+        os.copy_file_range = copy_file_range
+        gogitit.export._copy_file(self.src, self.dest, 0o644)
+        with open(self.dest) as f:
+            return f.read()
+
+    def test_kernel_copy(self):
+        def copy_file_range(src_fd, dest_fd, count):
+            self.calls.append(count)
+            # The kernel may copy less than asked for:
+            return os.write(dest_fd, os.read(src_fd, min(count, 4)))
+        self.assertEquals('0123456789', self._copy(copy_file_range))
+        self.assertEquals([10, 6, 2], self.calls)
+
+    def test_kernel_copy_unsupported(self):
+        def copy_file_range(src_fd, dest_fd, count):
+            raise OSError(errno.EXDEV, "Cross-device link")
+        self.assertEquals('0123456789', self._copy(copy_file_range))
+
+    def test_sendfile(self):
+        if gogitit.export._sendfile is None:
+            raise unittest.SkipTest("sendfile not available")
+        if hasattr(os, 'copy_file_range'):
+            del os.copy_file_range
+        with open(self.src, 'w') as f:
+            f.write('0123456789' * 100000)
+        src_fd = os.open(self.src, os.O_RDONLY)
+        dest_fd = os.open(self.dest, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            self.assertTrue(gogitit.export._kernel_copy(src_fd, dest_fd, 1000000))
+        finally:
+            os.close(src_fd)
+            os.close(dest_fd)
+        with open(self.dest) as f:
+            self.assertEquals('0123456789' * 100000, f.read())
+
+    def test_kernel_copy_short(self):
+        def copy_file_range(src_fd, dest_fd, count):
+            # The source shrank after the first call:
+            self.calls.append(count)
+            return os.write(dest_fd, os.read(src_fd, 4)) if len(self.calls) == 1 else 0
+        self.assertRaises(IOError, self._copy, copy_file_range)
@@ -0,0 +1,87 @@
+""" Unit tests for jobs module. """
+
+import threading
+import unittest
+
+import gogitit.jobs as jobs
+from gogitit.errors import ManifestError, RepoError
+
+
+class FakeCache(object):
+
+    def __init__(self, url, reference=None):
+        self.url = url
+        self.reference = reference
+
+    def __eq__(self, other):
+        return self.url == other.url
+
+    def __hash__(self):
+        return hash(self.url)
+
+
+class FakeRepo(object):
+
+    def __init__(self, url, version='master', reference=None):
+        self.url = url
+        self.version = version
+        self.cache = FakeCache(url, reference and FakeCache(reference))
+
+
+class RepoHostTests(unittest.TestCase):
+
+    def test_https(self):
+        self.assertEquals("github.com", jobs.repo_host("https://github.com/openshift/online-archivist.git"))
+
+    def test_ssh_scp_syntax_user(self):
+        self.assertEquals("server", jobs.repo_host("user@server:project.git"))
+
+
+class RunTests(unittest.TestCase):
+
+    def test_all_repos_run(self):
+        repos = [FakeRepo("https://example.com/%s.git" % i) for i in range(5)]
+        done = []
+        jobs.run(repos, lambda repo, echo: done.append(repo), jobs=3)
+        self.assertEquals(set(repos), set(done))
+
+    def test_same_cache_runs_in_order(self):
+        repos = [FakeRepo("https://example.com/a.git", v) for v in ['v1', 'v2', 'v3']]
+        done = []
+        jobs.run(repos, lambda repo, echo: done.append(repo.version), jobs=3)
+        self.assertEquals(['v1', 'v2', 'v3'], done)
+
+    def test_reference_runs_in_same_job(self):
+        repos = [FakeRepo("https://example.com/fork%s.git" % i, reference="https://example.com/a.git")
+                 for i in range(3)] + [FakeRepo("https://example.com/a.git")]
+        threads = set()
+        jobs.run(repos, lambda repo, echo: threads.add(threading.current_thread()), jobs=4)
+        self.assertEquals(1, len(threads))
+
+    def test_per_host_cap(self):
+        repos = [FakeRepo("https://example.com/%s.git" % i) for i in range(6)]
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def func(repo, echo):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            threading.Event().wait(0.02)
+            with lock:
+                state['running'] -= 1
+
+        jobs.run(repos, func, jobs=6, per_host=2)
+        self.assertTrue(state['max'] <= 2)
+
+    def test_failure_runs_remaining_repos(self):
+        repos = [FakeRepo("https://example.com/%s.git" % i) for i in range(3)]
+        done = []
+
+        def func(repo, echo):
+            if repo is repos[0]:
+                raise ManifestError("src does not exist")
+            done.append(repo)
+
+        self.assertRaises(RepoError, jobs.run, repos, func, 2)
+        self.assertEquals(set(repos[1:]), set(done))
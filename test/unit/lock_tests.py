@@ -0,0 +1,68 @@
+""" Unit tests for lock module. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gogitit.errors import LockTimeout
+from gogitit.lock import CacheLock
+
+
+class CacheLockTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gogitit-test-lock-')
+        self.path = os.path.join(self.tmp_dir, 'github.com', 'repo.lock')
+        self.echoed = []
+        self.locks = []
+
+    def tearDown(self):
+        for lock in self.locks:
+            lock.release()
+        shutil.rmtree(self.tmp_dir)
+
+    def _lock(self, timeout=0.2):
+        lock = CacheLock(self.path, timeout)
+        self.locks.append(lock)
+        return lock
+
+    def test_shared(self):
+        self._lock().acquire(False, self.echoed.append)
+        self._lock().acquire(False, self.echoed.append)
+        self.assertEquals([], self.echoed)
+
+    def test_exclusive_waits_for_shared(self):
+        self._lock().acquire(False, self.echoed.append)
+        self.assertRaises(LockTimeout, self._lock().acquire, True, self.echoed.append)
+        self.assertEquals(1, len(self.echoed))
+
+    def test_shared_waits_for_exclusive(self):
+        self._lock().acquire(True, self.echoed.append)
+        self.assertRaises(LockTimeout, self._lock().acquire, False, self.echoed.append)
+
+    def test_downgrade(self):
+        lock = self._lock()
+        lock.acquire(True, self.echoed.append)
+        lock.acquire(False, self.echoed.append)
+        self._lock().acquire(False, self.echoed.append)
+        self.assertEquals([], self.echoed)
+
+    def test_release(self):
+        lock = self._lock()
+        lock.acquire(True, self.echoed.append)
+        lock.release()
+        self._lock().acquire(True, self.echoed.append)
+        self.assertEquals([], self.echoed)
+
+    def test_try_acquire(self):
+        reader = self._lock()
+        reader.acquire(False, self.echoed.append)
+        lock = self._lock()
+        lock.acquire(False, self.echoed.append)
+        self.assertFalse(lock.try_acquire(True, self.echoed.append))
+        # Still held shared once the upgrade fails:
+        self.assertFalse(self._lock().try_acquire(True, self.echoed.append))
+        reader.release()
+        self.assertTrue(lock.try_acquire(True, self.echoed.append))
+        self.assertFalse(self._lock().try_acquire(False, self.echoed.append))
@@ -1,8 +1,10 @@
 """ Unit tests for manifest module. """
 
+import io
 import unittest
 
 import gogitit.manifest as manifest
+from gogitit.errors import ManifestError
 
 class RepoUrlToCacheDirTests(unittest.TestCase):
 
@@ -49,3 +51,106 @@ class RepoUrlToCacheDirTests(unittest.TestCase):
     def test_ssh_scp_syntax_no_user(self):
         self.assertEquals("server/project",
                 manifest.repo_url_to_dir("server:project.git"))
+
+
+class RepoCacheTests(unittest.TestCase):
+
+    def _manifest(self, *entries):
+        repos = [{'url': url, 'version': version, 'copy': [{'src': 'roles', 'dst': 'roles'}]}
+                 for url, version in entries]
+        return manifest.Manifest('gogitit.yml', '/cache', output_dir='./', repos=repos)
+
+    def test_same_url_shares_cache(self):
+        m = self._manifest(("https://github.com/openshift/openshift-ansible.git", "v3.0.2"),
+                           ("https://github.com/openshift/openshift-ansible", "master"))
+        self.assertEquals(1, len(m.repo_caches))
+        self.assertTrue(m.repos[0].cache is m.repos[1].cache)
+
+    def test_reference(self):
+        repos = [{'url': 'https://example.com/fork.git', 'reference': 'https://example.com/upstream.git',
+                  'copy': [{'src': 'roles', 'dst': 'roles'}]}]
+        m = manifest.Manifest('gogitit.yml', '/cache', output_dir='./', repos=repos)
+        self.assertTrue(m.repos[0].cache.reference is m.repo_cache('https://example.com/upstream.git'))
+        self.assertEquals([], m.repo_cache('https://example.com/upstream.git').versions)
+
+    def test_circular_reference(self):
+        repos = [{'url': 'https://example.com/a.git', 'reference': 'https://example.com/b.git',
+                  'copy': [{'src': 'roles', 'dst': 'roles'}]},
+                 {'url': 'https://example.com/b.git', 'reference': 'https://example.com/a.git',
+                  'copy': [{'src': 'roles', 'dst': 'roles'}]}]
+        self.assertRaises(ManifestError, manifest.Manifest, 'gogitit.yml', '/cache',
+                          output_dir='./', repos=repos)
+
+
+class SpecHashTests(unittest.TestCase):
+
+    def _manifest(self, repo):
+        return manifest.Manifest('gogitit.yml', '/cache', output_dir='./', repos=[repo])
+
+    def test_default_version(self):
+        m1 = self._manifest({'url': 'https://example.com/a.git', 'copy': [{'src': 'roles', 'dst': None}]})
+        m2 = self._manifest({'url': 'https://example.com/a.git', 'version': 'master',
+                             'copy': [{'src': 'roles', 'dst': ''}]})
+        self.assertEquals(m1.repos[0].spec_hash(), m2.repos[0].spec_hash())
+        self.assertEquals(m1.repos[0].copy[0].spec_hash(), m2.repos[0].copy[0].spec_hash())
+
+    def test_version_changes_copy(self):
+        m1 = self._manifest({'url': 'https://example.com/a.git', 'copy': [{'src': 'roles', 'dst': 'roles'}]})
+        m2 = self._manifest({'url': 'https://example.com/a.git', 'version': 'v1',
+                             'copy': [{'src': 'roles', 'dst': 'roles'}]})
+        self.assertNotEquals(m1.repos[0].copy[0].spec_hash(), m2.repos[0].copy[0].spec_hash())
+
+
+class TargetTests(unittest.TestCase):
+
+    MANIFEST = u"""---
+output_dir: ./out
+repos:
+- url: https://example.com/a.git
+  version: v1
+  copy:
+  - src: roles
+    dst: roles
+- url: https://example.com/b.git
+  targets: [staging]
+  copy:
+  - src: roles
+    dst: roles
+targets:
+  prod:
+    output_dir: ./prod
+  staging:
+    output_dir: ./staging
+    versions:
+      https://example.com/a.git: develop
+    repos:
+    - url: https://example.com/c.git
+      copy:
+      - src: playbooks
+        dst: playbooks
+"""
+
+    def _load(self, text, targets=None):
+        f = io.StringIO(text)
+        f.name = 'gogitit.yml'
+        return manifest.load_targets(f, '/cache', None, targets)
+
+    def test_targets(self):
+        prod, staging = self._load(self.MANIFEST)
+        self.assertEquals(('prod', './prod', 'gogitit.yml[prod]'), (prod.target, prod.output_dir, prod.key))
+        self.assertEquals([('https://example.com/a.git', 'v1')], [(r.url, r.version) for r in prod.repos])
+        self.assertEquals([('https://example.com/a.git', 'develop'), ('https://example.com/b.git', 'master'),
+                           ('https://example.com/c.git', 'master')], [(r.url, r.version) for r in staging.repos])
+        # One cache for the repo, fetching the versions of both targets:
+        self.assertTrue(prod.repos[0].cache is staging.repos[0].cache)
+        self.assertEquals(['v1', 'develop'], prod.repos[0].cache.versions)
+
+    def test_select_target(self):
+        self.assertEquals(['staging'], [m.target for m in self._load(self.MANIFEST, ['staging'])])
+        self.assertRaises(ManifestError, self._load, self.MANIFEST, ['dev'])
+        self.assertRaises(ManifestError, self._load, self.MANIFEST.replace('[staging]', '[dev]'))
+
+    def test_no_targets(self):
+        m, = self._load(u"---\noutput_dir: ./out\nrepos: []\n")
+        self.assertEquals((None, 'gogitit.yml'), (m.target, m.key))
+        self.assertRaises(ManifestError, self._load, u"---\noutput_dir: ./out\nrepos: []\n", ['prod'])
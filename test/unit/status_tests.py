@@ -0,0 +1,78 @@
+""" Unit tests for status module. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+import gogitit.status as status
+
+
+class StatusTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix='gogitit-test-status-')
+        self.copy = {'sha': 'a' * 40, 'paths': [os.path.join(self.output_dir, 'roles')],
+                     'dirs': [os.path.join(self.output_dir, 'roles')], 'spec': 'b' * 40, 'repo_spec': 'c' * 40}
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _write(self):
+        writer = status.StatusWriter(self.output_dir, 'd' * 40)
+        writer.add_copy('repo1:roles -> roles', self.copy)
+        writer.add_file(os.path.join(self.output_dir, 'roles/a.yml'), 'e' * 40, 10, 1.5, 100)
+        writer.add_file(os.path.join(self.output_dir, 'roles/b.yml'), 'f' * 40, 20, 2.5, 101)
+        writer.add_copy('repo2:. -> ', dict(self.copy, paths=[self.output_dir]), indexed=False)
+        writer.close()
+
+    def test_missing(self):
+        self.assertEquals(None, status.load(self.output_dir))
+
+    def test_load(self):
+        self._write()
+        loaded = status.load(self.output_dir)
+        self.assertEquals('d' * 40, loaded.manifest_sha)
+        self.assertEquals(self.copy, dict((k, v) for k, v in loaded.copies['repo1:roles -> roles'].items()
+                                          if k != 'indexed'))
+        self.assertEquals('a' * 40, loaded.paths[os.path.join(self.output_dir, 'roles')])
+        self.assertEquals([self.output_dir], loaded.copies['repo2:. -> ']['paths'])
+
+    def test_files(self):
+        self._write()
+        loaded = status.load(self.output_dir)
+        self.assertEquals([
+            status.FileRecord(os.path.join(self.output_dir, 'roles/a.yml'), 'e' * 40, 10, 1.5, 100),
+            status.FileRecord(os.path.join(self.output_dir, 'roles/b.yml'), 'f' * 40, 20, 2.5, 101),
+        ], list(loaded.files('repo1:roles -> roles')))
+        self.assertTrue(loaded.is_indexed('repo1:roles -> roles'))
+        self.assertFalse(loaded.is_indexed('repo2:. -> '))
+        self.assertEquals([], list(loaded.files('repo2:. -> ')))
+
+    def test_abort_keeps_previous(self):
+        self._write()
+        writer = status.StatusWriter(self.output_dir, '0' * 40)
+        writer.abort()
+        self.assertEquals('d' * 40, status.load(self.output_dir).manifest_sha)
+        self.assertEquals([status.STATUS_FILE], os.listdir(self.output_dir))
+
+    def test_legacy(self):
+        dest = os.path.join(self.output_dir, 'playbook1.yml')
+        with open(os.path.join(self.output_dir, status.LEGACY_STATUS_FILE), 'w') as f:
+            f.write(yaml.dump({'manifest_sha': 'd' * 40, 'paths': {dest: 'a' * 40}}))
+        loaded = status.load(self.output_dir)
+        self.assertEquals('d' * 40, loaded.manifest_sha)
+        self.assertEquals({dest: 'a' * 40}, loaded.paths)
+        self.assertEquals({}, loaded.copies)
+
+        self._write()
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, status.LEGACY_STATUS_FILE)))
+
+    def test_blob_sha(self):
+        path = os.path.join(self.output_dir, 'hello')
+        with open(path, 'w') as f:
+            f.write('hello\n')
+        # As given by git hash-object:
+        self.assertEquals('ce013625030ba8dba906f756967f9e9ca394464a', status.blob_sha(path))
@@ -0,0 +1,63 @@
+""" Unit tests for timings module. """
+
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+
+from gogitit.timings import Profiler, Timings
+
+
+class TimingsTests(unittest.TestCase):
+
+    def test_summary(self):
+        timings = Timings()
+        with timings.phase('copy', 'repo1:roles -> roles') as phase:
+            phase['files'] = 3
+            phase['bytes'] = 100
+        with timings.phase('copy', 'repo2:roles -> roles') as phase:
+            phase['files'] = 2
+            phase['bytes'] = 50
+        with timings.phase('prune'):
+            pass
+        timings.stop()
+        summary = timings.summary()
+        self.assertEquals(['copy', 'prune'], [total['phase'] for total in summary])
+        self.assertEquals((2, 5, 150), (summary[0]['count'], summary[0]['files'], summary[0]['bytes']))
+        self.assertEquals(None, summary[1]['files'])
+        self.assertTrue(timings.table()[1].startswith('copy'))
+        self.assertEquals(3, len(timings.to_json()['phases']))
+
+    def test_failed_phase_not_recorded(self):
+        timings = Timings()
+        try:
+            with timings.phase('clone', 'repo1'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals([], timings.phases)
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gogitit-test-profile-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_threads_profiled(self):
+        def work_in_thread():
+            sorted(range(1000))
+
+        path = os.path.join(self.tmp_dir, 'sync.prof')
+        profiler = Profiler()
+        profiler.start()
+        thread = threading.Thread(target=work_in_thread)
+        thread.start()
+        thread.join()
+        profiler.stop(path)
+        functions = [func[2] for func in pstats.Stats(path).stats]
+        self.assertTrue('work_in_thread' in functions)